@@ -5,24 +5,35 @@ from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Dict, List
+from typing import Dict, List, Optional
 import pandas as pd
 import csv
 from uuid import UUID, uuid4
-import requests
 from dotenv import load_dotenv
-from fastapi import Depends
-from sqlalchemy.orm import Session
-from database import SessionLocal, ThreadDB
-
-
-# Dependency to get the database session
-def get_db():
-    db = SessionLocal()
-    try:
+from fastapi import Depends, Query, Request
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, ThreadDB, MessageDB, aappend_messages, aread_messages, async_engine, write_transaction
+from thread_store import ThreadStore
+import cache
+import chunking
+import coalesce
+import context
+import extraction
+import ingest
+import listing
+import llm
+import retrieval
+import scheduler
+import streaming
+import telemetry
+
+
+# Dependency to get the database session. Sessions are async, so database work is
+# awaited instead of blocking the event loop.
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 
@@ -40,8 +51,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request ids, timed spans of each stage and a Prometheus /metrics endpoint
+telemetry.instrument(app, "AzureChat")
+
 # Data structure to hold user threads
-user_threads: Dict[str, List[Dict]] = {}
+thread_store = ThreadStore()
 
 # Define a directory to save uploaded files
 UPLOAD_DIR = "uploaded_files"
@@ -59,76 +73,87 @@ class Thread(BaseModel):
     messages: List[Message] = []  # Add messages to the thread
     uploaded_files: List[str] = []  # Track uploaded file paths
 
-# Utility function to extract text from PDF, TXT, CSV, and Excel
-def extract_text(file: UploadFile):
-    file_type = file.filename.lower()
+# A thread with one page of its messages
+class ThreadPage(Thread):
+    next_cursor: Optional[int] = None  # Pass as after to read the next page; None on the last page
+
+# Bump when extraction output changes so text cached by older extractors is not reused
+EXTRACTOR_VERSION = f"2-pypdf2-{PyPDF2.__version__}-pandas-{pd.__version__}-{extraction.OCR_VERSION}"
+
+# Utility function to extract text from a saved upload (PDF, TXT, CSV, and Excel).
+# Results are cached by the hash taken while the upload was saved, so re-uploads skip extraction.
+async def extract_text(filename, path, digest):
+    file_type = filename.lower()
 
     try:
+        key = cache.extraction_key(digest, os.path.splitext(file_type)[1], EXTRACTOR_VERSION)
+        cached_text = await cache.extraction_cache.aget(key)
+        if cached_text is not None:
+            return cached_text
+
         if file_type.endswith(".pdf"):
-            return extract_text_from_pdf(file.file)
+            text = await extract_text_from_pdf(path)
         elif file_type.endswith(".txt"):
-            return extract_text_from_txt(file.file)
+            text = extract_text_from_txt(path)
         elif file_type.endswith(".csv"):
-            return extract_text_from_csv(file.file)
+            text = extract_text_from_csv(path)
         elif file_type.endswith((".xls", ".xlsx")):
-            return extract_text_from_excel(file.file)
+            text = await extract_text_from_excel(path)
         else:
-            raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.filename}")
+            raise HTTPException(status_code=400, detail=f"Unsupported file type: {filename}")
+
+        # Extractors return "" on failure; don't pin a failed extraction in the cache
+        if text:
+            await cache.extraction_cache.aset(key, text)
+        return text
+    except HTTPException:
+        raise
+    except TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Timed out extracting text from the file: {filename}")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing the file: {file.filename}. Details: {e}")
+        raise HTTPException(status_code=500, detail=f"Error processing the file: {filename}. Details: {e}")
 
-def extract_text_from_pdf(file):
-    pdf_text = ""
-    try:
-        pdf_reader = PyPDF2.PdfReader(file)
-        for page in pdf_reader.pages:
-            pdf_text += page.extract_text() or ""
-    except Exception as e:
-        print(f"Error reading the PDF file: {e}")
-    return pdf_text
+# Function to extract text from a PDF file, parsed in the extraction process pool
+# (large PDFs are split into page ranges that are parsed in parallel)
+async def extract_text_from_pdf(path):
+    return await extraction.aextract_pdf(path)
 
-def extract_text_from_txt(file):
+def extract_text_from_txt(path):
     try:
-        return file.read().decode("utf-8")
+        with open(path, encoding="utf-8") as file:
+            return file.read()
     except Exception as e:
         print(f"Error reading the TXT file: {e}")
         return ""
 
-def extract_text_from_csv(file):
-    csv_text = ""
+def extract_text_from_csv(path):
+    rows = []
     try:
-        content = file.read().decode("utf-8").splitlines()
-        reader = csv.reader(content)
-        for row in reader:
-            csv_text += " ".join(row) + "\n"
+        with open(path, encoding="utf-8", newline="") as file:
+            for row in csv.reader(file):
+                rows.append(" ".join(row) + "\n")
     except Exception as e:
         print(f"Error reading the CSV file: {e}")
-    return csv_text
+    return "".join(rows)
 
-def extract_text_from_excel(file):
-    try:
-        excel_data = pd.read_excel(file)
-        return excel_data.to_string(index=False)
-    except Exception as e:
-        print(f"Error reading the Excel file: {e}")
-        return ""
+# Function to extract text from an Excel file, parsed in the extraction process pool
+async def extract_text_from_excel(path):
+    return await extraction.aextract_excel(path)
 
-# Function to split text into chunks to handle token limits
-def split_text_into_chunks(text, chunk_size=1500):
-    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+# Function to split text into sentence-aware chunks that fit the model's token budget
+def split_text_into_chunks(text, max_tokens=None):
+    with telemetry.span("chunking", chars=len(text)) as attributes:
+        chunks = list(chunking.iter_chunks(text, max_tokens=max_tokens, model=AZURE_OPENAI_MODEL))
+        attributes["chunks"] = len(chunks)
+    return chunks
 
 # Get the endpoint and API key from environment variables
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
+AZURE_OPENAI_MODEL = os.getenv("AZURE_OPENAI_MODEL", "gpt-4o-mini")  # Model behind the deployment, used for token counting
 
-# Function to query Azure OpenAI API with a single chunk
-def query_pdf_content(chunk_text, query):
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": AZURE_OPENAI_API_KEY,
-    }
-    
-    data = {
+def build_chunk_request(chunk_text, query):
+    return {
         "messages": [
             {
                 "role": "user",
@@ -136,70 +161,145 @@ def query_pdf_content(chunk_text, query):
             }
         ]
     }
-    
-    try:
-        response = requests.post(AZURE_OPENAI_ENDPOINT, json=data, headers=headers)
-        response.raise_for_status()  # Raise an error for bad responses
-        return response.json()['choices'][0]['message']['content']
-    except Exception as e:
-        print(f"Error querying Azure OpenAI API: {e}")
-        return f"Error querying Azure OpenAI API: {e}"
-    
-# Function to query OpenAI API with multiple chunks and get a combined response
-def query_pdf_content_in_chunks(combined_text, query):
-    chunks = split_text_into_chunks(combined_text)
-    responses = []
 
-    for chunk in chunks:
-        response = query_pdf_content(chunk, query)
-        responses.append(response)
+# Bump when the chunk prompt changes so answers to the old prompt are not served from the cache
+PROMPT_VERSION = "1"
+
+# Function to query Azure OpenAI API with a single chunk. Rate limits and retries are
+# handled by llm.py and scheduler.py; raises llm.LLMError when the call fails for good.
+# Answers are cached by chunk, query, model and prompt version; use_cache=False skips
+# the lookup (the fresh answer still replaces the cached one).
+async def aquery_pdf_content(chunk_text, query, use_cache=True):
+    key = cache.response_key(chunk_text, query, AZURE_OPENAI_MODEL, PROMPT_VERSION)
+    if use_cache:
+        cached_answer = await cache.response_cache.aget(key)
+        if cached_answer is not None:
+            return cached_answer
+
+    headers = llm.azure_headers(AZURE_OPENAI_API_KEY)
+    data = build_chunk_request(chunk_text, query)
+
+    async def call():
+        answer = await llm.apost_chat_completion(AZURE_OPENAI_ENDPOINT, headers, data)
+        await cache.response_cache.aset(key, answer)
+        return answer
+
+    # The same prompt already in flight for another request is waited for, not sent again
+    return await coalesce.llm_calls.run(key, call)
+    
+# One uncached prompt to the model, used to compress conversation summaries; raises on failure
+async def acomplete(prompt):
+    data = {"messages": [{"role": "user", "content": prompt}]}
+    return await llm.apost_chat_completion(AZURE_OPENAI_ENDPOINT, llm.azure_headers(AZURE_OPENAI_API_KEY), data)
+
+# Function to query Azure OpenAI API with a list of chunks and get a combined response.
+# Chunks are queried concurrently (bounded by LLM_MAX_CONCURRENCY) and answers keep chunk order.
+async def query_chunks(chunks, query, use_cache=True):
+    # Chunks the model couldn't answer are left out
+    responses = await llm.gather_in_order(chunks, lambda chunk: aquery_pdf_content(chunk, query, use_cache), keep_errors=True)
+    responses = llm.successful(responses)
 
     return "\n".join(responses)
 
+# Function to query Azure OpenAI API with every chunk of the text
+async def query_pdf_content_in_chunks(combined_text, query, use_cache=True):
+    return await query_chunks(split_text_into_chunks(combined_text), query, use_cache)
 
+# Load the thread's stored BM25 index, building it from the thread content for older rows
+def load_search_index(db_thread):
+    if db_thread.search_index:
+        return retrieval.BM25Index.from_dict(db_thread.search_index)
+    return retrieval.build_index(split_text_into_chunks(db_thread.content or ""))
 
-@app.post("/threads/", response_model=Thread)
-async def create_thread(thread: Thread, db: Session = Depends(get_db)):
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await llm.aclose_clients()
+
+
+@app.on_event("shutdown")
+def close_extraction_pool():
+    extraction.shutdown_pool()
+
+
+@app.on_event("shutdown")
+async def close_database():
+    await async_engine.dispose()
+
+
+
+# Insert a thread and its initial messages; the caller commits
+async def add_thread(db, thread):
     db_thread = ThreadDB(
         id=thread.id,
         doctor_name=thread.doctor_name,
         user_id=thread.user_id,
         content=thread.content,
-        messages=[message.dict() for message in thread.messages],  # Convert Message objects to dicts
         uploaded_files=thread.uploaded_files  # Save uploaded files
     )
     db.add(db_thread)
-    db.commit()
-    db.refresh(db_thread)
+    await db.flush()  # Insert the thread before the messages that reference it
+    await aappend_messages(db, thread.id, [message.dict() for message in thread.messages])  # Convert Message objects to dicts
     return db_thread
 
-# API to read threads by user ID from the database
-@app.get("/threads/{user_id}", response_model=List[Thread])
-def read_user_threads(user_id: str, db: Session = Depends(get_db)):
-    threads = db.query(ThreadDB).filter(ThreadDB.user_id == user_id).all()
-    return [Thread(
-        id=thread.id,
-        doctor_name=thread.doctor_name,
-        user_id=thread.user_id,
-        content=thread.content,
-        messages=thread.messages,
-        uploaded_files=thread.uploaded_files
-    ) for thread in threads]
+@app.post("/threads/", response_model=Thread)
+async def create_thread(thread: Thread, db: AsyncSession = Depends(get_db)):
+    async with write_transaction(db):
+        await add_thread(db, thread)
+    return thread
+
+# API to read threads by user ID from the database. Paged by ?limit= and the X-Next-Cursor
+# header (pass it back as ?cursor=); content and messages are left out unless asked for
+# with ?fields=, and only the requested columns are loaded.
+@app.get("/threads/{user_id}")
+async def read_user_threads(user_id: str, request: Request, cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1), fields: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    fields = listing.parse_fields(fields, Thread)
+    limit = listing.parse_limit(limit)
+    after = listing.decode_cursor(cursor)
+
+    # Keyset pagination over the primary key, so a page costs the same wherever it starts
+    columns = [getattr(ThreadDB, field) for field in fields if field != "messages"]
+    query = select(*columns).where(ThreadDB.user_id == user_id)
+    if after is not None:
+        query = query.where(ThreadDB.id > after[1])
+    rows = (await db.execute(query.order_by(ThreadDB.id).limit(limit + 1))).all()
+    more = len(rows) > limit
+    threads = [row._asdict() for row in rows[:limit]]
+
+    if "messages" in fields:
+        # Load the messages of every thread in one query instead of one per thread
+        messages = {thread["id"]: [] for thread in threads}
+        rows = await db.scalars(select(MessageDB).where(MessageDB.thread_id.in_(list(messages))).order_by(MessageDB.thread_id, MessageDB.seq))
+        for row in rows:
+            messages[row.thread_id].append({"user_id": row.user_id, "content": row.content})
+        for thread in threads:
+            thread["messages"] = messages[thread["id"]]
+
+    next_cursor = listing.encode_cursor(user_id, threads[-1]["id"]) if more else None
+    return listing.json_response(request, [listing.project(thread, fields) for thread in threads], next_cursor)
     
     
 
-# API to read a specific thread
-@app.get("/threads/{user_id}/{thread_id}", response_model=Thread)
-def read_thread(user_id: str, thread_id: UUID, db: Session = Depends(get_db)):
-    thread = db.query(ThreadDB).filter(ThreadDB.user_id == user_id, ThreadDB.id == thread_id).first()
+# API to read a specific thread. Messages are paged by sequence number: pass limit to get
+# at most that many, and the returned next_cursor as after to get the next page.
+@app.get("/threads/{user_id}/{thread_id}", response_model=ThreadPage)
+async def read_thread(user_id: str, thread_id: UUID, after: Optional[int] = None, limit: Optional[int] = Query(None, ge=1), db: AsyncSession = Depends(get_db)):
+    thread = await db.scalar(select(ThreadDB).where(ThreadDB.user_id == user_id, ThreadDB.id == thread_id))
     if thread:
-        return Thread(
+        # Fetch one extra row to know whether another page follows
+        rows = await aread_messages(db, thread_id, after, limit + 1 if limit else None)
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1].seq
+        return ThreadPage(
             id=thread.id,
             doctor_name=thread.doctor_name,
             user_id=thread.user_id,
             content=thread.content,
-            messages=thread.messages,
-            uploaded_files=thread.uploaded_files
+            messages=[{"user_id": row.user_id, "content": row.content} for row in rows],
+            uploaded_files=thread.uploaded_files,
+            next_cursor=next_cursor
         )
     raise HTTPException(status_code=404, detail="Thread not found")
 
@@ -209,48 +309,69 @@ def read_thread(user_id: str, thread_id: UUID, db: Session = Depends(get_db)):
 # API to update a thread
 @app.put("/threads/{user_id}/{thread_id}", response_model=Thread)
 def update_thread(user_id: str, thread_id: UUID, updated_thread: Thread):
-    if user_id not in user_threads:
+    if not thread_store.has_user(user_id):
         raise HTTPException(status_code=404, detail="User threads not found")
 
-    for index, thread in enumerate(user_threads[user_id]):
-        if thread['id'] == thread_id:
-            user_threads[user_id][index] = updated_thread.dict()
-            return updated_thread
+    if thread_store.replace(user_id, thread_id, updated_thread.dict()):
+        return updated_thread
     raise HTTPException(status_code=404, detail="Thread not found")
 
 # API to delete a thread
 @app.delete("/threads/{user_id}/{thread_id}", response_model=Thread)
 def delete_thread(user_id: str, thread_id: UUID):
-    if user_id not in user_threads:
+    if not thread_store.has_user(user_id):
         raise HTTPException(status_code=404, detail="User threads not found")
 
-    for index, thread in enumerate(user_threads[user_id]):
-        if thread['id'] == thread_id:
-            return Thread(**user_threads[user_id].pop(index))
+    thread = thread_store.delete(user_id, thread_id)
+    if thread is not None:
+        return thread
     raise HTTPException(status_code=404, detail="Thread not found")
 
 
+# API to inspect cache hit/miss counters
+@app.get("/cache/stats")
+def read_cache_stats():
+    return cache.stats()
+
 # API to upload files and ask a query
 @app.post("/upload_and_query/")
 async def upload_and_query(
     files: List[UploadFile] = File(...), 
     query: str = Form(...),
-    user_id: str = Form(...)
+    user_id: str = Form(...),
+    top_k: Optional[int] = Form(None),
+    no_cache: bool = Form(False),  # Skip cached answers for this request
+    stream: bool = Form(False)  # Answer as a text/event-stream instead of one JSON body
 ):
-    combined_text = ""
+    uploads = []
     uploaded_file_names = []  # This should collect file paths
 
     for file in files:
-        # Save the file to the specified directory
-        file_location = os.path.join(UPLOAD_DIR, file.filename)
-        with open(file_location, "wb") as f:
-            f.write(await file.read())  # Save the file content
+        # Stream the file to the specified directory, saved under its content hash so another
+        # upload with the same name can't replace it before its text is extracted
+        file_location, digest, _ = await ingest.save_upload_by_digest(file, UPLOAD_DIR)
 
         uploaded_file_names.append(file_location)  # Store the saved file path
+        uploads.append((file.filename, file_location, digest))
 
-        # Extract text from the uploaded file
-        extracted_text = extract_text(file)
-        combined_text += extracted_text + "\n"
+    events = stream_upload_and_query(uploads, uploaded_file_names, query, user_id, top_k, not no_cache)
+    if stream:
+        return streaming.sse_response(events)
+    return await streaming.final_result(events)
+
+
+# Event stream behind upload_and_query: extraction progress, each chunk answer as it
+# completes, then a "done" event with the combined answer and the new thread's id.
+# Request-scoped sessions are closed before a streamed body runs, so it opens its own.
+async def stream_upload_and_query(uploads, uploaded_file_names, query, user_id, top_k, use_cache):
+    combined_text = ""
+    for position, (filename, file_location, digest) in enumerate(uploads):
+        yield "progress", {"stage": "extracting", "file": filename, "index": position, "files": len(uploads)}
+        try:
+            combined_text += await extract_text(filename, file_location, digest) + "\n"
+        except HTTPException as e:
+            yield "error", {"error": e.detail, "status_code": e.status_code}
+            return
 
     # Create a new thread with uploaded files
     thread_id = uuid4()  # Generate a new UUID for the thread
@@ -262,13 +383,26 @@ async def upload_and_query(
         uploaded_files=uploaded_file_names  # Make sure this line is correct
     )
 
-    # Create the thread
-    await create_thread(new_thread)  # Ensure this method properly adds the thread
+    # Index the chunks once and keep the index with the thread for follow-up questions,
+    # along with the hashes of the files it covers
+    index = retrieval.build_index(split_text_into_chunks(combined_text))
 
-    # Continue with querying and return response
-    answer = query_pdf_content_in_chunks(combined_text, query)
+    async with AsyncSessionLocal() as db, write_transaction(db):
+        # Create the thread
+        db_thread = await add_thread(db, new_thread)
+        db_thread.search_index = index.to_dict()
+        db_thread.file_digests = [digest for _, _, digest in uploads]
+
+    # Query only the chunks that are most relevant to the question
+    answers = []
+    async for event in streaming.stream_chunk_answers(index.top_chunks(query, top_k), lambda chunk: aquery_pdf_content(chunk, query, use_cache), answers):
+        yield event
+    answer = "\n".join(answers)
+
+    # Start the rolling summary that follow-up questions carry, after the answer is sent
+    context.update_summary_later(thread_id, "", query, answer, acomplete, lambda summary: save_summary(thread_id, summary), model=AZURE_OPENAI_MODEL)
     
-    return {
+    yield "done", {
         "query": query,
         "answer": answer,
         "uploaded_files": uploaded_file_names,  # This should show uploaded files
@@ -283,53 +417,117 @@ async def upload_and_continue_chat(
     thread_id: UUID = Form(...),
     files: List[UploadFile] = File(...),
     query: str = Form(...),
-    user_id: str = Form(...)
+    user_id: str = Form(...),
+    top_k: Optional[int] = Form(None),
+    no_cache: bool = Form(False),  # Skip cached answers for this request
+    stream: bool = Form(False),  # Answer as a text/event-stream instead of one JSON body
+    db: AsyncSession = Depends(get_db)
 ):
+    # Check the thread exists before any file is processed or answer streamed
+    thread = (await db.execute(select(ThreadDB.id, ThreadDB.file_digests).where(ThreadDB.user_id == user_id, ThreadDB.id == thread_id))).first()
+    if thread is None:
+        raise HTTPException(status_code=404, detail="Thread not found.")
+
     combined_text = ""
     uploaded_file_paths = []  # To store file paths
+    new_files = []  # (path, digest, text) of files the thread hasn't seen
+    seen_digests = set(thread.file_digests or [])
 
     # Extract text from the uploaded files and save them to a directory
     for file in files:
-        # Save the file to the specified directory
-        file_location = os.path.join(UPLOAD_DIR, file.filename)
-        with open(file_location, "wb") as f:
-            f.write(await file.read())  # Save the file content
+        # Stream the file to the specified directory, saved under its content hash so another
+        # upload with the same name can't replace it before its text is extracted
+        file_location, digest, _ = await ingest.save_upload_by_digest(file, UPLOAD_DIR)
 
         uploaded_file_paths.append(file_location)  # Store the saved file path
 
-        # Extract text from the uploaded file
-        extracted_text = extract_text(file)
+        # Files already in the thread's index are not extracted or indexed again
+        if digest in seen_digests:
+            continue
+        seen_digests.add(digest)
+
+        # Extract text from the saved file
+        extracted_text = await extract_text(file.filename, file_location, digest)
+        new_files.append((file_location, digest, extracted_text + "\n"))
         combined_text += extracted_text + "\n"
 
-    if not combined_text:
+    if new_files and not combined_text:
         return JSONResponse(content={"error": "None of the provided files contain extractable text."}, status_code=400)
 
-    # Fetch the thread and append the new message
-    if user_id in user_threads:
-        for thread in user_threads[user_id]:
-            if thread['id'] == thread_id:
-                # Append the query and file paths as a message from the user
-                thread['messages'].append({
-                    "user_id": user_id,
-                    "content": f"Query: {query}\nFiles: {uploaded_file_paths}"
-                })
-                break
-        else:
-            raise HTTPException(status_code=404, detail="Thread not found.")
-    else:
-        raise HTTPException(status_code=404, detail="User threads not found.")
-
-    # Query the content
-    answer = query_pdf_content_in_chunks(combined_text, query)
-
-    # Append assistant's response
-    thread['messages'].append({
-        "user_id": "assistant", 
-        "content": answer
-    })
-    
+    events = stream_continue_chat(thread_id, combined_text, new_files, uploaded_file_paths, query, user_id, top_k, not no_cache)
+    if stream:
+        return streaming.sse_response(events)
+    return await streaming.final_result(events)
+
+
+# Store the rolling summary of a thread's conversation (see context.update_summary_later)
+async def save_summary(thread_id, summary):
+    async with AsyncSessionLocal() as db, write_transaction(db):
+        await db.execute(update(ThreadDB).where(ThreadDB.id == thread_id).values(summary=summary))
+
+
+# Event stream behind upload_and_continue_chat: each chunk answer as it completes, then a
+# "done" event; the turn is saved to the thread once the answer is complete. Chunks are
+# picked from the earlier documents and the new ones and asked the question; their
+# answers are put in the context of the conversation so far. The new files are added to
+# the thread as it is when the turn is saved (re-read and locked in the write
+# transaction), so a turn running at the same time doesn't lose its files or its index.
+async def stream_continue_chat(thread_id, combined_text, new_files, uploaded_file_paths, query, user_id, top_k, use_cache):
+    scheduler.set_lane("interactive")  # Follow-up questions go ahead of bulk work for the rate limits
+    await context.wait_for_summary(thread_id)  # The previous turn's, if still being written
+    async with AsyncSessionLocal() as db:
+        db_thread = await db.scalar(select(ThreadDB).where(ThreadDB.user_id == user_id, ThreadDB.id == thread_id))
+        await db.commit()  # End the read transaction so the connection isn't held while the answer streams
+
+        # The query and file paths as a message from the user
+        messages = [{
+            "user_id": user_id,
+            "content": f"Query: {query}\nFiles: {uploaded_file_paths}"
+        }]
+
+        # Reuse the thread's index and only index the newly uploaded files
+        index = load_search_index(db_thread)
+        recent_from = len(index)
+        index.add(split_text_into_chunks(combined_text))
+
+        summary = db_thread.summary or ""
+
+        # Query only the chunks that are most relevant to the question
+        answers = []
+        async for event in streaming.stream_chunk_answers(index.top_chunks(query, top_k, recent_from), lambda chunk: aquery_pdf_content(chunk, query, use_cache), answers):
+            yield event
+        answer = await context.answer_in_context(query, summary, answers, acomplete)
+
+        # Append assistant's response
+        messages.append({
+            "user_id": "assistant", 
+            "content": answer
+        })
+
+        # Only the new turn is written; earlier messages are left untouched
+        async with write_transaction(db):
+            await aappend_messages(db, thread_id, messages)
+
+            db_thread = await db.scalar(select(ThreadDB).where(ThreadDB.id == thread_id)
+                                        .with_for_update().execution_options(populate_existing=True))
+            known_digests = set(db_thread.file_digests or [])
+            added = [new_file for new_file in new_files if new_file[1] not in known_digests]
+            if added:
+                added_text = "".join(text for _, _, text in added)
+                saved_index = load_search_index(db_thread)
+                saved_index.add(split_text_into_chunks(added_text))
+
+                # JSON columns are saved on assignment, not on in-place changes
+                db_thread.search_index = saved_index.to_dict()
+                db_thread.content = (db_thread.content or "") + added_text
+                db_thread.uploaded_files = (db_thread.uploaded_files or []) + [path for path, _, _ in added]
+                db_thread.file_digests = (db_thread.file_digests or []) + [digest for _, digest, _ in added]
+
+    # Fold the turn into the summary after the answer is sent
+    context.update_summary_later(thread_id, summary, query, answer, acomplete, lambda summary: save_summary(thread_id, summary), model=AZURE_OPENAI_MODEL)
+
     # Return query, answer, uploaded files, thread_id, and user_id
-    return {
+    yield "done", {
         "query": query,
         "answer": answer,
         "uploaded_files": uploaded_file_paths,
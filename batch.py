@@ -0,0 +1,558 @@
+# batch.py
+#
+# Offline batch mode for back-processing archived case files: every chunk prompt of a set
+# of documents is written to JSONL batch files, submitted to a batch backend, polled until
+# done, and the answers are put back together per document. All progress is kept in a
+# SQLite file in the run's directory, so a run that stopped (or crashed) picks up where it
+# was by running the same command again.
+#
+#     python batch.py run --run nightly --query "Summarize the findings" archive/
+#     python batch.py status --run nightly
+#     python batch.py export --run nightly --output answers.jsonl
+
+import argparse
+import concurrent.futures
+import csv
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+import pandas as pd
+import PyPDF2
+
+import cache
+import chunking
+import extraction
+import llm
+import scheduler
+
+# Directory holding one subdirectory per run: its state, batch files and answers
+BATCH_DIR = os.getenv("BATCH_DIR", "./batch_runs")
+
+# Requests and bytes per batch file; the OpenAI batch API takes up to 50,000 requests and 200 MB a file
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "50000"))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(190 * 1024 * 1024)))
+
+# Seconds between status checks of the submitted batches
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "60"))
+
+# Batches a chunk prompt is sent in before its failure is final
+BATCH_MAX_ATTEMPTS = int(os.getenv("BATCH_MAX_ATTEMPTS", "3"))
+
+# Files and batches endpoints of the OpenAI style batch API, for the "openai" backend
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+
+SUPPORTED_EXTENSIONS = (".pdf", ".txt", ".csv", ".xls", ".xlsx")
+
+# Same extractor and prompt versions as thread.py and AzureChat.py, so extracted text and
+# chunk answers are shared with the apps through the caches
+EXTRACTOR_VERSION = f"2-pypdf2-{PyPDF2.__version__}-pandas-{pd.__version__}-{extraction.OCR_VERSION}"
+PROMPT_VERSION = "1"
+
+# Batch statuses after which a batch changes no more
+FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def build_chunk_request(chunk_text, query, model):
+    return {
+        "model": model,
+        "messages": [
+            {
+                "role": "user",
+                "content": f"Analyze the following document: {chunk_text}. Based on this text, answer the question: {query}."
+            }
+        ]
+    }
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Text of one document; runs in the extraction worker processes
+def extract_document(path):
+    file_type = path.lower()
+    if file_type.endswith(".pdf"):
+        return extraction.read_pdf_text(path)
+    if file_type.endswith((".xls", ".xlsx")):
+        return extraction.read_excel(path)
+    if file_type.endswith(".csv"):
+        with open(path, encoding="utf-8", newline="") as file:
+            return "".join(" ".join(row) + "\n" for row in csv.reader(file))
+    with open(path, encoding="utf-8") as file:
+        return file.read()
+
+
+# Paths of the supported documents in paths, directories searched recursively
+def iter_documents(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                        yield os.path.abspath(os.path.join(directory, name))
+        elif path.lower().endswith(SUPPORTED_EXTENSIONS):
+            yield os.path.abspath(path)
+        else:
+            print(f"Skipping {path}: unsupported file type")
+
+
+# The answer in a line of a batch output file, as (content, None), or (None, error)
+def parse_result(line):
+    response = line.get("response") or {}
+    if line.get("error") or response.get("status_code") != 200:
+        error = line.get("error") or {}
+        return None, error.get("message") or f"status {response.get('status_code')}"
+    try:
+        return response["body"]["choices"][0]["message"]["content"], None
+    except (KeyError, IndexError, TypeError):
+        return None, "malformed response"
+
+
+# Stand-in for a batch API: a batch's requests are sent to a chat completions endpoint
+# (the real one, or benchmarks/stub_llm.py in tests) from a background thread, through the
+# scheduler's bulk lane, and answers are appended to an output file in the OpenAI batch
+# output format. A batch interrupted by a crash carries on with the requests it has no
+# answer for when its status is next asked for.
+class LocalBatchBackend:
+    def __init__(self, directory, url=None, headers=None, workers=None):
+        self.directory = directory
+        self.url = url or llm.OPENAI_CHAT_URL
+        self.headers = headers or llm.openai_headers(OPENAI_API_KEY)
+        self.workers = workers or llm.LLM_MAX_CONCURRENCY
+        self._threads = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, batch_id, suffix):
+        return os.path.join(self.directory, f"{batch_id}.{suffix}")
+
+    def find(self, name):
+        return name if os.path.exists(self._path(name, "status")) else None
+
+    def submit(self, path, name):
+        shutil.copyfile(path, self._path(name, "input.jsonl"))
+        self._set_status(name, "in_progress")
+        self._start(name)
+        return name
+
+    def status(self, batch_id):
+        with open(self._path(batch_id, "status")) as file:
+            status = file.read().strip()
+        if status == "in_progress" and not self._threads.get(batch_id, threading.Thread()).is_alive():
+            self._start(batch_id)  # Interrupted by a crash
+        return status
+
+    def results(self, batch_id):
+        with open(self._path(batch_id, "output.jsonl"), encoding="utf-8") as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Blank, or cut short by a crash; that request is sent again
+
+    def _set_status(self, batch_id, status):
+        with open(self._path(batch_id, "status.tmp"), "w") as file:
+            file.write(status)
+        os.replace(self._path(batch_id, "status.tmp"), self._path(batch_id, "status"))
+
+    def _start(self, batch_id):
+        thread = threading.Thread(target=self._process, args=(batch_id,), daemon=True)
+        self._threads[batch_id] = thread
+        thread.start()
+
+    def _answer(self, request):
+        try:
+            with scheduler.lane("bulk"):
+                content = llm.post_chat_completion(self.url, self.headers, request["body"])
+        except llm.LLMError as e:
+            return {"id": uuid.uuid4().hex, "custom_id": request["custom_id"], "response": None,
+                    "error": {"code": "llm_error", "message": str(e)}}
+        body = {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]}
+        return {"id": uuid.uuid4().hex, "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": body}, "error": None}
+
+    def _process(self, batch_id):
+        output_path = self._path(batch_id, "output.jsonl")
+        answered = set()
+        if os.path.exists(output_path):
+            answered = {line["custom_id"] for line in self.results(batch_id)}
+
+        with open(self._path(batch_id, "input.jsonl"), encoding="utf-8") as input_file, \
+                open(output_path, "a", encoding="utf-8") as output_file, \
+                concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            output_file.write("\n")  # Ends a line cut short by a crash
+            requests = (json.loads(line) for line in input_file if line.strip())
+            pending = set()
+            for request in requests:
+                if request["custom_id"] in answered:
+                    continue
+                pending.add(executor.submit(self._answer, request))
+                if len(pending) >= self.workers * 2:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    self._write(output_file, done)
+            self._write(output_file, pending)
+        self._set_status(batch_id, "completed")
+
+    @staticmethod
+    def _write(output_file, futures):
+        for future in concurrent.futures.as_completed(futures):
+            output_file.write(json.dumps(future.result()) + "\n")
+        output_file.flush()
+
+
+# The OpenAI batch API: the batch file is uploaded to /files, a batch created for it at
+# /batches (named in its metadata, so a submission cut short by a crash is found again
+# rather than paid for twice), and the output and error files downloaded when it's done.
+class OpenAIBatchBackend:
+    def __init__(self, base_url=None, api_key=None, completion_window="24h"):
+        self.base_url = (base_url or OPENAI_API_BASE).rstrip("/")
+        self.headers = {"Authorization": f"Bearer {api_key or OPENAI_API_KEY}"}
+        self.completion_window = completion_window
+
+    def _request(self, method, path, **kwargs):
+        response = llm.get_sync_client().request(method, self.base_url + path, headers=self.headers, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def find(self, name):
+        after = None
+        while True:
+            page = self._request("GET", "/batches", params={"limit": 100, **({"after": after} if after else {})})
+            for batch in page["data"]:
+                if (batch.get("metadata") or {}).get("name") == name and batch["status"] not in ("failed", "cancelled"):
+                    return batch["id"]
+            if not page.get("has_more") or not page["data"]:
+                return None
+            after = page["data"][-1]["id"]
+
+    def submit(self, path, name):
+        with open(path, "rb") as file:
+            uploaded = self._request("POST", "/files", data={"purpose": "batch"},
+                                     files={"file": (os.path.basename(path), file, "application/jsonl")})
+        batch = self._request("POST", "/batches", json={"input_file_id": uploaded["id"], "endpoint": "/v1/chat/completions",
+                                                         "completion_window": self.completion_window, "metadata": {"name": name}})
+        return batch["id"]
+
+    def status(self, batch_id):
+        return self._request("GET", f"/batches/{batch_id}")["status"]
+
+    def results(self, batch_id):
+        batch = self._request("GET", f"/batches/{batch_id}")
+        for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+            if not file_id:
+                continue
+            with llm.get_sync_client().stream("GET", f"{self.base_url}/files/{file_id}/content", headers=self.headers) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line.strip():
+                        yield json.loads(line)
+
+
+# One batch run: the documents, their chunk prompts and the batches they were sent in, in
+# a SQLite file. Every step only looks at what the steps before left in the database, so
+# they can be repeated after a crash, and nothing but the current batch file's prompts is
+# held in memory, whatever the number of documents.
+class BatchRun:
+    def __init__(self, name, backend=None, directory=None):
+        self.directory = os.path.join(directory or BATCH_DIR, name)
+        os.makedirs(self.directory, exist_ok=True)
+        self.backend = backend or LocalBatchBackend(os.path.join(self.directory, "local"))
+
+        self._connection = sqlite3.connect(os.path.join(self.directory, "state.db"), timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, digest TEXT, "
+            "status TEXT NOT NULL, chunks INTEGER, error TEXT);"
+            "CREATE TABLE IF NOT EXISTS prompts (custom_id TEXT PRIMARY KEY, document INTEGER NOT NULL, position INTEGER NOT NULL, "
+            "cache_key TEXT NOT NULL, body TEXT, batch TEXT, attempts INTEGER NOT NULL DEFAULT 0, answer TEXT, error TEXT);"
+            "CREATE INDEX IF NOT EXISTS ix_prompts_document ON prompts (document, position);"
+            "CREATE INDEX IF NOT EXISTS ix_prompts_batch ON prompts (batch);"
+            "CREATE TABLE IF NOT EXISTS batches (name TEXT PRIMARY KEY, file TEXT NOT NULL, remote_id TEXT, status TEXT NOT NULL, "
+            "requests INTEGER NOT NULL, updated_at REAL NOT NULL);"
+        )
+        self._connection.commit()
+
+    def _setting(self, name):
+        row = self._connection.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return row and row["value"]
+
+    # The question and model are fixed when the run starts; resuming with others is refused
+    def configure(self, query, model):
+        for name, value in (("query", query), ("model", model)):
+            current = self._setting(name)
+            if current is None and value is not None:
+                self._connection.execute("INSERT INTO settings (name, value) VALUES (?, ?)", (name, value))
+            elif current is not None and value is not None and current != value:
+                raise ValueError(f"Run {self.directory} was started with {name} {current!r}, not {value!r}")
+        self._connection.commit()
+
+    def add_documents(self, paths):
+        added = 0
+        for path in iter_documents(paths):
+            added += self._connection.execute(
+                "INSERT OR IGNORE INTO documents (path, status) VALUES (?, 'pending')", (path,)).rowcount
+        self._connection.commit()
+        return added
+
+    # Extract and chunk the pending documents (in the extraction worker processes) and store
+    # a prompt for every chunk. Chunks whose answer is already in the response cache are
+    # answered from it and not sent.
+    def prepare(self):
+        query, model = self._setting("query"), self._setting("model")
+        pending = self._connection.execute("SELECT id, path FROM documents WHERE status = 'pending' ORDER BY id").fetchall()
+        window = max(1, extraction.EXTRACTION_WORKERS) * 4
+        for start in range(0, len(pending), window):
+            documents = pending[start:start + window]
+            if extraction.EXTRACTION_WORKERS > 0:
+                futures = [extraction.get_pool().submit(extract_document, document["path"]) for document in documents]
+            else:
+                futures = [None] * len(documents)
+            for document, future in zip(documents, futures):
+                try:
+                    digest = file_digest(document["path"])
+                    text = self._extract(document["path"], digest, future)
+                except Exception as e:
+                    print(f"Error extracting {document['path']}: {e}")
+                    self._fail_document(document["id"], f"extraction failed: {e}")
+                    continue
+                if not text.strip():
+                    self._fail_document(document["id"], "no extractable text")
+                    continue
+                self._add_prompts(document["id"], digest, text, query, model)
+        return len(pending)
+
+    def _extract(self, path, digest, future):
+        key = cache.extraction_key(digest, os.path.splitext(path.lower())[1], EXTRACTOR_VERSION)
+        text = cache.extraction_cache.get(key)
+        if text is None:
+            text = extract_document(path) if future is None else future.result(timeout=extraction.EXTRACTION_TIMEOUT)
+            if text:
+                cache.extraction_cache.set(key, text)
+        elif future is not None:
+            future.cancel()
+        return text
+
+    def _fail_document(self, document_id, error):
+        self._connection.execute("UPDATE documents SET status = 'failed', error = ? WHERE id = ?", (error, document_id))
+        self._connection.commit()
+
+    def _add_prompts(self, document_id, digest, text, query, model):
+        rows = []
+        for position, chunk in enumerate(chunking.iter_chunks(text, model=model)):
+            key = cache.response_key(chunk, query, model, PROMPT_VERSION)
+            answer = cache.response_cache.get(key)
+            body = None if answer is not None else json.dumps(build_chunk_request(chunk, query, model))
+            rows.append((f"{document_id}-{position}", document_id, position, key, body, answer))
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO prompts (custom_id, document, position, cache_key, body, answer) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self._connection.execute("UPDATE documents SET status = 'prompted', digest = ?, chunks = ? WHERE id = ?",
+                                 (digest, len(rows), document_id))
+        self._connection.commit()
+
+    # Write the prompts that are in no batch yet to batch files of at most BATCH_MAX_REQUESTS
+    # requests and BATCH_MAX_BYTES bytes. A file is complete on disk before its batch is
+    # recorded, so a crash leaves at worst an unused file.
+    def write_batches(self):
+        written = []
+        after = ""
+        while True:
+            name = f"batch-{uuid.uuid4().hex[:12]}"
+            path = os.path.join(self.directory, f"{name}.jsonl")
+            custom_ids, size = [], 0
+            with open(path + ".tmp", "w", encoding="utf-8") as file:
+                while len(custom_ids) < BATCH_MAX_REQUESTS and size < BATCH_MAX_BYTES:
+                    rows = self._connection.execute(
+                        "SELECT custom_id, body FROM prompts WHERE batch IS NULL AND answer IS NULL AND error IS NULL "
+                        "AND custom_id > ? ORDER BY custom_id LIMIT 500", (after,)).fetchall()
+                    if not rows:
+                        break
+                    for row in rows:
+                        line = json.dumps({"custom_id": row["custom_id"], "method": "POST", "url": "/v1/chat/completions",
+                                           "body": json.loads(row["body"])}) + "\n"
+                        if custom_ids and (len(custom_ids) >= BATCH_MAX_REQUESTS or size + len(line) > BATCH_MAX_BYTES):
+                            break
+                        file.write(line)
+                        custom_ids.append(row["custom_id"])
+                        size += len(line)
+                        after = row["custom_id"]
+                    else:
+                        continue
+                    break
+            if not custom_ids:
+                os.remove(path + ".tmp")
+                return written
+            os.replace(path + ".tmp", path)
+            self._connection.execute("INSERT INTO batches (name, file, status, requests, updated_at) VALUES (?, ?, 'written', ?, ?)",
+                                     (name, path, len(custom_ids), time.time()))
+            self._connection.executemany("UPDATE prompts SET batch = ? WHERE custom_id = ?", [(name, custom_id) for custom_id in custom_ids])
+            self._connection.commit()
+            written.append(name)
+            print(f"Wrote {name} with {len(custom_ids)} chunk prompts ({size / 1e6:.1f} MB)")
+
+    def _set_batch(self, name, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        self._connection.execute(f"UPDATE batches SET {assignments} WHERE name = ?", (*fields.values(), name))
+        self._connection.commit()
+
+    def submit(self):
+        for batch in self._connection.execute("SELECT name, file FROM batches WHERE status = 'written'").fetchall():
+            remote_id = self.backend.find(batch["name"]) or self.backend.submit(batch["file"], batch["name"])
+            self._set_batch(batch["name"], status="submitted", remote_id=remote_id)
+            print(f"Submitted {batch['name']} as {remote_id}")
+
+    # Check the submitted batches once and collect the ones that finished. Returns the
+    # number still running.
+    def poll(self):
+        running = 0
+        for batch in self._connection.execute("SELECT name, remote_id FROM batches WHERE status = 'submitted'").fetchall():
+            status = self.backend.status(batch["remote_id"])
+            if status in FINISHED_STATUSES:
+                self.collect(batch["name"], batch["remote_id"], status)
+            else:
+                running += 1
+        return running
+
+    # Store the answers of a finished batch (in the run and in the response cache). Prompts
+    # that failed or got no answer, as in an expired batch, go in a later batch until they
+    # have been tried BATCH_MAX_ATTEMPTS times.
+    def collect(self, name, remote_id, status):
+        answered = failed = 0
+        for line in self.backend.results(remote_id):
+            row = self._connection.execute("SELECT cache_key, attempts FROM prompts WHERE custom_id = ? AND batch = ?",
+                                           (line.get("custom_id"), name)).fetchone()
+            if row is None:
+                continue  # Not from this run, or already collected
+            content, error = parse_result(line)
+            if content is not None:
+                cache.response_cache.set(row["cache_key"], content)
+                self._connection.execute("UPDATE prompts SET answer = ?, body = NULL WHERE custom_id = ?", (content, line["custom_id"]))
+                answered += 1
+            else:
+                self._retry_or_fail(line["custom_id"], row["attempts"], error)
+                failed += 1
+        unanswered = self._connection.execute(
+            "SELECT custom_id, attempts FROM prompts WHERE batch = ? AND answer IS NULL AND error IS NULL", (name,)).fetchall()
+        for row in unanswered:
+            self._retry_or_fail(row["custom_id"], row["attempts"], f"no result in a {status} batch")
+        self._connection.commit()
+        self._set_batch(name, status="collected")
+        print(f"Collected {name} ({status}): {answered} answered, {failed + len(unanswered)} to retry or failed")
+
+    def _retry_or_fail(self, custom_id, attempts, error):
+        if attempts + 1 < BATCH_MAX_ATTEMPTS:
+            self._connection.execute("UPDATE prompts SET batch = NULL, attempts = ? WHERE custom_id = ?", (attempts + 1, custom_id))
+        else:
+            self._connection.execute("UPDATE prompts SET error = ?, attempts = ?, body = NULL WHERE custom_id = ?",
+                                     (error, attempts + 1, custom_id))
+
+    # Mark the documents whose every prompt is answered, or failed for good, done
+    def assemble(self):
+        finished = self._connection.execute(
+            "UPDATE documents SET status = 'done' WHERE status = 'prompted' AND NOT EXISTS "
+            "(SELECT 1 FROM prompts WHERE prompts.document = documents.id AND answer IS NULL AND error IS NULL)").rowcount
+        self._connection.commit()
+        return finished
+
+    # Every step until all documents are done, waiting poll_interval seconds between checks
+    # of the submitted batches
+    def run(self, poll_interval=None):
+        poll_interval = BATCH_POLL_INTERVAL if poll_interval is None else poll_interval
+        prepared = self.prepare()
+        if prepared:
+            print(f"Prepared {prepared} documents")
+        while True:
+            self.write_batches()
+            self.submit()
+            running = self.poll()
+            self.assemble()
+            if not running and not self._connection.execute(
+                    "SELECT 1 FROM prompts WHERE batch IS NULL AND answer IS NULL AND error IS NULL LIMIT 1").fetchone():
+                return self.status()
+            if running:
+                time.sleep(poll_interval)
+
+    def status(self):
+        documents = dict(self._connection.execute("SELECT status, COUNT(*) FROM documents GROUP BY status").fetchall())
+        batches = dict(self._connection.execute("SELECT status, COUNT(*) FROM batches GROUP BY status").fetchall())
+        prompts = self._connection.execute(
+            "SELECT COUNT(*), COUNT(answer), COUNT(error) FROM prompts").fetchone()
+        return {"query": self._setting("query"), "model": self._setting("model"), "documents": documents, "batches": batches,
+                "prompts": {"total": prompts[0], "answered": prompts[1], "failed": prompts[2]}}
+
+    # The answers of the finished documents, in the shape the thread endpoints answer with,
+    # chunk answers joined in document order like query_chunks does
+    def iter_answers(self):
+        query = self._setting("query")
+        documents = self._connection.execute("SELECT id, path, digest, chunks, status, error FROM documents WHERE status IN ('done', 'failed') ORDER BY id")
+        for document in documents:
+            answers = [row["answer"] for row in self._connection.execute(
+                "SELECT answer FROM prompts WHERE document = ? AND answer IS NOT NULL ORDER BY position", (document["id"],))]
+            record = {"query": query, "answer": "\n".join(answers), "uploaded_files": [document["path"]], "digest": document["digest"],
+                      "chunks": document["chunks"] or 0, "failed_chunks": (document["chunks"] or 0) - len(answers)}
+            if document["status"] == "failed":
+                record["error"] = document["error"]
+            yield record
+
+    def export(self, path):
+        count = 0
+        with open(path + ".tmp", "w", encoding="utf-8") as file:
+            for record in self.iter_answers():
+                file.write(json.dumps(record) + "\n")
+                count += 1
+        os.replace(path + ".tmp", path)
+        return count
+
+
+def make_backend(name, directory):
+    if name == "openai":
+        return OpenAIBatchBackend()
+    return LocalBatchBackend(os.path.join(directory, "local"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a question over many documents with batched chunk prompts")
+    parser.add_argument("command", choices=["run", "status", "export"])
+    parser.add_argument("paths", nargs="*", help="Documents, or directories of them, to add to the run")
+    parser.add_argument("--run", required=True, help="Name of the run; running it again resumes it")
+    parser.add_argument("--query", help="Question asked of every document (fixed when the run starts)")
+    parser.add_argument("--model", default=chunking.DEFAULT_MODEL)
+    parser.add_argument("--backend", choices=["local", "openai"], default="local")
+    parser.add_argument("--directory", default=BATCH_DIR)
+    parser.add_argument("--poll-interval", type=float, default=None)
+    parser.add_argument("--output", help="Answers file (default answers.jsonl in the run's directory)")
+    args = parser.parse_intermixed_args()
+
+    run_directory = os.path.join(args.directory, args.run)
+    batch_run = BatchRun(args.run, make_backend(args.backend, run_directory), args.directory)
+    if args.command == "run":
+        batch_run.configure(args.query, args.model)
+        if batch_run._setting("query") is None:
+            parser.error("--query is needed to start a run")
+        added = batch_run.add_documents(args.paths)
+        print(f"Added {added} documents")
+        try:
+            print(json.dumps(batch_run.run(args.poll_interval), indent=2))
+        finally:
+            extraction.shutdown_pool()
+    if args.command in ("run", "export"):
+        output = args.output or os.path.join(run_directory, "answers.jsonl")
+        print(f"Wrote {batch_run.export(output)} answers to {output}")
+    if args.command == "status":
+        print(json.dumps(batch_run.status(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
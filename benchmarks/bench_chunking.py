@@ -0,0 +1,58 @@
+# benchmarks/bench_chunking.py
+#
+# Compares the old fixed 1500-character splitter with the token-budgeted,
+# sentence-aware chunker on the bundled PDFs. Every chunk is one LLM round
+# trip in the report pipeline, so chunk count is also the call count.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_chunking --max-tokens 1500 --overlap 100
+
+import argparse
+import time
+
+import PyPDF2
+
+import chunking
+
+PDFS = ["mri.pdf", "Toxicology.pdf", "autopsyreportsample.pdf"]
+
+
+def fixed_char_chunks(text, chunk_size=1500):
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+
+def extract_pages(path):
+    return [page.extract_text() or "" for page in PyPDF2.PdfReader(path).pages]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare chunkers on the bundled PDFs")
+    parser.add_argument("--max-tokens", type=int, default=chunking.CHUNK_MAX_TOKENS)
+    parser.add_argument("--overlap", type=int, default=chunking.CHUNK_OVERLAP_TOKENS)
+    parser.add_argument("--model", default=chunking.DEFAULT_MODEL)
+    args = parser.parse_args()
+
+    count = chunking.get_token_counter(args.model)
+    print(f"budget {args.max_tokens} tokens, overlap {args.overlap} tokens, model {args.model}")
+    print(f"{'document':<26} {'tokens':>7} {'old chunks':>11} {'new chunks':>11} {'avg tok/new':>12} {'new ms':>8}")
+
+    totals = [0, 0]
+    for path in PDFS:
+        pages = extract_pages(path)
+        text = "".join(pages)
+
+        old = fixed_char_chunks(text)
+        start = time.perf_counter()
+        new = list(chunking.iter_chunks(pages, max_tokens=args.max_tokens, overlap_tokens=args.overlap, model=args.model))
+        elapsed = (time.perf_counter() - start) * 1000
+
+        average = sum(count(chunk) for chunk in new) / len(new) if new else 0
+        totals[0] += len(old)
+        totals[1] += len(new)
+        print(f"{path:<26} {count(text):>7} {len(old):>11} {len(new):>11} {average:>12.0f} {elapsed:>8.1f}")
+
+    print(f"{'LLM round trips':<26} {'':>7} {totals[0]:>11} {totals[1]:>11}")
+
+
+if __name__ == "__main__":
+    main()
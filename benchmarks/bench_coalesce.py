@@ -0,0 +1,69 @@
+# benchmarks/bench_coalesce.py
+#
+# Identical analyses requested at the same moment (a shared document opened by
+# several doctors), with and without the single-flight coalescing in
+# coalesce.py. Sends --clients identical /upload_and_query/ requests to main.py
+# at once, half of them streamed, against the stub LLM endpoint with the
+# response cache turned off, and reports the chat model calls made and the
+# slowest answer.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_coalesce --clients 8 --file "Medical History Report.pdf"
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.stub_llm import StubLLMServer
+
+
+async def send(app, data, args, round_number):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def one(position):
+            started = time.perf_counter()
+            response = await client.post("/upload_and_query/", files=[("files", (os.path.basename(args.file), data))],
+                                         data={"query": f"findings, round {round_number}", "user_id": f"user-{position}",
+                                               "stream": str(position % 2 == 1).lower(), "no_cache": "true"})
+            response.raise_for_status()
+            return time.perf_counter() - started
+
+        return await asyncio.gather(*(one(position) for position in range(args.clients)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure coalescing of identical concurrent analyses")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--file", default="Medical History Report.pdf")
+    parser.add_argument("--latency", type=float, default=0.2, help="Stub response time (seconds)")
+    args = parser.parse_args()
+
+    stub = StubLLMServer(latency=args.latency, token_latency=0.005).start()
+    os.environ.update(OPENAI_CHAT_URL=stub.url, CACHE_DB_PATH=os.path.join(tempfile.mkdtemp(), "cache.db"), TRACE_SAMPLE_RATE="0")
+    import coalesce
+    import main as app_module
+
+    with open(args.file, "rb") as file:
+        data = file.read()
+
+    print(f"{args.clients} identical requests at once, {args.file}\n")
+    print(f"{'mode':<14} {'LLM calls':>10} {'slowest (s)':>12}")
+    find = coalesce.SingleFlight._find
+    try:
+        for round_number, (name, coalescing) in enumerate([("separate", False), ("coalesced", True)]):
+            coalesce.SingleFlight._find = find if coalescing else (lambda self, key: None)
+            before = stub.request_count
+            timings = asyncio.run(send(app_module.app, data, args, round_number))
+            print(f"{name:<14} {stub.request_count - before:>10} {max(timings):>12.2f}")
+    finally:
+        coalesce.SingleFlight._find = find
+        stub.stop()
+        app_module.extraction.shutdown_pool()
+
+
+if __name__ == "__main__":
+    main()
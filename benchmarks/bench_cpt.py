@@ -0,0 +1,106 @@
+# benchmarks/bench_cpt.py
+#
+# Throughput of the one-pass CPT matcher in cpt.py, in MB of extracted text
+# per second. The bundled PDFs name no CPT procedures, so their text is repeated
+# up to the requested size with a sentence naming a procedure (a label from the
+# code list, abbreviations spelled out) after every --every lines; the labels
+# found among those planted are reported as recall. For comparison it also times
+# the per-label approach: one regular expression per label, each scanning the
+# whole text.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_cpt --megabytes 1 8 --baseline-megabytes 1
+
+import argparse
+import bisect
+import random
+import re
+import time
+
+import cpt
+import extraction
+
+PDFS = ["autopsyreportsample.pdf", "Toxicology.pdf", "mri.pdf", "Medical History Report.pdf", "Untitled document (4).pdf"]
+
+SENTENCE = "The patient underwent {} on admission."
+
+
+def per_label_patterns(matcher):
+    patterns = []
+    for terms in matcher.label_terms:
+        gap = r"\w*(?:\W+\w+){0,%d}?\W+" % cpt.CPT_WINDOW_SLACK
+        patterns.append(re.compile(r"\b" + gap.join(re.escape(term) for term in terms), re.IGNORECASE))
+    return patterns
+
+
+# The report text repeated to megabytes, with a procedure sentence after every `every`
+# lines. Returns the text and the (start, end, label position) of each planted label.
+def planted_text(reports, matcher, megabytes, every, rng):
+    lines = reports.splitlines()
+    parts, planted, size = [], [], 0
+    while size < megabytes * 1e6:
+        for number, line in enumerate(lines, 1):
+            parts.append(line)
+            size += len(line) + 1
+            if number % every == 0:
+                position = rng.randrange(len(matcher.labels))
+                words = [cpt.ABBREVIATIONS.get(word.lower(), word) for word in cpt.WORD_PATTERN.findall(matcher.labels[position])]
+                sentence = SENTENCE.format(" ".join(words).lower())
+                start = size + len("The patient underwent ")
+                planted.append((start, start + len(" ".join(words)), position))
+                parts.append(sentence)
+                size += len(sentence) + 1
+    return "\n".join(parts), planted
+
+
+# Planted labels that came back as a label match overlapping their sentence
+def recall(matches, planted, matcher):
+    found = {}
+    for match in matches:
+        if match["kind"] == "label":
+            found.setdefault(match["start"], []).append(match)
+    starts = sorted(found)
+    hits = 0
+    for start, end, position in planted:
+        index = bisect.bisect_left(starts, start)
+        nearby = starts[max(0, index - 1):index + 2]
+        hits += any(match["label"] == matcher.labels[position] and match["start"] < end and match["end"] > start
+                    for key in nearby for match in found[key])
+    return hits / len(planted) if planted else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure CPT matching throughput")
+    parser.add_argument("--megabytes", type=float, nargs="+", default=[1, 8])
+    parser.add_argument("--baseline-megabytes", type=float, default=1, help="Text size for the per-label regex scan")
+    parser.add_argument("--every", type=int, default=10, help="Report lines between planted procedure sentences")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    matcher = cpt.load_matcher(cpt.CPT_CODES_PATH)
+    print(f"compiled {len(matcher)} codes into {len(matcher.labels)} labels and {len(matcher.postings)} terms "
+          f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    reports = "\n".join(extraction.read_pdf_pages(path) for path in PDFS)
+
+    print(f"{'method':<16} {'MB':>6} {'seconds':>8} {'MB/s':>7} {'planted':>8} {'matches':>8} {'recall':>7}")
+    for megabytes in args.megabytes:
+        text, planted = planted_text(reports, matcher, megabytes, args.every, random.Random(0))
+        size = len(text.encode("utf-8")) / 1e6
+        start = time.perf_counter()
+        matches = matcher.match(text)
+        seconds = time.perf_counter() - start
+        print(f"{'one pass':<16} {size:>6.1f} {seconds:>8.3f} {size / seconds:>7.1f} {len(planted):>8} {len(matches):>8} "
+              f"{recall(matches, planted, matcher):>7.1%}")
+
+    patterns = per_label_patterns(matcher)
+    text, planted = planted_text(reports, matcher, args.baseline_megabytes, args.every, random.Random(0))
+    size = len(text.encode("utf-8")) / 1e6
+    start = time.perf_counter()
+    found = sum(len(pattern.findall(text)) for pattern in patterns)
+    seconds = time.perf_counter() - start
+    print(f"{'regex per label':<16} {size:>6.1f} {seconds:>8.3f} {size / seconds:>7.1f} {len(planted):>8} {found:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# benchmarks/bench_db_concurrency.py
+#
+# Write throughput and latency of AzureChat.py's POST /threads/ as the number
+# of concurrent clients grows, against a scratch SQLite database. Run it once
+# per journal mode to compare WAL with SQLite's default rollback journal.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_db_concurrency --clients 1 4 16 64 --requests 2000
+#     python -m benchmarks.bench_db_concurrency --journal-mode DELETE --synchronous FULL
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+
+import httpx
+
+from benchmarks.bench_streaming import free_port
+
+
+async def run_clients(url, clients, requests, message_chars):
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def client(http):
+        nonlocal errors
+        for _ in counter:  # Shared iterator, so the clients split the requests between them
+            thread = {"id": str(uuid.uuid4()), "doctor_name": "DocName", "user_id": f"user-{len(latencies) % 50}",
+                      "content": "x" * message_chars, "messages": [{"user_id": "doctor", "content": "y" * message_chars}]}
+            start = time.perf_counter()
+            response = await http.post(url, json=thread)
+            latencies.append(time.perf_counter() - start)
+            errors += response.status_code != 200
+
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(limits=limits, timeout=None) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(clients)))
+        total = time.perf_counter() - start
+    return total, latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure /threads/ write throughput under concurrent clients")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per concurrency level")
+    parser.add_argument("--message-chars", type=int, default=2000)
+    parser.add_argument("--journal-mode", default="WAL")
+    parser.add_argument("--synchronous", default="NORMAL")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(scratch, 'bench.db')}"
+    os.environ["CACHE_DB_PATH"] = os.path.join(scratch, "cache.db")
+    os.environ["SQLITE_JOURNAL_MODE"] = args.journal_mode
+    os.environ["SQLITE_SYNCHRONOUS"] = args.synchronous
+
+    import uvicorn
+
+    import AzureChat  # Imported after DATABASE_URL points at the scratch file
+    import database
+
+    port = free_port()
+    api = uvicorn.Server(uvicorn.Config(AzureChat.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=api.run, daemon=True).start()
+    while not api.started:
+        time.sleep(0.05)
+
+    url = f"http://127.0.0.1:{port}/threads/"
+    print(f"journal_mode={args.journal_mode} synchronous={args.synchronous}, pool {database.DB_POOL_SIZE}+{database.DB_MAX_OVERFLOW}, "
+          f"{args.requests} requests per level")
+    print(f"{'clients':>8} {'writes/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for clients in args.clients:
+        total, latencies, errors = asyncio.run(run_clients(url, clients, args.requests, args.message_chars))
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"{clients:>8} {len(latencies) / total:>9.0f} {statistics.median(latencies) * 1000:>8.1f} {p99 * 1000:>8.1f} {errors:>7}")
+
+    api.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+# benchmarks/bench_e2e.py
+#
+# End-to-end benchmark suite. Serves main.py, thread.py, AzureChat.py and
+# coronary.py with uvicorn on local ports, pointed at the stub chat server in
+# benchmarks/stub_llm.py, and drives them over HTTP with the repository's own
+# PDFs and CSVs as fixtures. Reports p50/p95/p99 latency and throughput for
+# each section:
+#
+#   extraction  text extraction of every fixture PDF through the process pool
+#   chunking    token-aware chunking of the extracted and CSV text
+#   crud        thread create / read / update / list / delete, per app; each
+#               operation's throughput is thread lifecycles per second
+#   upload      full upload-and-query requests, per app, at --concurrency
+#
+# Results are written as JSON (to --output, by default a timestamped file in
+# benchmarks/results/) with the git commit and settings of the run. Pass an
+# earlier file as --compare to print the change of every metric and flag those
+# that got worse by more than --threshold; the exit status is then 1 when any did.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_e2e --latency 0.2 --error-rate 0.05
+#     python -m benchmarks.bench_e2e --sections upload --apps main --compare benchmarks/results/e2e-before.json
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import httpx
+import uvicorn
+
+from benchmarks.stub_llm import StubLLMServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+PDFS = ["autopsyreportsample.pdf", "Toxicology.pdf", "mri.pdf", "Medical History Report.pdf", "Untitled document (4).pdf"]
+CSVS = ["cpt4.csv", "patient_personal_details(1).csv"]
+
+APPS = ["main", "thread", "AzureChat", "coronary"]
+SECTIONS = ["extraction", "chunking", "crud", "upload"]
+
+# Fixtures each app's upload_and_query accepts; coronary.py reads PDFs only
+UPLOAD_FIXTURES = {"main": PDFS + ["cpt4.csv"], "thread": PDFS + ["cpt4.csv"], "AzureChat": PDFS + ["cpt4.csv"], "coronary": PDFS}
+
+# Thread operations each app serves from the same store it creates threads in.
+# AzureChat.py updates and deletes through the in-memory store rather than its
+# database, so only its create, read and list are measured.
+CRUD_OPERATIONS = {
+    "main": ["create", "read", "update", "list", "delete"],
+    "thread": ["create", "read", "update", "list", "delete"],
+    "AzureChat": ["create", "read", "list"],
+}
+
+QUERY = "Summarize the findings, medications and dates in these documents."
+
+# Metrics compared by --compare, and whether a higher value is better
+COMPARED_METRICS = {"p50_ms": False, "p95_ms": False, "p99_ms": False, "throughput_per_s": True}
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+# Latency percentiles (ms) and throughput (operations per second of wall time)
+def summarize(latencies, seconds, errors=0, **extra):
+    ordered = sorted(latencies)
+    stats = {
+        "count": len(ordered),
+        "errors": errors,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3) if ordered else None,
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 3) if ordered else None,
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3) if ordered else None,
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None,
+        "throughput_per_s": round(len(ordered) / seconds, 3) if seconds else None,
+    }
+    stats.update(extra)
+    return stats
+
+
+# Run the operations (coroutine functions) at most concurrency at a time. Returns the
+# latency of each operation that succeeded, the number that raised, and the wall time.
+async def run_concurrently(operations, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def run(operation):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await operation()
+            except Exception as e:
+                errors += 1
+                print(f"  error: {e}")
+                return
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(operation) for operation in operations))
+    return latencies, errors, time.perf_counter() - start
+
+
+def read_fixture(name):
+    with open(os.path.join(ROOT, name), "rb") as file:
+        return file.read()
+
+
+async def bench_extraction(args, results):
+    import extraction
+
+    files = [read_fixture(name) for name in PDFS]
+    await extraction.aextract_pdf(files[0])  # Start the worker processes outside the timings
+
+    operations = [lambda data=data: extraction.aextract_pdf(data) for _ in range(args.repeat) for data in files]
+    latencies, errors, seconds = await run_concurrently(operations, args.concurrency)
+    megabytes = sum(map(len, files)) * args.repeat / 1e6
+    results["extraction"] = summarize(latencies, seconds, errors, mb_per_s=round(megabytes / seconds, 3))
+    extraction.shutdown_pool()
+
+
+def bench_chunking(args, results):
+    import chunking
+    import extraction
+
+    texts = [extraction.read_pdf_pages(os.path.join(ROOT, name)) for name in PDFS]
+    texts += [read_fixture(name).decode("utf-8", errors="replace") for name in CSVS]
+
+    latencies, chunks = [], 0
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for text in texts:
+            started = time.perf_counter()
+            chunks += len(list(chunking.iter_chunks(text)))
+            latencies.append(time.perf_counter() - started)
+    seconds = time.perf_counter() - start
+    megabytes = sum(len(text.encode("utf-8")) for text in texts) * args.repeat / 1e6
+    results["chunking"] = summarize(latencies, seconds, mb_per_s=round(megabytes / seconds, 3), chunks=chunks)
+
+
+# Serves an app with uvicorn on a free local port in a background thread
+class AppServer:
+    def __init__(self, app):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.port = probe.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError("The app server failed to start")
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def thread_body(app, thread_id, user_id, content):
+    body = {"id": thread_id, "doctor_name": "Dr. Bench", "user_id": user_id, "content": content}
+    if app == "AzureChat":
+        body.update(messages=[{"user_id": user_id, "content": content}], uploaded_files=[])
+    return body
+
+
+def checked(response):
+    response.raise_for_status()
+    return response
+
+
+async def bench_crud(app, url, args, results):
+    timings = {operation: [] for operation in CRUD_OPERATIONS[app]}
+    errors = {operation: 0 for operation in timings}
+    user_id = f"bench-{uuid.uuid4().hex[:8]}"
+
+    async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+        async def timed(operation, call):
+            start = time.perf_counter()
+            try:
+                checked(await call())
+            except Exception as e:
+                errors[operation] += 1
+                print(f"  {app} {operation} error: {e}")
+                return
+            timings[operation].append(time.perf_counter() - start)
+
+        async def lifecycle(position):
+            thread_id = str(uuid.uuid4())
+            steps = {
+                "create": lambda: client.post("/threads/", json=thread_body(app, thread_id, user_id, f"thread {position}")),
+                "read": lambda: client.get(f"/threads/{user_id}/{thread_id}"),
+                "update": lambda: client.put(f"/threads/{user_id}/{thread_id}", json=thread_body(app, thread_id, user_id, "updated")),
+                "list": lambda: client.get(f"/threads/{user_id}", params={"limit": 50}),
+                "delete": lambda: client.delete(f"/threads/{user_id}/{thread_id}"),
+            }
+            for operation in timings:
+                await timed(operation, steps[operation])
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def bounded(position):
+            async with semaphore:
+                await lifecycle(position)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(bounded(position) for position in range(args.threads)))
+        seconds = time.perf_counter() - start
+
+    for operation, latencies in timings.items():
+        results[f"crud.{app}.{operation}"] = summarize(latencies, seconds, errors[operation])
+
+
+async def bench_upload(app, url, args, results):
+    fixtures = [(name, read_fixture(name)) for name in UPLOAD_FIXTURES[app]]
+
+    async with httpx.AsyncClient(base_url=url, timeout=600) as client:
+        async def upload(position):
+            name, data = fixtures[position % len(fixtures)]
+            form = {"query": QUERY, "user_id": "bench", "no_cache": str(not args.cache).lower()}
+            checked(await client.post("/upload_and_query/", files=[("files", (name, data))], data=form))
+
+        operations = [lambda position=position: upload(position) for position in range(args.requests)]
+        latencies, errors, seconds = await run_concurrently(operations, args.concurrency)
+    results[f"upload.{app}"] = summarize(latencies, seconds, errors)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"\n{'benchmark':<26} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>9}")
+    for name, stats in results.items():
+        values = [stats[metric] if stats[metric] is not None else float("nan") for metric in ("p50_ms", "p95_ms", "p99_ms", "throughput_per_s")]
+        print(f"{name:<26} {stats['count']:>6} {stats['errors']:>6} " + " ".join(f"{value:>9.1f}" for value in values))
+
+
+# Print each metric's change from a previous run; returns the names of the regressions
+def compare(results, path, threshold):
+    with open(path, encoding="utf-8") as file:
+        baseline = json.load(file)
+    print(f"\nchange from {path} (commit {(baseline['meta'].get('commit') or '?')[:10]}), threshold {threshold:.0%}")
+    regressions = []
+    for name, stats in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        changes = []
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if not before.get(metric) or stats.get(metric) is None:
+                continue
+            change = stats[metric] / before[metric] - 1
+            worse = -change if higher_is_better else change
+            flag = " REGRESSION" if worse > threshold else ""
+            if flag:
+                regressions.append(f"{name} {metric}")
+            changes.append(f"{metric} {change:+.1%}{flag}")
+        print(f"{name:<26} " + ", ".join(changes))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the end-to-end benchmark suite against a stub LLM")
+    parser.add_argument("--sections", nargs="+", choices=SECTIONS, default=SECTIONS)
+    parser.add_argument("--apps", nargs="+", choices=APPS, default=APPS)
+    parser.add_argument("--latency", type=float, default=0.2, help="Stub response delay in seconds")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="Stub delay between streamed words")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of stub requests that fail")
+    parser.add_argument("--error-status", type=int, default=500, help="Status of the failed stub requests (e.g. 429)")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the fixtures for extraction and chunking")
+    parser.add_argument("--threads", type=int, default=50, help="Thread lifecycles per app in the crud section")
+    parser.add_argument("--requests", type=int, default=20, help="Upload-and-query requests per app")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once")
+    parser.add_argument("--cache", action="store_true", help="Let uploads use cached answers (no_cache=false)")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/e2e-<time>.json)")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output or os.path.join(RESULTS_DIR, time.strftime("e2e-%Y%m%d-%H%M%S.json")))
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    stub = StubLLMServer(latency=args.latency, token_latency=args.token_latency, error_rate=args.error_rate,
+                         error_status=args.error_status).start()
+
+    # The apps keep their databases, caches and uploads next to the working directory, so
+    # every run starts empty in its own directory, with the fixtures read from the repository
+    workdir = tempfile.mkdtemp(prefix="bench-e2e-")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    os.environ.update(
+        OPENAI_CHAT_URL=stub.url,
+        AZURE_OPENAI_ENDPOINT=stub.url,
+        AZURE_OPENAI_API_KEY="stub",
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'threads.db')}",
+        CACHE_DB_PATH=os.path.join(workdir, "cache.db"),
+        JOBS_DB_PATH=os.path.join(workdir, "jobs.db"),
+        PATIENT_DATA_PATH=os.path.join(ROOT, "patient_personal_details(1).csv"),
+        CPT_CODES_PATH=os.path.join(ROOT, "cpt4.csv"),
+    )
+
+    results = {}
+    print(f"stub latency {args.latency:.3f}s, error rate {args.error_rate:.0%}, concurrency {args.concurrency}, working directory {workdir}")
+
+    if "extraction" in args.sections:
+        print("extraction...")
+        asyncio.run(bench_extraction(args, results))
+    if "chunking" in args.sections:
+        print("chunking...")
+        bench_chunking(args, results)
+
+    for name in args.apps:
+        app_sections = [section for section in ("crud", "upload") if section in args.sections and (section != "crud" or name in CRUD_OPERATIONS)]
+        if not app_sections:
+            continue
+        module = __import__(name)
+        with AppServer(module.app) as server:
+            if "crud" in app_sections:
+                print(f"crud {name}...")
+                asyncio.run(bench_crud(name, server.url, args, results))
+            if "upload" in app_sections:
+                print(f"upload {name}...")
+                asyncio.run(bench_upload(name, server.url, args, results))
+
+    stub.stop()
+    print_results(results)
+
+    run = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "settings": vars(args),
+            "stub": {"requests": stub.request_count, "errors": stub.error_count},
+        },
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(run, file, indent=2)
+    print(f"\nsaved {output}")
+
+    if compare_path:
+        regressions = compare(results, compare_path, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
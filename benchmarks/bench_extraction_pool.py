@@ -0,0 +1,119 @@
+# benchmarks/bench_extraction_pool.py
+#
+# Latency of concurrent /upload_and_query/ requests to main.py with PDF parsing
+# inline on the event loop (EXTRACTION_WORKERS=0, the old behaviour) and in the
+# extraction process pool. A light GET /threads/ is timed while the uploads run
+# to show how long other users wait behind an extraction.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_extraction_pool --clients 8 --copies 20 --workers 4
+
+import argparse
+import io
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import PyPDF2
+
+from benchmarks.bench_streaming import free_port
+from benchmarks.stub_llm import StubLLMServer
+
+PDFS = ["mri.pdf", "Toxicology.pdf", "autopsyreportsample.pdf"]
+
+
+# One large case bundle made of the bundled PDFs repeated copies times
+def build_bundle(copies):
+    writer = PyPDF2.PdfWriter()
+    for _ in range(copies):
+        for path in PDFS:
+            for page in PyPDF2.PdfReader(path).pages:
+                writer.add_page(page)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue(), len(writer.pages)
+
+
+def upload(url, bundle):
+    start = time.perf_counter()
+    response = httpx.post(
+        url,
+        files=[("files", ("bundle.pdf", bundle, "application/pdf"))],
+        data={"query": "Summarize the findings.", "user_id": "bench", "no_cache": "true"},
+        timeout=None,
+    )
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+# Time GET /threads/ back to back until the uploads finish
+def probe(url, done, latencies):
+    while not done.is_set():
+        start = time.perf_counter()
+        httpx.get(url, timeout=None)
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.01)
+
+
+def run(base_url, bundle, clients):
+    done = threading.Event()
+    probes = []
+    prober = threading.Thread(target=probe, args=(f"{base_url}/threads/", done, probes))
+    prober.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        uploads = list(executor.map(lambda _: upload(f"{base_url}/upload_and_query/", bundle), range(clients)))
+    wall = time.perf_counter() - start
+    done.set()
+    prober.join()
+    return uploads, probes, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare inline and pooled PDF extraction under concurrent uploads")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent uploads")
+    parser.add_argument("--copies", type=int, default=20, help="Times the bundled PDFs are repeated in each upload")
+    parser.add_argument("--workers", type=int, default=4, help="Extraction pool size for the pooled run")
+    parser.add_argument("--latency", type=float, default=0.05, help="Stub LLM delay in seconds")
+    args = parser.parse_args()
+
+    server = StubLLMServer(latency=args.latency, token_latency=0).start()
+    os.environ["OPENAI_CHAT_URL"] = server.url
+    os.environ["CACHE_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "cache.db")
+
+    import uvicorn
+
+    import extraction
+    import main as app_module  # Imported after the endpoint points at the stub
+
+    port = free_port()
+    api = uvicorn.Server(uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=api.run, daemon=True).start()
+    while not api.started:
+        time.sleep(0.05)
+
+    bundle, pages = build_bundle(args.copies)
+    print(f"{args.clients} concurrent uploads of {pages} pages ({len(bundle) / 1e6:.1f} MB), "
+          f"{extraction.EXTRACTION_PAGES_PER_TASK} pages per task")
+    print(f"{'mode':<10} {'upload p50 (s)':>15} {'upload max (s)':>15} {'probe p50 (ms)':>15} {'probe max (ms)':>15} {'wall (s)':>9}")
+
+    for mode, workers in (("inline", 0), ("pool", args.workers)):
+        extraction.shutdown_pool()
+        extraction.EXTRACTION_WORKERS = workers
+        if workers:
+            upload(f"http://127.0.0.1:{port}/upload_and_query/", bundle)  # Start the workers before timing
+        uploads, probes, wall = run(f"http://127.0.0.1:{port}", bundle, args.clients)
+        print(f"{mode:<10} {statistics.median(uploads):>15.3f} {max(uploads):>15.3f} "
+              f"{statistics.median(probes) * 1000:>15.1f} {max(probes) * 1000:>15.1f} {wall:>9.2f}")
+
+    extraction.shutdown_pool()
+    api.should_exit = True
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
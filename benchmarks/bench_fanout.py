@@ -0,0 +1,72 @@
+# benchmarks/bench_fanout.py
+#
+# Compares the old serial per-chunk loop (one requests.post per chunk) with the
+# concurrent fan-out in llm.py, against a local stub of the Azure endpoint.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_fanout --latency 0.2 --chunks 1 4 16 64
+
+import argparse
+import asyncio
+import os
+import time
+
+import requests
+
+from benchmarks.stub_llm import StubLLMServer
+
+
+def serial_baseline(url, chunks, query):
+    # What query_pdf_content_in_chunks used to do: one fresh connection per chunk, one at a time
+    responses = []
+    for chunk in chunks:
+        data = {"messages": [{"role": "user", "content": f"Analyze the following document: {chunk}. Based on this text, answer the question: {query}."}]}
+        response = requests.post(url, json=data, headers={"Content-Type": "application/json", "api-key": "stub"})
+        response.raise_for_status()
+        responses.append(response.json()['choices'][0]['message']['content'])
+    return "\n".join(responses)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.2, help="Stub response delay in seconds")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    server = StubLLMServer(latency=args.latency).start()
+    os.environ["AZURE_OPENAI_ENDPOINT"] = server.url
+    os.environ["AZURE_OPENAI_API_KEY"] = "stub"
+
+    import AzureChat  # Imported after the endpoint points at the stub
+    import llm
+
+    query = "Summarize the toxicology findings."
+    print(f"stub latency {args.latency:.3f}s, max concurrency {llm.LLM_MAX_CONCURRENCY}")
+    print(f"{'chunks':>8} {'serial (s)':>12} {'fan-out (s)':>12} {'speedup':>9}")
+
+    for n_chunks in args.chunks:
+        text = "x" * (1500 * n_chunks)
+        chunks = AzureChat.split_text_into_chunks(text)
+
+        start = time.perf_counter()
+        serial_baseline(server.url, chunks, query)
+        serial = time.perf_counter() - start
+
+        async def run():
+            try:
+                return await AzureChat.query_pdf_content_in_chunks(text, query)
+            finally:
+                await llm.aclose_clients()
+
+        start = time.perf_counter()
+        answer = asyncio.run(run())
+        fanout = time.perf_counter() - start
+        assert answer.count("\n") == n_chunks - 1
+
+        print(f"{n_chunks:>8} {serial:>12.3f} {fanout:>12.3f} {serial / fanout:>8.1f}x")
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
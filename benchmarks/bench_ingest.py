@@ -0,0 +1,63 @@
+# benchmarks/bench_ingest.py
+#
+# Peak Python memory and time to save and hash one upload: the old path
+# (await file.read(), write, then read the file again to hash it) against the
+# single-pass block copy in ingest.py.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_ingest --sizes 16 64 256
+
+import argparse
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+import tracemalloc
+
+from fastapi import UploadFile
+
+import ingest
+
+
+async def old_save(file, directory):
+    path = os.path.join(directory, file.filename)
+    with open(path, "wb") as f:
+        f.write(await file.read())
+    file.file.seek(0)
+    return path, hashlib.sha256(file.file.read()).hexdigest()
+
+
+async def measure(save, source_path, directory):
+    with open(source_path, "rb") as source:
+        file = UploadFile(source, filename="upload.bin")
+        tracemalloc.start()
+        start = time.perf_counter()
+        await save(file, directory)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare upload ingestion memory and time")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 64, 256], help="Upload sizes in MB")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    print(f"block size {ingest.UPLOAD_BLOCK_SIZE / 1024:.0f} KB")
+    print(f"{'size (MB)':>10} {'old peak (MB)':>14} {'new peak (MB)':>14} {'old (s)':>8} {'new (s)':>8}")
+    for size in args.sizes:
+        source_path = os.path.join(directory, "source.bin")
+        with open(source_path, "wb") as f:
+            for _ in range(size):
+                f.write(os.urandom(1024 * 1024))
+
+        old_time, old_peak = asyncio.run(measure(old_save, source_path, directory))
+        new_time, new_peak = asyncio.run(measure(ingest.save_upload, source_path, directory))
+        print(f"{size:>10} {old_peak / 1e6:>14.1f} {new_peak / 1e6:>14.1f} {old_time:>8.3f} {new_time:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# benchmarks/bench_listing.py
+#
+# Latency and body size of listing one user's threads as document volume grows:
+# the old path (every thread with its full content through pydantic Thread
+# objects and the standard JSON encoder) against the paged, projected orjson
+# listing in listing.py.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_listing --threads 1000 --content-kb 1 16 128
+
+import argparse
+import gzip
+import json
+import time
+import uuid
+
+import orjson
+
+import listing
+from thread import Thread
+from thread_store import ThreadStore
+
+USER = "doctor"
+
+
+def old_listing(store):
+    threads = [Thread(**thread) for thread in store.list_user(USER)]
+    return json.dumps([thread.model_dump(mode="json") for thread in threads]).encode("utf-8")
+
+
+def new_listing(store):
+    fields = listing.parse_fields(None, Thread)
+    page, _ = store.page(listing.parse_limit(None), user_id=USER)
+    return orjson.dumps([listing.project(thread, fields) for thread in page])
+
+
+def best_of(function, store, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = function(store)
+        timings.append(time.perf_counter() - start)
+    return min(timings), body
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare thread listing latency and size")
+    parser.add_argument("--threads", type=int, default=1000)
+    parser.add_argument("--content-kb", type=int, nargs="+", default=[1, 16, 128], help="Extracted text per thread")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{args.threads} threads, page size {listing.parse_limit(None)}")
+    print(f"{'content KB':>11} {'old ms':>9} {'old MB':>8} {'old gz MB':>10} {'new ms':>8} {'new KB':>8}")
+    for content_kb in args.content_kb:
+        store = ThreadStore()
+        content = "lorem ipsum " * (content_kb * 1024 // 12)
+        for _ in range(args.threads):
+            store.create(USER, {"id": uuid.uuid4(), "doctor_name": "DocName", "user_id": USER, "content": content,
+                                "messages": [{"user_id": USER, "content": "question"}], "uploaded_files": []})
+
+        old_time, old_body = best_of(old_listing, store, args.repeat)
+        new_time, new_body = best_of(new_listing, store, args.repeat)
+        print(f"{content_kb:>11} {old_time * 1000:>9.1f} {len(old_body) / 1e6:>8.1f} {len(gzip.compress(old_body, 5)) / 1e6:>10.2f} "
+              f"{new_time * 1000:>8.2f} {len(new_body) / 1e3:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
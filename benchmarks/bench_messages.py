@@ -0,0 +1,57 @@
+# benchmarks/bench_messages.py
+#
+# Cost of appending one chat turn as a thread grows to thousands of turns:
+# rewriting the whole ThreadDB.messages JSON column (the old continue-chat
+# path) against one insert into the indexed messages table.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_messages --turns 5000 --every 500
+
+import argparse
+import os
+import tempfile
+import time
+import uuid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-turn append cost of JSON rewrite and message rows")
+    parser.add_argument("--turns", type=int, default=5000)
+    parser.add_argument("--every", type=int, default=500, help="Report the average over this many turns")
+    parser.add_argument("--message-chars", type=int, default=800)
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    from database import SessionLocal, ThreadDB, append_messages  # Imported after DATABASE_URL points at a scratch file
+
+    message = {"user_id": "doctor", "content": "x" * args.message_chars}
+    json_id, table_id = uuid.uuid4(), uuid.uuid4()
+    with SessionLocal() as db:
+        db.add_all([ThreadDB(id=json_id, user_id="doctor", content="", messages=[]),
+                    ThreadDB(id=table_id, user_id="doctor", content="")])
+        db.commit()
+
+    print(f"{'turns':>7} {'json rewrite (ms)':>18} {'row insert (ms)':>16}")
+    json_total = table_total = 0.0
+    with SessionLocal() as db:
+        for turn in range(1, args.turns + 1):
+            start = time.perf_counter()
+            thread = db.get(ThreadDB, json_id)
+            thread.messages = list(thread.messages or []) + [message]
+            db.commit()
+            db.expire_all()  # Each request loads the thread afresh
+            json_total += time.perf_counter() - start
+
+            start = time.perf_counter()
+            append_messages(db, table_id, [message])
+            db.commit()
+            db.expire_all()
+            table_total += time.perf_counter() - start
+
+            if turn % args.every == 0:
+                print(f"{turn:>7} {json_total / args.every * 1000:>18.3f} {table_total / args.every * 1000:>16.3f}")
+                json_total = table_total = 0.0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# benchmarks/bench_ocr.py
+#
+# Pages per second extracted from PDFs with a text layer and from scanned PDFs, whose
+# pages are rendered and OCR'd in the extraction worker pool (see extraction.aocr_pages).
+# The scanned PDF is made here, from images of typed text; it's extracted with an empty
+# OCR cache and again with the pages cached, as for a re-upload. Needs the tesseract
+# and poppler (pdftoppm) binaries for the OCR rows.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_ocr --pages 12 --dpi 300
+
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+FILES = ["Medical History Report.pdf", "autopsyreportsample.pdf", "Toxicology.pdf", "mri.pdf"]
+
+LINE = "Toxicology: blood alcohol 0.08 g/dL, no other drugs detected. Cause of death pending review."
+
+
+def make_scanned_pdf(path, pages):
+    from PIL import Image, ImageDraw
+
+    images = []
+    for number in range(pages):
+        image = Image.new("RGB", (1275, 1650), "white")
+        draw = ImageDraw.Draw(image)
+        for row in range(30):
+            draw.text((80, 80 + row * 48), f"{number + 1}.{row + 1} {LINE}", fill="black")
+        images.append(image)
+    images[0].save(path, save_all=True, append_images=images[1:], resolution=150)
+
+
+async def extract(paths):
+    import extraction
+
+    started = time.perf_counter()
+    texts = await asyncio.gather(*(extraction.aextract_pdf(path) for path in paths))
+    return time.perf_counter() - started, sum(len(text) for text in texts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure extraction of native text and OCR'd pages")
+    parser.add_argument("--pages", type=int, default=12, help="Pages of the scanned PDF")
+    parser.add_argument("--copies", type=int, default=10, help="Times the text PDFs are extracted")
+    parser.add_argument("--dpi", type=int, default=300)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ.update(OCR_DPI=str(args.dpi), CACHE_DB_PATH=os.path.join(directory, "cache.db"), TRACE_SAMPLE_RATE="0")
+    import extraction
+    import PyPDF2
+
+    native = [os.path.abspath(name) for name in FILES] * args.copies
+    native_pages = sum(len(PyPDF2.PdfReader(path).pages) for path in native)
+    scanned = os.path.join(directory, "scanned.pdf")
+    make_scanned_pdf(scanned, args.pages)
+
+    print(f"{extraction.EXTRACTION_WORKERS} workers, OCR at {args.dpi} dpi\n")
+    print(f"{'pages':<22} {'count':>6} {'seconds':>8} {'pages/s':>9} {'chars':>8}")
+    try:
+        asyncio.run(extract(native[:1]))  # Start the extraction workers
+        rows = [("text layer", native, native_pages)]
+        if extraction.OCR_ENABLED and shutil.which("tesseract") and shutil.which("pdftoppm"):
+            rows += [("scanned, OCR", [scanned], args.pages), ("scanned, cached OCR", [scanned], args.pages)]
+        else:
+            print("(OCR rows skipped: pytesseract, pdf2image, tesseract or pdftoppm is missing)")
+        for name, paths, pages in rows:
+            seconds, chars = asyncio.run(extract(paths))
+            print(f"{name:<22} {pages:>6} {seconds:>8.2f} {pages / seconds:>9.1f} {chars:>8}")
+    finally:
+        extraction.shutdown_pool()
+
+
+if __name__ == "__main__":
+    main()
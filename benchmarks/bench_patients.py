@@ -0,0 +1,82 @@
+# benchmarks/bench_patients.py
+#
+# Load time and per-query latency of the indexed patient engine in patients.py
+# against a pandas DataFrame scanned with boolean masks, over synthetic copies
+# of patient_personal_details(1).csv scaled up to the requested row counts.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_patients --rows 10000 100000 1000000
+
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+
+import pandas as pd
+
+import patients
+
+SOURCE = "patient_personal_details(1).csv"
+
+
+def write_dataset(path, rows, n_patients):
+    with open(SOURCE, encoding="utf-8", errors="replace", newline="") as file:
+        texts = [row["transcription"] for row in csv.DictReader(file, delimiter=";")]
+    random.seed(0)
+    start = patients.parse_time("2023-01-01")
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file, delimiter=";", quoting=csv.QUOTE_ALL)
+        writer.writerow(["transcription", "created_at", "patient_model_id", "patient_id"])
+        for row in range(rows):
+            writer.writerow([texts[row % len(texts)], patients.format_time(start + random.randrange(365 * 24 * 3600)),
+                             str(random.randrange(200)), f"P-{random.randrange(n_patients):06d}"])
+
+
+def per_call(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the indexed patient engine with pandas scans")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--patients", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'rows':>9} {'query':<12} {'engine us':>10} {'pandas us':>10}")
+    for rows in args.rows:
+        path = os.path.join(tempfile.mkdtemp(), "patients.csv")
+        write_dataset(path, rows, args.patients)
+
+        start = time.perf_counter()
+        table = patients.load_table(path)
+        engine_load = time.perf_counter() - start
+        start = time.perf_counter()
+        frame = pd.read_csv(path, sep=";", dtype=str)
+        frame["created_at"] = pd.to_datetime(frame["created_at"])
+        pandas_load = time.perf_counter() - start
+        print(f"{rows:>9} {'load (s)':<12} {engine_load:>10.2f} {pandas_load:>10.2f}")
+
+        patient_id = "P-000042"
+        low, high = patients.parse_time("2023-06-01"), patients.parse_time("2023-06-01", end=True)
+        low_ts, high_ts = pd.Timestamp("2023-06-01"), pd.Timestamp("2023-06-01 23:59:59")
+        queries = {
+            "lookup": (lambda: table.by_patient(patient_id, limit=10, include_text=False),
+                       lambda: frame[frame["patient_id"] == patient_id].nlargest(10, "created_at")),
+            "time range": (lambda: table.in_range(low, high, limit=10, include_text=False),
+                           lambda: frame[(frame["created_at"] >= low_ts) & (frame["created_at"] <= high_ts)].nlargest(10, "created_at")),
+            "top 10": (lambda: table.top_patients(10),
+                       lambda: frame["patient_id"].value_counts().head(10)),
+        }
+        for name, (engine_query, pandas_query) in queries.items():
+            repeat = max(1, args.repeat * 10000 // rows)
+            print(f"{rows:>9} {name:<12} {per_call(engine_query, args.repeat):>10.1f} {per_call(pandas_query, repeat):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
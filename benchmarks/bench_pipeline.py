@@ -0,0 +1,88 @@
+# benchmarks/bench_pipeline.py
+#
+# The map stage of a report over several uploads, run the old way (extract every
+# file, chunk the combined text, then query the chunks) and pipelined (pages go to
+# the chunker as they are parsed and each chunk is queried as soon as it is complete,
+# see streaming.stream_pipelined_chunk_answers). Chunk calls go to the stub LLM
+# endpoint with the response cache off; reports the time to the first model call,
+# to the last chunk answer, and checks both ways make the same chunks.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_pipeline --copies 4 --latency 0.3
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.stub_llm import StubLLMServer
+
+FILES = ["Medical History Report.pdf", "autopsyreportsample.pdf", "Toxicology.pdf", "mri.pdf"]
+
+
+async def run(app_module, uploads, pipelined, query):
+    import chunking
+    import extraction
+    import streaming
+
+    started = time.perf_counter()
+    first_call = None
+    chunks = []
+
+    async def worker(chunk):
+        nonlocal first_call
+        first_call = first_call or time.perf_counter() - started
+        chunks.append(chunk)
+        return await app_module.aquery_pdf_content(chunk, query, use_cache=False)
+
+    answers = []
+    if pipelined:
+        pieces = app_module.iter_upload_text(uploads)
+        events = streaming.stream_pipelined_chunk_answers(pieces, chunking.Chunker(model="gpt-3.5-turbo"), worker, answers)
+    else:
+        combined_text = ""
+        for _, data in uploads:
+            combined_text += await extraction.aextract_pdf(data) + "\n"
+        events = streaming.stream_chunk_answers(app_module.split_text_into_chunks(combined_text), worker, answers)
+    async for _ in events:
+        pass
+    return first_call, time.perf_counter() - started, sorted(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure pipelined extraction and chunk queries against extract-then-query")
+    parser.add_argument("--copies", type=int, default=4, help="Times the sample files are uploaded (as different files)")
+    parser.add_argument("--latency", type=float, default=0.3, help="Stub response time (seconds)")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    stub = StubLLMServer(latency=args.latency, token_latency=0).start()
+    os.environ.update(OPENAI_CHAT_URL=stub.url, CACHE_DB_PATH=os.path.join(tempfile.mkdtemp(), "cache.db"), TRACE_SAMPLE_RATE="0")
+    import main as app_module
+
+    uploads = []
+    for copy in range(args.copies):
+        for name in FILES:
+            with open(name, "rb") as file:
+                uploads.append((f"{copy}-{name}", file.read()))
+
+    print(f"{len(uploads)} PDFs, stub latency {args.latency}s, best of {args.rounds}\n")
+    print(f"{'mode':<12} {'chunks':>7} {'first call (s)':>15} {'all answers (s)':>16}")
+    try:
+        asyncio.run(run(app_module, uploads[:1], False, "warm up"))  # Start the extraction workers
+        results = {}
+        for name, pipelined in [("sequential", False), ("pipelined", True)]:
+            timings = [asyncio.run(run(app_module, uploads, pipelined, f"findings {name} {round_number}")) for round_number in range(args.rounds)]
+            first_call = min(timing[0] for timing in timings)
+            total = min(timing[1] for timing in timings)
+            results[name] = timings[0][2]
+            print(f"{name:<12} {len(timings[0][2]):>7} {first_call:>15.2f} {total:>16.2f}")
+        print(f"\nsame chunks: {results['sequential'] == results['pipelined']}")
+    finally:
+        stub.stop()
+        app_module.extraction.shutdown_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# benchmarks/bench_router.py
+#
+# Accuracy and latency of the query router in router.py over labelled questions
+# (one {"query", "route"} per line, plus "files": true when documents were uploaded
+# with the question), with the patient ids of the bundled transcripts. Two splits:
+# benchmarks/router_eval.jsonl, which the rules were tuned on, and
+# benchmarks/router_heldout.jsonl, written before the last rule changes and kept out
+# of tuning; only the held-out score says how the router does on new questions. For
+# comparison it scores the substring check the router replaced ("patient id" or "top"
+# in the query means a patient question, anything else goes to the documents).
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_router --repeat 1000
+
+import argparse
+import json
+import os
+import time
+
+import patients
+import router
+
+EVAL_PATHS = [os.path.join(os.path.dirname(__file__), name) for name in ("router_eval.jsonl", "router_heldout.jsonl")]
+
+
+def substring_family(query):
+    return "patients" if "patient id" in query.lower() or "top" in query.lower() else "documents"
+
+
+def score(path, patient_ids, verbose):
+    with open(path, encoding="utf-8") as file:
+        examples = [json.loads(line) for line in file if line.strip()]
+
+    correct, family_correct, substring_correct = {}, 0, 0
+    misrouted = []
+    for example in examples:
+        decision = router.route(example["query"], patient_ids, example.get("files", False))
+        expected_family = router.ROUTES[example["route"]]
+        hits, total = correct.get(example["route"], (0, 0))
+        correct[example["route"]] = (hits + (decision["name"] == example["route"]), total + 1)
+        family_correct += router.ROUTES[decision["name"]] == expected_family
+        substring_correct += substring_family(example["query"]) == expected_family
+        if decision["name"] != example["route"]:
+            misrouted.append((example, decision))
+
+    print(f"\n{os.path.basename(path)}\n{'route':<22} {'questions':>9} {'correct':>8}")
+    for name in router.ROUTES:
+        hits, total = correct.get(name, (0, 0))
+        if total:
+            print(f"{name:<22} {total:>9} {hits / total:>8.1%}")
+    exact = sum(hits for hits, _ in correct.values())
+    print(f"{'all routes':<22} {len(examples):>9} {exact / len(examples):>8.1%}")
+    print(f"{'family (router)':<22} {len(examples):>9} {family_correct / len(examples):>8.1%}")
+    print(f"{'family (substring)':<22} {len(examples):>9} {substring_correct / len(examples):>8.1%}")
+    for example, decision in misrouted if verbose else []:
+        print(f"  {example['query']!r}: expected {example['route']}, got {decision['name']} ({decision['rule']})")
+    return examples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure query routing accuracy and latency")
+    parser.add_argument("--eval", nargs="+", default=EVAL_PATHS, help="JSONL files of {\"query\", \"route\"}, scored apart")
+    parser.add_argument("--repeat", type=int, default=1000, help="Timed routings of each question")
+    parser.add_argument("--verbose", action="store_true", help="Print every misrouted question")
+    args = parser.parse_args()
+
+    patient_ids = patients.load_table(patients.PATIENT_DATA_PATH).rows_by_patient
+    examples = [example for path in args.eval for example in score(path, patient_ids, args.verbose)]
+
+    timings = []
+    for example in examples:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            router.route(example["query"], patient_ids, example.get("files", False))
+        timings.append((time.perf_counter() - start) / args.repeat * 1e6)
+    timings.sort()
+    print(f"\nrouting time per question: mean {sum(timings) / len(timings):.1f}us, "
+          f"median {timings[len(timings) // 2]:.1f}us, slowest {timings[-1]:.1f}us")
+
+
+if __name__ == "__main__":
+    main()
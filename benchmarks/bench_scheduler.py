@@ -0,0 +1,93 @@
+# benchmarks/bench_scheduler.py
+#
+# The LLM call scheduler in scheduler.py against a stub endpoint that enforces a
+# requests per minute quota with 429s and Retry-After, like an Azure OpenAI
+# deployment. Several report generations fire their chunk calls at once while
+# a doctor asks follow-up questions, and each run reports the 429s received,
+# the calls given up on, how long the reports took and how long the follow-up
+# questions waited. The runs are: no pacing (429s and their Retry-After only),
+# token bucket pacing with every call in one lane, and pacing with the reports
+# in the bulk lane and the questions in the interactive one.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_scheduler --rpm 600 --reports 4 --chunks 25
+
+import argparse
+import asyncio
+import contextlib
+import os
+import time
+
+import llm
+import scheduler
+from benchmarks.stub_llm import StubLLMServer
+
+
+async def run(url, args, lanes):
+    headers = llm.openai_headers("bench")
+    payload = {"model": "bench", "messages": [{"role": "user", "content": "x" * 400}]}
+    failures = 0
+
+    async def call(lane):
+        nonlocal failures
+        with scheduler.lane(lane if lanes else "standard"):
+            try:
+                await llm.apost_chat_completion(url, headers, payload)
+            except llm.LLMError:
+                failures += 1
+
+    async def report():
+        started = time.perf_counter()
+        await llm.gather_in_order(range(args.chunks), lambda _: call("bulk"))
+        return time.perf_counter() - started
+
+    async def questions():
+        waits = []
+        await asyncio.sleep(args.question_delay)
+        for _ in range(args.questions):
+            started = time.perf_counter()
+            await call("interactive")
+            waits.append(time.perf_counter() - started)
+            await asyncio.sleep(args.question_interval)
+        return waits
+
+    results = await asyncio.gather(questions(), *(report() for _ in range(args.reports)))
+    return results[0], results[1:], failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the LLM call scheduler against a rate limited endpoint")
+    parser.add_argument("--rpm", type=int, default=600, help="Requests per minute the stub allows")
+    parser.add_argument("--window", type=float, default=1, help="Seconds the stub and the scheduler check the quota over")
+    parser.add_argument("--headroom", type=float, default=0.9, help="Share of the quota the scheduler is set to")
+    parser.add_argument("--latency", type=float, default=0.05, help="Stub response time (seconds)")
+    parser.add_argument("--reports", type=int, default=4, help="Reports generated at the same time")
+    parser.add_argument("--chunks", type=int, default=25, help="Chunk calls per report")
+    parser.add_argument("--questions", type=int, default=10, help="Follow-up questions asked during the reports")
+    parser.add_argument("--question-delay", type=float, default=1.0, help="Seconds before the first question")
+    parser.add_argument("--question-interval", type=float, default=0.5, help="Seconds between questions")
+    args = parser.parse_args()
+
+    modes = [
+        ("no pacing", scheduler.Scheduler(0, 0), False),
+        ("paced, one lane", scheduler.Scheduler(int(args.rpm * args.headroom), 0, args.window), False),
+        ("paced, lanes", scheduler.Scheduler(int(args.rpm * args.headroom), 0, args.window), True),
+    ]
+    print(f"{args.reports} reports x {args.chunks} chunk calls, {args.questions} questions, "
+          f"quota {args.rpm} requests/minute checked over {args.window}s, scheduler set to {args.headroom:.0%} of it\n")
+    print(f"{'mode':<18} {'429s':>6} {'failed':>7} {'reports (s)':>12} {'question p50 (s)':>17} {'question max (s)':>17}")
+    for name, mode_scheduler, lanes in modes:
+        scheduler.llm_scheduler = mode_scheduler
+        stub = StubLLMServer(latency=args.latency, requests_per_minute=args.rpm, quota_window=args.window).start()
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):  # Retry messages
+                waits, reports, failures = asyncio.run(run(stub.url, args, lanes))
+        finally:
+            stub.stop()
+        waits.sort()
+        print(f"{name:<18} {stub.throttled_count:>6} {failures:>7} {max(reports):>12.2f} "
+              f"{waits[len(waits) // 2]:>17.3f} {waits[-1]:>17.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# benchmarks/bench_streaming.py
+#
+# Time to first byte and total time of main.py's /upload_and_query/ with and
+# without stream=true, against a local stub of the chat completions endpoint
+# that streams its answers word by word.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_streaming --latency 0.5 --token-latency 0.02
+
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import httpx
+
+from benchmarks.stub_llm import StubLLMServer
+
+PDFS = ["mri.pdf", "Toxicology.pdf", "autopsyreportsample.pdf"]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def post(url, stream):
+    files = [("files", (os.path.basename(path), open(path, "rb"), "application/pdf")) for path in PDFS]
+    data = {"query": "Summarize the findings.", "user_id": "bench", "no_cache": "true", "stream": str(stream).lower()}
+    events = 0
+    start = time.perf_counter()
+    first_byte = None
+    with httpx.stream("POST", url, files=files, data=data, timeout=None) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            events += line.startswith("event:")
+    for _, (_, handle, _) in files:
+        handle.close()
+    return first_byte, time.perf_counter() - start, events
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare buffered and streamed /upload_and_query/")
+    parser.add_argument("--latency", type=float, default=0.5, help="Stub delay before each answer in seconds")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="Stub delay between streamed words")
+    args = parser.parse_args()
+
+    server = StubLLMServer(latency=args.latency, token_latency=args.token_latency).start()
+    os.environ["OPENAI_CHAT_URL"] = server.url
+    os.environ["CACHE_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "cache.db")
+
+    import uvicorn
+
+    import main as app_module  # Imported after the endpoint points at the stub
+
+    port = free_port()
+    api = uvicorn.Server(uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=api.run, daemon=True).start()
+    while not api.started:
+        time.sleep(0.05)
+
+    url = f"http://127.0.0.1:{port}/upload_and_query/"
+    print(f"stub latency {args.latency:.3f}s, {args.token_latency:.3f}s per streamed word, files {', '.join(PDFS)}")
+    print(f"{'mode':<10} {'first byte (s)':>15} {'total (s)':>10} {'events':>7}")
+    for stream in (False, True):
+        first_byte, total, events = post(url, stream)
+        print(f"{'stream' if stream else 'buffered':<10} {first_byte:>15.3f} {total:>10.3f} {events:>7}")
+
+    api.should_exit = True
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
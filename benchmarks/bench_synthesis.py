@@ -0,0 +1,65 @@
+# benchmarks/bench_synthesis.py
+#
+# Per-level timing of the tree-reduce synthesis in synthesis.py for growing
+# numbers of chunk answers, against a local stub of the chat completions
+# endpoint. The stub's answers are short, so every level shrinks its input
+# the way real merge calls do.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_synthesis --answers 8 64 512 --fan-in 8 --max-tokens 8000
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.stub_llm import StubLLMServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the tree-reduce synthesis")
+    parser.add_argument("--answers", type=int, nargs="+", default=[8, 64, 512])
+    parser.add_argument("--answer-words", type=int, default=300, help="Words per chunk answer")
+    parser.add_argument("--fan-in", type=int, default=None)
+    parser.add_argument("--max-tokens", type=int, default=None)
+    parser.add_argument("--max-depth", type=int, default=None)
+    parser.add_argument("--latency", type=float, default=0.2, help="Stub response delay in seconds")
+    args = parser.parse_args()
+
+    server = StubLLMServer(latency=args.latency).start()
+    os.environ["OPENAI_CHAT_URL"] = server.url
+    os.environ["CACHE_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "cache.db")
+
+    import llm
+    import main as app_module  # Imported after the endpoint points at the stub
+    import synthesis
+
+    answer = " ".join(["finding"] * args.answer_words)
+    print(f"stub latency {args.latency:.3f}s, fan-in {args.fan_in or synthesis.SYNTHESIS_FAN_IN}, "
+          f"budget {args.max_tokens or synthesis.SYNTHESIS_MAX_TOKENS} tokens, max concurrency {llm.LLM_MAX_CONCURRENCY}")
+    print(f"{'answers':>8} {'level':>6} {'inputs':>7} {'calls':>6} {'seconds':>8}")
+
+    for n_answers in args.answers:
+        async def run():
+            try:
+                return await synthesis.reduce_until_fits(
+                    [f"{position}: {answer}" for position in range(n_answers)],
+                    lambda text: app_module.aquery_pdf_content(text, app_module.MERGE_QUERY, use_cache=False),
+                    model="gpt-3.5-turbo", max_tokens=args.max_tokens, fan_in=args.fan_in, max_depth=args.max_depth,
+                )
+            finally:
+                await llm.aclose_clients()
+
+        start = time.perf_counter()
+        remaining, levels = asyncio.run(run())
+        total = time.perf_counter() - start
+        for level in levels:
+            print(f"{n_answers:>8} {level['level']:>6} {level['inputs']:>7} {level['calls']:>6} {level['seconds']:>8.3f}")
+        print(f"{n_answers:>8} {'total':>6} {len(remaining):>7} {'':>6} {total:>8.3f}")
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# benchmarks/bench_telemetry.py
+#
+# Overhead of the instrumentation in telemetry.py: the cost of one span, and
+# the added latency per request of the middleware on a minimal FastAPI app,
+# with the trace printed for every request and for none. Traces are printed
+# to /dev/null so the terminal isn't what's measured.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_telemetry --spans 200000 --requests 5000
+
+import argparse
+import asyncio
+import contextlib
+import os
+import time
+
+import httpx
+from fastapi import FastAPI
+
+import telemetry
+
+
+def build_app(instrumented):
+    app = FastAPI()
+    if instrumented:
+        telemetry.instrument(app, "bench")
+
+    @app.get("/items/{item_id}")
+    def read_item(item_id: int):
+        with telemetry.span("lookup"):
+            return {"id": item_id, "name": "item"}
+
+    return app
+
+
+async def time_requests(app, count):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for item_id in range(100):  # Warm up
+            await client.get(f"/items/{item_id}")
+        start = time.perf_counter()
+        for item_id in range(count):
+            await client.get(f"/items/{item_id}")
+        return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the overhead of spans and the telemetry middleware")
+    parser.add_argument("--spans", type=int, default=200000)
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    for _ in range(args.spans):
+        with telemetry.span("bench"):
+            pass
+    print(f"span outside a request: {(time.perf_counter() - start) / args.spans * 1e6:.2f}us")
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), telemetry.trace("bench"):
+        start = time.perf_counter()
+        for _ in range(args.spans):
+            with telemetry.span("bench"):
+                pass
+        per_span = (time.perf_counter() - start) / args.spans
+    print(f"span inside a request:  {per_span * 1e6:.2f}us (the first {telemetry.TRACE_MAX_SPANS} kept in the trace)")
+
+    print(f"\n{'app':<28} {'us/request':>11} {'overhead':>9}")
+    baseline = asyncio.run(time_requests(build_app(False), args.requests))
+    print(f"{'plain':<28} {baseline * 1e6:>11.1f} {'':>9}")
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = []
+        for rate in (0.0, 1.0):
+            telemetry.TRACE_SAMPLE_RATE = rate
+            results.append((rate, asyncio.run(time_requests(build_app(True), args.requests))))
+    for rate, seconds in results:
+        label = f"instrumented, {rate:.0%} traced"
+        print(f"{label:<28} {seconds * 1e6:>11.1f} {(seconds - baseline) * 1e6:>7.1f}us")
+
+
+if __name__ == "__main__":
+    main()
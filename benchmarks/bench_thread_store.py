@@ -0,0 +1,103 @@
+# benchmarks/bench_thread_store.py
+#
+# Per-operation latency of thread CRUD for one user holding 10 to 100k threads:
+# the old list-of-dicts scan against the indexed ThreadStore. Operations target
+# threads spread across the list, so scans pay their average cost.
+#
+# Run from the repository root:
+#     python -m benchmarks.bench_thread_store --sizes 10 1000 100000
+
+import argparse
+import random
+import time
+import uuid
+
+from thread_store import ThreadStore
+
+USER = "doctor"
+
+
+def make_thread(thread_id):
+    return {"id": thread_id, "doctor_name": "DocName", "user_id": USER, "content": ""}
+
+
+# The user_threads code the apps used before ThreadStore
+class ListStore:
+    def __init__(self):
+        self.user_threads = {}
+
+    def create(self, user_id, thread):
+        threads = self.user_threads.setdefault(user_id, [])
+        if any(existing['id'] == thread['id'] for existing in threads):
+            return False
+        threads.append(thread)
+        return True
+
+    def get(self, user_id, thread_id):
+        for thread in self.user_threads.get(user_id, []):
+            if thread['id'] == thread_id:
+                return thread
+        return None
+
+    def replace(self, user_id, thread_id, updated):
+        for index, thread in enumerate(self.user_threads.get(user_id, [])):
+            if thread['id'] == thread_id:
+                self.user_threads[user_id][index] = updated
+                return True
+        return False
+
+    def delete(self, user_id, thread_id):
+        for index, thread in enumerate(self.user_threads.get(user_id, [])):
+            if thread['id'] == thread_id:
+                return self.user_threads[user_id].pop(index)
+        return None
+
+
+def time_ops(store, ids, operations):
+    targets = random.sample(ids, min(operations, len(ids)))
+    timings = {}
+
+    start = time.perf_counter()
+    for thread_id in targets:
+        store.get(USER, thread_id)
+    timings["read"] = (time.perf_counter() - start) / len(targets)
+
+    start = time.perf_counter()
+    for thread_id in targets:
+        store.replace(USER, thread_id, make_thread(thread_id))
+    timings["update"] = (time.perf_counter() - start) / len(targets)
+
+    start = time.perf_counter()
+    for thread_id in targets:
+        store.delete(USER, thread_id)
+    timings["delete"] = (time.perf_counter() - start) / len(targets)
+
+    start = time.perf_counter()
+    for thread_id in targets:
+        store.create(USER, make_thread(thread_id))  # Includes the duplicate check
+    timings["create"] = (time.perf_counter() - start) / len(targets)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare thread CRUD latency as a user's thread count grows")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--operations", type=int, default=200, help="Operations timed per kind")
+    args = parser.parse_args()
+
+    print(f"{'threads':>8} {'store':>6} {'create (us)':>12} {'read (us)':>10} {'update (us)':>12} {'delete (us)':>12}")
+    for size in args.sizes:
+        ids = [uuid.uuid4() for _ in range(size)]
+        for name, store in (("list", ListStore()), ("index", ThreadStore())):
+            if isinstance(store, ListStore):
+                store.user_threads[USER] = [make_thread(thread_id) for thread_id in ids]  # Skip the O(n^2) fill
+            else:
+                for thread_id in ids:
+                    store.create(USER, make_thread(thread_id))
+            timings = time_ops(store, ids, args.operations)
+            print(f"{size:>8} {name:>6} {timings['create'] * 1e6:>12.2f} {timings['read'] * 1e6:>10.2f} "
+                  f"{timings['update'] * 1e6:>12.2f} {timings['delete'] * 1e6:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
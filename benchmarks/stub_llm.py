@@ -0,0 +1,160 @@
+# benchmarks/stub_llm.py
+#
+# Local stand-in for the OpenAI / Azure OpenAI chat completions endpoint.
+# Answers every POST with a canned completion after a fixed delay (streamed
+# word by word when the request sets "stream": true), so the services can be
+# benchmarked without network access or API keys. A share of the requests can
+# be failed with an error status, to measure the services when the API errors,
+# and a requests per minute quota can be enforced with 429s and Retry-After like
+# an Azure OpenAI deployment's.
+
+import json
+import math
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep connections alive like the real endpoint
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.server.latency)
+        self.server.request_count += 1
+
+        retry_after = self.server.over_quota()
+        if retry_after is not None:
+            self.server.throttled_count += 1
+            self._error(429, retry_after)
+            return
+
+        if self.server.error_rate and self.server.random.random() < self.server.error_rate:
+            self.server.error_count += 1
+            self._error(self.server.error_status)
+            return
+
+        prompt = payload.get("messages", [{}])[-1].get("content", "")
+        content = f"stub answer ({len(prompt)} chars)"
+
+        if payload.get("stream"):
+            self._stream(content)
+            return
+
+        body = json.dumps({
+            "choices": [
+                {"message": {"role": "assistant", "content": content}}
+            ]
+        }).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, retry_after=None):
+        body = json.dumps({"error": {"message": "stub error", "type": "server_error"}}).encode("utf-8")
+        self.send_response(status)
+        if retry_after is not None:
+            self.send_header("Retry-After", str(math.ceil(retry_after)))
+            self.send_header("retry-after-ms", str(int(retry_after * 1000)))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Server-sent events in the shape of the streaming chat completions API,
+    # one delta per word, sent with chunked transfer encoding
+    def _stream(self, content):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for word in content.split(" "):
+            delta = {"choices": [{"delta": {"content": word + " "}}]}
+            self._write_chunk(f"data: {json.dumps(delta)}\n\n".encode("utf-8"))
+            time.sleep(self.server.token_latency)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output clean
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.2, token_latency=0.02, error_rate=0.0, error_status=500, seed=0,
+                 requests_per_minute=0, quota_window=60):
+        super().__init__((host, port), StubLLMHandler)
+        self.latency = latency
+        self.token_latency = token_latency  # Delay between streamed deltas
+        self.error_rate = error_rate  # Share of requests answered with error_status instead of a completion
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.request_count = 0
+        self.error_count = 0
+        self.requests_per_minute = requests_per_minute  # Quota, 0 for none
+        self.quota_window = quota_window  # Seconds the quota is checked over, pro rata
+        self.throttled_count = 0
+        self._accepted = deque()  # Times of the requests accepted in the last minute
+        self._quota_lock = threading.Lock()
+        self._thread = None
+
+    # Seconds until the quota has room, or None after counting the request against it.
+    # Requests are counted over a sliding quota_window.
+    def over_quota(self):
+        if not self.requests_per_minute:
+            return None
+        with self._quota_lock:
+            now = time.monotonic()
+            while self._accepted and self._accepted[0] <= now - self.quota_window:
+                self._accepted.popleft()
+            if len(self._accepted) >= max(1, self.requests_per_minute * self.quota_window // 60):
+                return self._accepted[0] + self.quota_window - now
+            self._accepted.append(now)
+            return None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local stub chat completions server")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="Quota enforced with 429s; 0 for none")
+    parser.add_argument("--quota-window", type=float, default=60, help="Seconds the quota is checked over")
+    args = parser.parse_args()
+
+    server = StubLLMServer(port=args.port, latency=args.latency, token_latency=args.token_latency,
+                           error_rate=args.error_rate, error_status=args.error_status,
+                           requests_per_minute=args.requests_per_minute, quota_window=args.quota_window)
+    print(f"Stub LLM listening on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,236 @@
+# cache.py
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# SQLite file backing the on-disk tier of every cache; survives restarts
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "./cache.db")
+
+# Memory budget of the in-process LRU tier of the extracted text cache
+EXTRACTION_CACHE_MEMORY_BYTES = int(os.getenv("EXTRACTION_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+
+# Memory budget and lifetime (seconds) of cached LLM answers
+RESPONSE_CACHE_MEMORY_BYTES = int(os.getenv("RESPONSE_CACHE_MEMORY_BYTES", str(16 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Rows of cached LLM answers kept on disk; the oldest go first beyond it
+RESPONSE_CACHE_MAX_ROWS = int(os.getenv("RESPONSE_CACHE_MAX_ROWS", "200000"))
+
+# Expired rows and rows over the cap are purged from disk every this many writes
+PURGE_EVERY = 1000
+
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+_connection = None
+_connection_lock = threading.Lock()
+
+
+def _get_connection():
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False, timeout=30)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("PRAGMA synchronous=NORMAL")
+    return _connection
+
+
+# Two-tier string cache: an in-memory LRU bounded by total value size in front of a
+# SQLite table. Reads check memory first, then disk (promoting the value to memory).
+# With a ttl, entries older than ttl seconds are treated as missing and purged. With
+# max_disk_rows, the oldest rows beyond it are deleted as well when the table is purged
+# (at start and every PURGE_EVERY writes), so the table stays bounded under steady
+# traffic. Async code uses aget and aset, which run the SQLite calls in a worker thread so a
+# cache miss or write doesn't block the event loop.
+class TieredCache:
+    def __init__(self, name, max_memory_bytes, ttl=None, max_disk_rows=None):
+        self.name = name
+        self.max_memory_bytes = max_memory_bytes
+        self.ttl = ttl
+        self.max_disk_rows = max_disk_rows
+        self._memory = OrderedDict()  # key -> (value, created_at), least recently used first
+        self._memory_bytes = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.disk_evictions = 0
+
+        with _connection_lock:
+            connection = _get_connection()
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.name} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.name}_created_at ON {self.name} (created_at)")
+            connection.commit()
+        self.purge()
+
+    def _expired(self, created_at):
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def get(self, key):
+        found, value = self._memory_get(key)
+        if found:
+            return value
+        return self._disk_loaded(key, self._disk_get(key))
+
+    async def aget(self, key):
+        found, value = self._memory_get(key)
+        if found:
+            return value
+        return self._disk_loaded(key, await asyncio.to_thread(self._disk_get, key))
+
+    def set(self, key, value):
+        created_at = time.time()
+        self._disk_set(key, value, created_at)
+        if self._stored(key, value, created_at):
+            self.purge()
+
+    async def aset(self, key, value):
+        created_at = time.time()
+        await asyncio.to_thread(self._disk_set, key, value, created_at)
+        if self._stored(key, value, created_at):
+            await asyncio.to_thread(self.purge)
+
+    # (True, value) on a memory hit, (False, None) when the disk has to be checked
+    def _memory_get(self, key):
+        with self._lock:
+            if key in self._memory:
+                value, created_at = self._memory[key]
+                if not self._expired(created_at):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return True, value
+                self._forget(key)
+                self.expirations += 1
+        return False, None
+
+    def _disk_get(self, key):
+        with _connection_lock:
+            return _get_connection().execute(
+                f"SELECT value, created_at FROM {self.name} WHERE key = ?", (key,)
+            ).fetchone()
+
+    def _disk_loaded(self, key, row):
+        with self._lock:
+            if row is None or self._expired(row[1]):
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, row[0], row[1])
+        return row[0]
+
+    def _disk_set(self, key, value, created_at):
+        with _connection_lock:
+            connection = _get_connection()
+            connection.execute(
+                f"INSERT OR REPLACE INTO {self.name} (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, created_at),
+            )
+            connection.commit()
+
+    # Returns whether it's time to purge expired rows
+    def _stored(self, key, value, created_at):
+        with self._lock:
+            self._remember(key, value, created_at)
+            self._writes += 1
+            return self._writes % PURGE_EVERY == 0
+
+    # Delete expired rows from disk, then the oldest rows beyond max_disk_rows
+    def purge(self):
+        if self.ttl is None and self.max_disk_rows is None:
+            return
+        with _connection_lock:
+            connection = _get_connection()
+            if self.ttl is not None:
+                connection.execute(f"DELETE FROM {self.name} WHERE created_at < ?", (time.time() - self.ttl,))
+            evicted = 0
+            if self.max_disk_rows is not None:
+                (rows,) = connection.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()
+                if rows > self.max_disk_rows:
+                    evicted = connection.execute(
+                        f"DELETE FROM {self.name} WHERE key IN "
+                        f"(SELECT key FROM {self.name} ORDER BY created_at LIMIT ?)", (rows - self.max_disk_rows,)
+                    ).rowcount
+            connection.commit()
+        with self._lock:
+            self.disk_evictions += evicted
+
+    # Caller holds self._lock
+    def _remember(self, key, value, created_at):
+        size = len(value.encode("utf-8"))
+        if size > self.max_memory_bytes:
+            return  # Too large for the memory tier, served from disk only
+
+        self._forget(key)
+        self._memory[key] = (value, created_at)
+        self._memory_bytes += size
+
+        while self._memory_bytes > self.max_memory_bytes:
+            _, (evicted, _) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.encode("utf-8"))
+            self.evictions += 1
+
+    # Caller holds self._lock
+    def _forget(self, key):
+        if key in self._memory:
+            value, _ = self._memory.pop(key)
+            self._memory_bytes -= len(value.encode("utf-8"))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "disk_evictions": self.disk_evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+            }
+
+
+# Extracted document text, keyed by a hash of the uploaded bytes plus the extractor version
+extraction_cache = TieredCache("extracted_text", EXTRACTION_CACHE_MEMORY_BYTES)
+
+
+# digest is content_hash() of the file's bytes, computed while the upload is saved
+def extraction_key(digest, file_type, extractor_version):
+    return f"{digest}:{file_type}:{extractor_version}"
+
+
+# LLM answers, keyed by chunk content, normalized query, model and prompt template version
+response_cache = TieredCache("llm_responses", RESPONSE_CACHE_MEMORY_BYTES, ttl=RESPONSE_CACHE_TTL,
+                             max_disk_rows=RESPONSE_CACHE_MAX_ROWS)
+
+
+# Case, surrounding whitespace and trailing punctuation don't change the question
+def normalize_query(query):
+    return " ".join(query.lower().split()).rstrip("?.! ")
+
+
+def response_key(chunk_text, query, model, prompt_version):
+    return f"{content_hash(chunk_text)}:{content_hash(normalize_query(query))}:{model}:{prompt_version}"
+
+
+def stats():
+    return {
+        "extracted_text": extraction_cache.stats(),
+        "llm_responses": response_cache.stats(),
+    }
@@ -0,0 +1,221 @@
+# chunking.py
+
+import math
+import os
+import re
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to an estimate when tiktoken is not installed
+    tiktoken = None
+
+# Token budget each chunk is packed up to, and how many tokens of trailing
+# sentences are repeated at the start of the next chunk
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "1500"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "100"))
+
+DEFAULT_MODEL = "gpt-4o-mini"
+
+# Encodings for models tiktoken may not know by name (e.g. Azure deployment names)
+MODEL_ENCODINGS = {
+    "gpt-4o-mini": "o200k_base",
+    "gpt-4o": "o200k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-3.5-turbo": "cl100k_base",
+}
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+# Sentence end: ., ! or ? followed by whitespace and something that can start a sentence.
+# Decimals such as "0.08 g/dL" have no whitespace after the dot and are never split.
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(\[])")
+ESTIMATE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+# Rough BPE estimate used when the model's encoding is not available:
+# one token per punctuation mark and about four characters per token for words
+def estimate_tokens(text):
+    return sum(math.ceil(len(piece) / 4) for piece in ESTIMATE_PATTERN.findall(text))
+
+
+# Token counter for the target model; loading an encoding may need network access,
+# so any failure falls back to estimate_tokens
+@lru_cache(maxsize=None)
+def get_token_counter(model=DEFAULT_MODEL):
+    if tiktoken is not None:
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding(MODEL_ENCODINGS.get(model, "o200k_base"))
+            return lambda text: len(encoding.encode(text, disallowed_special=()))
+        except Exception as e:
+            print(f"Error loading the tokenizer for {model}, estimating tokens instead: {e}")
+    return estimate_tokens
+
+
+def count_tokens(text, model=DEFAULT_MODEL):
+    return get_token_counter(model)(text)
+
+
+def _split_units(text):
+    units = []
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        sentences = [sentence.strip() for sentence in SENTENCE_BREAK.split(paragraph)]
+        sentences = [sentence for sentence in sentences if sentence]
+        for position, sentence in enumerate(sentences):
+            units.append((sentence, position == len(sentences) - 1))
+    return units
+
+
+# Sentence-level units of text that arrives in pieces (pages, ...). feed returns the
+# (sentence, ends_paragraph) units a piece completes; the last sentence is held back
+# until the next piece arrives since it may continue there, and finish returns it.
+class SentenceSplitter:
+    def __init__(self):
+        self._pieces = []  # the held back text, as it arrived
+        self._size = 0
+        self._scan_from = 0  # no break starts before this offset of the held back text
+
+    # Held back text from offset start on, joining only the pieces it spans
+    def _text_from(self, start):
+        parts, size = [], self._size
+        for piece in reversed(self._pieces):
+            if size <= start:
+                break
+            parts.append(piece)
+            size -= len(piece)
+        return "".join(reversed(parts))[start - size:]
+
+    def feed(self, piece):
+        self._pieces.append(piece)
+        self._size += len(piece)
+        # A new break can only be in the new text or the whitespace (and the sentence
+        # end) just before it, so text without breaks isn't re-split on every piece
+        window = self._text_from(self._scan_from)
+        if not (PARAGRAPH_BREAK.search(window) or SENTENCE_BREAK.search(window)):
+            self._scan_from += max(len(window.rstrip()) - 1, 0)
+            return []
+
+        buffer = "".join(self._pieces)
+        units = _split_units(buffer)
+        if not units:
+            self._pieces, self._size, self._scan_from = [], 0, 0
+            return []
+        # Keep the tail (with any trailing blank line) so a break at the boundary is not lost
+        tail_start = buffer.rfind(units[-1][0])
+        tail = buffer[tail_start:] if tail_start >= 0 else units[-1][0]
+        self._pieces, self._size, self._scan_from = [tail], len(tail), max(len(tail.rstrip()) - 1, 0)
+        return units[:-1]
+
+    def finish(self):
+        units = _split_units("".join(self._pieces))
+        self._pieces, self._size, self._scan_from = [], 0, 0
+        return units
+
+
+# Sentence-level units from a stream of text pieces (whole text, pages, ...).
+# Yields (sentence, ends_paragraph).
+def iter_sentences(pieces):
+    if isinstance(pieces, str):
+        pieces = [pieces]
+
+    splitter = SentenceSplitter()
+    for piece in pieces:
+        yield from splitter.feed(piece)
+    yield from splitter.finish()
+
+
+# Split a sentence that is over budget on its own (tables, lab panels) at line and
+# word boundaries, so tokens are never cut in half
+def _split_long_unit(text, max_tokens, counter):
+    pieces = []
+    current = []
+    current_tokens = 0
+    for word in re.findall(r"\S+\s*", text):
+        word_tokens = counter(word)
+        if current and current_tokens + word_tokens > max_tokens:
+            pieces.append("".join(current).strip())
+            current, current_tokens = [], 0
+        current.append(word)
+        current_tokens += word_tokens
+    if current:
+        pieces.append("".join(current).strip())
+    return pieces
+
+
+def _join(units):
+    text = ""
+    for sentence, ends_paragraph in units:
+        text += sentence + ("\n\n" if ends_paragraph else " ")
+    return text.strip()
+
+
+# Streaming chunker: packs whole sentences into chunks of up to max_tokens tokens of the
+# target model, breaking on paragraph and sentence boundaries and repeating up to
+# overlap_tokens of trailing sentences at the start of the next chunk. Text is pushed in
+# with feed, which returns the chunks it completed, so a pipeline can send each chunk on
+# while the rest of the text is still being extracted; finish returns the last one.
+class Chunker:
+    def __init__(self, max_tokens=None, overlap_tokens=None, model=DEFAULT_MODEL):
+        self.max_tokens = max_tokens or CHUNK_MAX_TOKENS
+        overlap_tokens = CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+        self.overlap_tokens = min(overlap_tokens, self.max_tokens // 2)
+        self._counter = get_token_counter(model)
+        self._sentences = SentenceSplitter()
+        self._current = []  # (sentence, ends_paragraph, tokens)
+        self._current_tokens = 0
+        self._has_new_text = False  # False while current only holds overlap from the previous chunk
+
+    def feed(self, piece):
+        return self._add(self._sentences.feed(piece))
+
+    def finish(self):
+        chunks = self._add(self._sentences.finish())
+        if self._has_new_text:
+            chunks.append(_join((s, p) for s, p, _ in self._current))
+        self._current, self._current_tokens, self._has_new_text = [], 0, False
+        return chunks
+
+    def _add(self, sentences):
+        chunks = []
+        for sentence, ends_paragraph in sentences:
+            tokens = self._counter(sentence)
+            if tokens > self.max_tokens:
+                parts = _split_long_unit(sentence, self.max_tokens, self._counter)
+                units = [(part, ends_paragraph and i == len(parts) - 1, self._counter(part)) for i, part in enumerate(parts)]
+            else:
+                units = [(sentence, ends_paragraph, tokens)]
+
+            for unit in units:
+                if self._has_new_text and self._current_tokens + unit[2] > self.max_tokens:
+                    chunks.append(_join((s, p) for s, p, _ in self._current))
+
+                    # Carry trailing sentences over as overlap
+                    carried = []
+                    carried_tokens = 0
+                    for previous in reversed(self._current):
+                        if carried_tokens + previous[2] > self.overlap_tokens:
+                            break
+                        carried.insert(0, previous)
+                        carried_tokens += previous[2]
+                    self._current, self._current_tokens, self._has_new_text = carried, carried_tokens, False
+
+                while self._current and self._current_tokens + unit[2] > self.max_tokens:
+                    self._current_tokens -= self._current.pop(0)[2]  # Drop overlap that no longer fits
+
+                self._current.append(unit)
+                self._current_tokens += unit[2]
+                self._has_new_text = True
+        return chunks
+
+
+# The chunks of a whole text, or of a stream of text pieces, as a generator
+def iter_chunks(pieces, max_tokens=None, overlap_tokens=None, model=DEFAULT_MODEL):
+    if isinstance(pieces, str):
+        pieces = [pieces]
+
+    chunker = Chunker(max_tokens, overlap_tokens, model)
+    for piece in pieces:
+        yield from chunker.feed(piece)
+    yield from chunker.finish()
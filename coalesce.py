@@ -0,0 +1,138 @@
+# coalesce.py
+
+import asyncio
+import json
+
+import cache
+import llm
+import telemetry
+
+
+# Key of an analysis: the uploaded files (by content), the question as normalized for the
+# response cache, the model and any option that changes the result
+def analysis_key(digests, query, model, *options):
+    return cache.content_hash(json.dumps([sorted(digests), cache.normalize_query(query), model, *options]))
+
+
+# A computation in flight, shared by every caller with the same key
+class _Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+        self.joined = 0  # Callers after the first
+        self.llm_calls = [0]  # Calls made by the computation, see llm.count_calls
+        self.events = []  # Event pipelines: every (event, data) so far, replayed to late joiners
+        self.finished = False
+        self.error = None
+        self.changed = asyncio.Event()
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+# Single-flight: callers asking for the same key while it is being computed wait for that
+# computation instead of starting their own. The shared work runs in its own task, so a
+# caller that is cancelled (its client went away) only stops waiting; the work is
+# cancelled once no caller is left. Finished work is forgotten, the caches keep results.
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}  # key -> _Flight
+
+    def _find(self, key):
+        flight = self._flights.get(key)
+        # A flight of another event loop (a test client's, say) can't be awaited from this one
+        if flight is not None and flight.task.get_loop() is asyncio.get_running_loop():
+            telemetry.COALESCED.inc(self.name)
+            return flight
+        return None
+
+    def _start(self, key, flight):
+        self._flights[key] = flight
+
+        def finished(_):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if flight.joined and not flight.task.cancelled():
+                telemetry.LLM_CALLS_SAVED.inc(self.name, amount=flight.llm_calls[0] * flight.joined)
+
+        flight.task.add_done_callback(finished)
+
+    def _leave(self, flight):
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            flight.task.cancel()
+
+    async def _count(self, flight, work):
+        with llm.count_calls() as calls:
+            flight.llm_calls = calls
+            return await work
+
+    # Await factory() once for every concurrent caller with the same key
+    async def run(self, key, factory):
+        flight = self._find(key)
+        if flight is None:
+            flight = _Flight(None)
+            flight.task = asyncio.ensure_future(self._count(flight, factory()))
+            self._start(key, flight)
+        else:
+            flight.joined += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(flight)
+
+    async def _pump(self, flight, events):
+        try:
+            with llm.count_calls() as calls:
+                flight.llm_calls = calls
+                async for event in events:
+                    flight.events.append(event)
+                    flight._notify()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.finished = True
+            flight._notify()
+
+    # The events of the pipeline factory() as an async generator, with one pipeline run for
+    # every concurrent caller with the same key. A caller that joins late gets the events
+    # sent so far first, so every caller sees the whole stream; an exception raised by the
+    # pipeline is raised to each of them.
+    async def join(self, key, factory):
+        flight = self._find(key)
+        if flight is None:
+            flight = _Flight(None)
+            flight.task = asyncio.ensure_future(self._pump(flight, factory()))
+            self._start(key, flight)
+        else:
+            flight.joined += 1
+        flight.waiters += 1
+        try:
+            position = 0
+            while True:
+                changed = flight.changed
+                while position < len(flight.events):
+                    yield flight.events[position]
+                    position += 1
+                if flight.finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await changed.wait()
+        finally:
+            self._leave(flight)
+
+    def in_flight(self):
+        return len(self._flights)
+
+
+# Chat model calls (the same prompt to the same model, keyed like the response cache)
+llm_calls = SingleFlight("llm_call")
+
+# Whole document analyses (the same files and question)
+analyses = SingleFlight("analysis")
@@ -0,0 +1,85 @@
+# context.py
+
+import asyncio
+import os
+
+import chunking
+
+# Token budget of the rolling summary of earlier turns that follow-up questions carry
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "600"))
+
+SUMMARY_PROMPT = ("Summarize this conversation between a doctor and an assistant about the doctor's uploaded documents "
+                  "in at most {max_tokens} tokens. Keep every question asked and every finding, value, date, name, "
+                  "medication and dosage given in the answers.\n\n{conversation}")
+
+
+ANSWER_PROMPT = ("A doctor is asking about their uploaded documents. The conversation so far:\n{summary}\n\n"
+                 "Findings from the parts of the documents most relevant to the question:\n{answers}\n\n"
+                 "Using these findings and the conversation so far, answer the doctor's question: {query}")
+
+# Summary updates running in the background, by thread id
+_updates = {}
+
+
+# The answer of a follow-up turn. The chunks are asked the question alone, so their answers
+# are shared through the response cache; the conversation so far only goes into this one
+# final call (complete, uncached) over their answers. Without a summary yet, or when the
+# call fails, the chunk answers are joined as they are.
+async def answer_in_context(query, summary, answers, complete):
+    joined = "\n".join(answers)
+    if not summary or not answers:
+        return joined
+    try:
+        return await complete(ANSWER_PROMPT.format(summary=summary, answers=joined, query=query))
+    except Exception as e:
+        print(f"Error answering in the context of the conversation, using the chunk answers: {e}")
+        return joined
+
+
+# Fold a finished turn into the thread's rolling summary. Turns are kept verbatim while
+# they fit max_tokens; past that, complete(prompt) (one uncached model call that raises
+# on failure) compresses the summary and the new turn together. When that fails, or its
+# result is still over budget, the most recent max_tokens of the conversation are kept.
+async def update_summary(summary, query, answer, complete, model=chunking.DEFAULT_MODEL, max_tokens=None):
+    max_tokens = max_tokens or CONTEXT_SUMMARY_MAX_TOKENS
+    counter = chunking.get_token_counter(model)
+
+    turn = f"Q: {query}\nA: {answer}"
+    conversation = f"{summary}\n{turn}" if summary else turn
+    if counter(conversation) <= max_tokens:
+        return conversation
+
+    try:
+        compressed = await complete(SUMMARY_PROMPT.format(max_tokens=max_tokens, conversation=conversation))
+        if counter(compressed) <= max_tokens:
+            return compressed
+        conversation = compressed
+    except Exception as e:
+        print(f"Error summarizing the conversation, keeping its most recent part: {e}")
+
+    return list(chunking.iter_chunks(conversation, max_tokens=max_tokens, overlap_tokens=0, model=model))[-1]
+
+
+# update_summary in a background task, so a turn's answer is sent without waiting for the
+# summary call; save(summary) (a coroutine function) stores the result. The thread's next
+# turn waits for it with wait_for_summary before it reads the summary.
+def update_summary_later(thread_id, summary, query, answer, complete, save, model=chunking.DEFAULT_MODEL, max_tokens=None):
+    async def run():
+        try:
+            await save(await update_summary(summary, query, answer, complete, model, max_tokens))
+        except Exception as e:
+            print(f"Error saving the conversation summary: {e}")
+        finally:
+            if _updates.get(thread_id) is task:
+                del _updates[thread_id]
+
+    task = asyncio.ensure_future(run())
+    _updates[thread_id] = task
+    return task
+
+
+async def wait_for_summary(thread_id):
+    task = _updates.get(thread_id)
+    # A task of another event loop (a test client's, say) can't be awaited from this one
+    if task is not None and task.get_loop() is asyncio.get_running_loop():
+        await asyncio.shield(task)
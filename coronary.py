@@ -1,12 +1,26 @@
 import PyPDF2
 import openai
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Dict, List
+from typing import Dict, List, Optional
 import pandas as pd
 import csv
+import os
+import cache
+import chunking
+import coalesce
+import cpt
+import extraction
+import ingest
+import llm
+import patients
+import router
+import scheduler
+import streaming
+import synthesis
+import telemetry
 from uuid import UUID
 
 app = FastAPI()
@@ -20,6 +34,31 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request ids, timed spans of each stage and a Prometheus /metrics endpoint
+telemetry.instrument(app, "coronary")
+
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await llm.aclose_clients()
+
+
+@app.on_event("shutdown")
+def close_extraction_pool():
+    extraction.shutdown_pool()
+
+# Directory to save uploaded files
+UPLOAD_DIR = "uploaded_files"
+os.makedirs(UPLOAD_DIR, exist_ok=True)  # Create the directory if it doesn't exist
+
+# Transcripts of patient_personal_details(1).csv, answered from memory without the LLM
+patient_engine = patients.PatientEngine()
+
+
+@app.on_event("startup")
+def load_patient_data():
+    patient_engine.reload()
+
 # Set your OpenAI API key
 openai.api_key = ""  # Replace with your actual OpenAI API key
 
@@ -33,87 +72,212 @@ class Thread(BaseModel):
     user_id: str
     content: str
 
-# Function to extract text from a PDF file
-def extract_text_from_pdf(file):
-    pdf_text = ""
-    try:
-        pdf_reader = PyPDF2.PdfReader(file)
-        for page in pdf_reader.pages:
-            pdf_text += page.extract_text() or ""
-    except Exception as e:
-        print(f"Error reading the PDF file: {e}")
-    return pdf_text
+# Function to extract text from a PDF file, parsed in the extraction process pool
+# (large PDFs are split into page ranges that are parsed in parallel)
+async def extract_text_from_pdf(file):
+    return await extraction.aextract_pdf(file.read())
 
 # Functions for other file types (TXT, CSV, Excel) remain the same...
 
-# Function to split text into smaller chunks to fit token limits
-def split_text_into_chunks(text, chunk_size=1500):
-    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+# Function to split text into sentence-aware chunks that fit the model's token budget
+def split_text_into_chunks(text, max_tokens=None):
+    with telemetry.span("chunking", chars=len(text)) as attributes:
+        chunks = list(chunking.iter_chunks(text, max_tokens=max_tokens, model="gpt-4o-mini"))
+        attributes["chunks"] = len(chunks)
+    return chunks
 
-# Function to query OpenAI API with a single prompt
-def query_pdf_content(chunk_text, query):
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"Analyze the following document: {chunk_text}. Based on this text, answer the question: {query}."
-                }
-            ]
-        )
-        return response['choices'][0]['message']['content']
-    except Exception as e:
-        print(f"Error querying OpenAI API: {e}")
-        return f"Error querying OpenAI API: {e}"
-
-# Function to handle PDF content queries
-def query_pdf_content_in_chunks(combined_text, query):
-    chunks = split_text_into_chunks(combined_text)
+def build_chunk_request(chunk_text, query):
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {
+                "role": "user",
+                "content": f"Analyze the following document: {chunk_text}. Based on this text, answer the question: {query}."
+            }
+        ]
+    }
+
+# Bump when the chunk prompt changes so answers to the old prompt are not served from the cache
+PROMPT_VERSION = "1"
+
+# Function to query OpenAI API with a single chunk, over the shared keep-alive pool in llm.py.
+# Answers are cached by chunk, query, model and prompt version; use_cache=False skips
+# the lookup (the fresh answer still replaces the cached one).
+async def aquery_pdf_content(chunk_text, query, use_cache=True):
+    key = cache.response_key(chunk_text, query, "gpt-4o-mini", PROMPT_VERSION)
+    if use_cache:
+        cached_answer = await cache.response_cache.aget(key)
+        if cached_answer is not None:
+            return cached_answer
+
+    data = build_chunk_request(chunk_text, query)
+    async def call():
+        answer = await llm.apost_chat_completion(llm.OPENAI_CHAT_URL, llm.openai_headers(openai.api_key), data)
+        await cache.response_cache.aset(key, answer)
+        return answer
+
+    # The same prompt already in flight for another request is waited for, not sent again
+    return await coalesce.llm_calls.run(key, call)
+
+# Streaming version of aquery_pdf_content: yields the answer piece by piece as the model
+# produces it. A cached answer is yielded whole; the streamed answer is cached once complete.
+async def astream_pdf_content(chunk_text, query, use_cache=True):
+    key = cache.response_key(chunk_text, query, "gpt-4o-mini", PROMPT_VERSION)
+    if use_cache:
+        cached_answer = await cache.response_cache.aget(key)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+
+    data = build_chunk_request(chunk_text, query)
+    answer = ""
+    async for token in llm.astream_chat_completion(llm.OPENAI_CHAT_URL, llm.openai_headers(openai.api_key), data):
+        answer += token
+        yield token
+
+    await cache.response_cache.aset(key, answer)
+
+# Instructions for merging a batch of chunk answers when they are too many for one final call
+MERGE_QUERY = "combine these partial findings into one consolidated set of findings. Keep every fact, date, name, finding, medication and dosage, and drop only repetition"
+
+# Instructions for the final synthesis over the combined chunk answers
+FINAL_REPORT_QUERY = """generate a final report..."""  # Full instructions for coroner's report
+
+# Extraction stage of the report pipeline: a "progress" event as each upload starts, then
+# its text as "text" events, page by page as the pages are parsed
+async def iter_upload_text(uploads):
+    for position, (filename, path) in enumerate(uploads):
+        yield "progress", {"stage": "extracting", "file": filename, "index": position, "files": len(uploads)}
+        try:
+            async for page in extraction.aiter_pdf_pages(path):
+                yield "text", page
+        except TimeoutError:
+            yield "error", {"error": f"Timed out extracting text from the file: {filename}", "status_code": 504}
+            return
+        yield "text", "\n"
+
+# Report pipeline as an event stream: extraction progress, each chunk
+# answer as it completes, then the tokens of the final report as the model produces them.
+# Chunks are queried as soon as the pages they come from are extracted, while the rest of
+# the uploads are still being read. uploads is a list of (filename, path) of the files
+# saved before the response started.
+async def stream_query_pdf_content_in_chunks(uploads, query, use_cache=True):
+    scheduler.set_lane("bulk")  # Reports wait behind interactive chat turns for the rate limits
     responses = []
+    chunker = chunking.Chunker(model="gpt-4o-mini")
+    async for event in streaming.stream_pipelined_chunk_answers(iter_upload_text(uploads), chunker, lambda chunk: aquery_pdf_content(chunk, query, use_cache), responses):
+        yield event
+        if event[0] == "error":
+            return
+
+    yield "progress", {"stage": "reducing", "answers": len(responses)}
+    responses, levels = await synthesis.reduce_until_fits(responses, lambda text: aquery_pdf_content(text, MERGE_QUERY, use_cache), model="gpt-4o-mini")
+    for level in levels:
+        yield "progress", dict(level, stage="reduced")
+
+    yield "progress", {"stage": "synthesizing"}
+    final_response = ""
+    async for token in astream_pdf_content("\n".join(responses), FINAL_REPORT_QUERY, use_cache):
+        final_response += token
+        yield "token", {"content": token}
 
-    for chunk in chunks:
-        response = query_pdf_content(chunk, query)
-        responses.append(response)
+    yield "done", {"query": query, "answer": final_response}
 
-    combined_response = "\n".join(responses)
+# Answer a question the router sent to the patient data or the CPT code list
+def answer_routed_query(decision):
+    name, params = decision["name"], decision["params"]
+    if router.ROUTES[name] == "patients":
+        table = patient_engine.table
+        start = patients.parse_time(params.get("start"))
+        end = patients.parse_time(params.get("end"), end=True)
+        if name == "patient_transcripts":
+            return {"patient_id": params["patient_id"], "transcripts": table.by_patient(params["patient_id"], start, end)}
+        if name == "patient_count":
+            return dict(table.count(params["patient_id"], start, end), patient_id=params["patient_id"])
+        if name == "top_patients":
+            return {"top_patients": table.top_patients(params["n"])}
+        return {"transcripts": table.in_range(start, end, params["limit"])}
 
-    final_response = query_pdf_content(combined_response, """generate a final report...""")  # Full instructions for coroner's report
+    matcher = cpt.get_matcher()
+    if name == "cpt_code":
+        return {"code": params["code"], "label": matcher.code_labels.get(params["code"]), "codes": matcher.label_codes(params["code"])}
+    return {"text": params["text"], "matches": matcher.match(params["text"])}
 
-    return final_response
+# The router's decision as the first event of a document answer stream
+async def stream_with_route(decision, events):
+    yield "route", decision
+    async for event in events:
+        yield event
+
+def parse_time_param(value, end=False):
+    try:
+        return patients.parse_time(value, end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid time: {value}. Use YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+
+# API to list the patients with the most transcripts
+@app.get("/patients/top")
+def read_top_patients(n: int = Query(10, ge=1)):
+    return patient_engine.table.top_patients(n)
+
+# API to list every patient's transcripts between two times, newest first
+@app.get("/patients/transcripts")
+def read_transcripts(start: Optional[str] = None, end: Optional[str] = None, limit: Optional[int] = Query(None, ge=1), include_text: bool = True):
+    return patient_engine.table.in_range(parse_time_param(start), parse_time_param(end, end=True), limit, include_text=include_text)
+
+# API to list one patient's transcripts, newest first
+@app.get("/patients/{patient_id}/transcripts")
+def read_patient_transcripts(patient_id: str, start: Optional[str] = None, end: Optional[str] = None, limit: Optional[int] = Query(None, ge=1), include_text: bool = True):
+    table = patient_engine.table
+    if patient_id not in table.rows_by_patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    return table.by_patient(patient_id, parse_time_param(start), parse_time_param(end, end=True), limit, include_text=include_text)
+
+# API to reload the patient data now instead of at the next change check
+@app.post("/patients/reload")
+def reload_patient_data():
+    reloaded = patient_engine.reload(force=True)
+    return {"reloaded": reloaded, "transcripts": len(patient_engine.table)}
 
 @app.post("/upload_and_query/")
 async def upload_and_query(
-    files: List[UploadFile] = File(...), 
+    files: Optional[List[UploadFile]] = File(None),  # Not needed for questions about patients or CPT codes
     query: str = Form(...),
-    user_id: str = Form(...)
+    user_id: str = Form(...),
+    no_cache: bool = Form(False),  # Skip cached answers for this request
+    stream: bool = Form(False)  # Answer as a text/event-stream instead of one JSON body
 ):
-    # Check for specific queries that should not trigger PDF processing
-    if "patient id" in query.lower() or "top" in query.lower():
-     
-        return JSONResponse(content={"query": query, "result": "Placeholder result based on database logic"}, status_code=200)
+    # Questions about patients or CPT codes are answered locally, without the documents or the LLM
+    decision = router.route(query, patient_engine.table.rows_by_patient, documents=bool(files))
+    if decision["name"] != "documents":
+        return JSONResponse(content={"query": query, "route": decision, "result": answer_routed_query(decision)}, status_code=200)
 
-    combined_text = ""
+    if not files:
+        return JSONResponse(content={"error": "Upload the documents to ask about, or ask about a patient id, the top patients, "
+                                              "a time range or a CPT code.", "route": decision}, status_code=400)
 
     for file in files:
-        filename = file.filename.lower()
-
-        # Handle PDF files
-        if filename.endswith(".pdf"):
-            pdf_text = extract_text_from_pdf(file.file)
-            combined_text += pdf_text + "\n"
-        
-        # Handle other file types (TXT, CSV, Excel)...
-        
-        else:
+        if not file.filename.lower().endswith(".pdf"):
             return JSONResponse(content={"error": f"Unsupported file type: {file.filename}"}, status_code=400)
 
-    if not combined_text:
-        return JSONResponse(content={"error": "None of the provided files contain extractable text."}, status_code=400)
+    # Uploads are closed once the handler returns, so save them before streaming. Each is
+    # copied to disk block by block under its content hash, hashed on the way.
+    uploads, digests = [], []
+    for file in files:
+        path, digest, _ = await ingest.save_upload_by_digest(file, UPLOAD_DIR)
+        uploads.append((file.filename, path))
+        digests.append(digest)
+
+    # Requests for the same files and question while one is being answered share its analysis
+    key = coalesce.analysis_key(digests, query, "gpt-4o-mini", not no_cache)
+    events = coalesce.analyses.join(key, lambda: stream_query_pdf_content_in_chunks(uploads, query, use_cache=not no_cache))
 
-    answer = query_pdf_content_in_chunks(combined_text, query)
-    
-    return {"query": query, "answer": answer}
+    if stream:
+        return streaming.sse_response(stream_with_route(decision, events))
+    result = await streaming.final_json(events)
+    if isinstance(result, dict):
+        return dict(result, route=decision)
+    return result
 
 if __name__ == "__main__":
     import uvicorn
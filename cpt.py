@@ -0,0 +1,175 @@
+# cpt.py
+
+import csv
+import os
+import re
+import threading
+
+# CPT codes and their short labels, one per row (CPTCodes,label)
+CPT_CODES_PATH = os.getenv("CPT_CODES_PATH", "cpt4.csv")
+
+# Extra words a label's terms may be spread over in the text, beyond the label's own length
+CPT_WINDOW_SLACK = int(os.getenv("CPT_WINDOW_SLACK", "2"))
+
+WORD_PATTERN = re.compile(r"[A-Za-z0-9]+")
+
+# Code-shaped words: five digits, or four digits and a category letter (F, T or U)
+CODE_PATTERN = re.compile(r"\b(\d{4}[0-9FTU])\b")
+
+# Words that carry no meaning in a procedure label
+STOPWORDS = frozenset("a an and as at by for from in into of on or the to w wo with without".split())
+
+# Abbreviations used in the short CPT labels, spelled out as they appear in reports
+ABBREVIATIONS = {
+    "tx": "treatment", "dx": "diagnostic", "rpr": "repair", "repr": "repair", "inj": "injection",
+    "cath": "catheter", "endovasc": "endovascular", "prosth": "prosthesis", "stimul": "stimulation",
+    "photocoagulat": "photocoagulation", "vasc": "vascular", "ur": "urine", "rad": "radiology",
+    "fx": "fracture", "bx": "biopsy", "abd": "abdomen", "revis": "revision", "recon": "reconstruction",
+}
+
+# Terms are compared by their first STEM_LENGTH characters, so "treat", "treated" and
+# "treatment" are the same term
+STEM_LENGTH = 5
+
+
+# (word, term, start, end) for every meaningful word of the text, with character offsets.
+# word is the lowercased word with abbreviations spelled out, term its stem.
+def iter_terms(text):
+    for match in WORD_PATTERN.finditer(text):
+        word = match.group().lower()
+        if word not in STOPWORDS:
+            word = ABBREVIATIONS.get(word, word)
+            yield word, word[:STEM_LENGTH], match.start(), match.end()
+
+
+# Matches CPT labels and codes in text. Labels are compiled once into an inverted index
+# from term to (label, slot); a scan then walks the text's terms once, recording for each
+# label touched where each of its terms was last seen. A label matches when all its terms
+# have been seen within a window of its length plus CPT_WINDOW_SLACK terms, in any order.
+# Codes are grouped by their normalized label (lowercased, abbreviations spelled out,
+# stopwords dropped), so every code labelled "Treat humerus fracture" comes back together,
+# from a label match and from a written-out code alike. One-word labels ("Cervicography")
+# are indexed by the whole word rather than its stem, so a stem alone ("cervical") can't
+# match them.
+class CPTMatcher:
+    def __init__(self, rows):
+        self.labels = []  # Label text as in the file
+        self.codes = []  # Codes of each label
+        self.label_terms = []  # Distinct terms of each label
+        self.postings = {}  # term, or whole word for one-word labels -> [(label position, slot of the term)]
+        self.code_labels = {}  # code -> label text
+        self.code_positions = {}  # code -> label position
+        by_label = {}  # normalized label -> label position
+
+        for code, label in rows:
+            self.code_labels[code] = label
+            words = list(iter_terms(label))
+            terms = tuple(dict.fromkeys(word if len(words) == 1 else term for word, term, _, _ in words))
+            if not terms:
+                continue
+            normalized = " ".join(word for word, _, _, _ in words)
+            position = by_label.get(normalized)
+            if position is None:
+                position = by_label[normalized] = len(self.labels)
+                self.labels.append(label)
+                self.codes.append([])
+                self.label_terms.append(terms)
+                for slot, term in enumerate(terms):
+                    self.postings.setdefault(term, []).append((position, slot))
+            self.codes[position].append(code)
+            self.code_positions[code] = position
+
+    def __len__(self):
+        return len(self.code_labels)
+
+    # Every code with the same normalized label as code, code first
+    def label_codes(self, code):
+        position = self.code_positions.get(code)
+        if position is None:
+            return [code] if code in self.code_labels else []
+        return [code] + [other for other in self.codes[position] if other != code]
+
+    # Codes written out in the text, e.g. "CPT 24500", with the others of their label
+    def _code_mentions(self, text):
+        return [{"codes": self.label_codes(match.group(1)), "label": self.code_labels[match.group(1)], "start": match.start(1),
+                 "end": match.end(1), "kind": "code"}
+                for match in CODE_PATTERN.finditer(text) if match.group(1) in self.code_labels]
+
+    def _label_matches(self, text):
+        matches = []
+        seen = {}  # label position -> ([term index of each slot's last occurrence], [its start offset])
+        postings = self.postings
+        index = -1
+
+        # iter_terms inlined: this loop runs once per word of the document
+        for match in WORD_PATTERN.finditer(text):
+            word = match.group().lower()
+            if word in STOPWORDS:
+                continue
+            index += 1
+            word = ABBREVIATIONS.get(word, word)
+            term = word[:STEM_LENGTH]
+            hits = postings.get(term)
+            if word != term and word in postings:
+                hits = (hits or []) + postings[word]
+            if not hits:
+                continue
+
+            for position, slot in hits:
+                state = seen.get(position)
+                if state is None:
+                    state = seen[position] = ([-1] * len(self.label_terms[position]), [0] * len(self.label_terms[position]))
+                last, starts = state
+                last[slot] = index
+                starts[slot] = match.start()
+                first = min(last)
+                if first >= 0 and index - first < len(last) + CPT_WINDOW_SLACK:
+                    matches.append({"codes": self.codes[position], "label": self.labels[position],
+                                    "start": starts[last.index(first)], "end": match.end(), "kind": "label", "terms": len(last)})
+                    del seen[position]  # The next match of this label needs all its terms again
+        return matches
+
+    # Matches as dicts with the codes, the label, the character offsets of the matched
+    # text and the kind ("code" for a written-out code, "label" for a label), in text order.
+    # A label match inside a longer label's match is dropped in favour of the longer one.
+    def match(self, text):
+        labels = self._label_matches(text)
+        labels.sort(key=lambda match: (match["start"], -match["end"], -match["terms"]))
+        kept = []
+        active = []  # Earlier matches that may still cover the current one
+        for match in labels:
+            active = [other for other in active if other["end"] >= match["start"]]
+            if not any(other["end"] >= match["end"] and other["terms"] > match["terms"] for other in active):
+                kept.append(match)
+            active.append(match)
+        for match in kept:
+            del match["terms"]
+
+        matches = self._code_mentions(text) + kept
+        matches.sort(key=lambda match: (match["start"], match["end"]))
+        return matches
+
+
+def load_matcher(path):
+    rows = []
+    with open(path, encoding="utf-8", errors="replace", newline="") as file:
+        reader = csv.reader(file)
+        next(reader, None)  # Header
+        for row in reader:
+            if len(row) >= 2 and row[0].strip() and row[1].strip():
+                rows.append((row[0].strip(), row[1].strip()))
+    return CPTMatcher(rows)
+
+
+_matcher = None
+_matcher_lock = threading.Lock()
+
+
+# The matcher for CPT_CODES_PATH, compiled on first use
+def get_matcher():
+    global _matcher
+    if _matcher is None:
+        with _matcher_lock:
+            if _matcher is None:
+                _matcher = load_matcher(CPT_CODES_PATH)
+    return _matcher
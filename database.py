@@ -1,16 +1,90 @@
 # database.py
 
-from sqlalchemy import create_engine, Column, String, Text, JSON
+from sqlalchemy import create_engine, event, inspect, null, select, text, func, Column, ForeignKey, Index, Integer, String, Text, JSON
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.dialects.postgresql import UUID as PG_UUID
+import asyncio
+import contextlib
 import os
 import uuid
 
+import telemetry
+
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")  # Change to your database URL
 
-engine = create_engine(DATABASE_URL)
+# Async drivers for the request handlers; the sync engine is kept for startup migrations and scripts
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+def to_async_url(url):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+
+# Connection pool sizing. SQLite takes one writer at a time, so extra connections there
+# mostly serve reads that WAL lets run alongside the writer.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# SQLite settings applied to every new connection. WAL lets readers run while a write is in
+# progress, NORMAL sync is durable across application crashes in WAL mode, and the busy
+# timeout makes concurrent writers wait for the lock instead of failing with "database is locked".
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "16384"))
+
+def pool_options(url):
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}  # In-memory databases live in one connection and are not pooled
+    return {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE, "pool_pre_ping": url.get_backend_name() != "sqlite"}
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+engine = create_engine(DATABASE_URL, **pool_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Sessions for async handlers; expire_on_commit=False so rows stay readable after commit
+# without a lazy load, which async sessions cannot do
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_options(ASYNC_DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+for sqlite_engine in (engine, async_engine.sync_engine):
+    if sqlite_engine.dialect.name == "sqlite":
+        event.listen(sqlite_engine, "connect", set_sqlite_pragmas)
+
+# SQLite allows one writer at a time. Writers in this process queue on a lock instead of
+# waiting out the busy timeout, which polls the file lock with sleeps of up to 100ms.
+sqlite_write_lock = asyncio.Lock() if async_engine.dialect.name == "sqlite" else contextlib.nullcontext()
+
+# Run the writes of the block in one transaction, committed at the end and rolled back on error.
+# Start it with no read transaction open on the session: a SQLite read transaction cannot
+# be upgraded to a write once another connection has committed.
+@contextlib.asynccontextmanager
+async def write_transaction(db):
+    async with sqlite_write_lock:
+        try:
+            yield db
+            with telemetry.span("db.commit"):
+                await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
 Base = declarative_base()
 
 class ThreadDB(Base):
@@ -20,8 +94,94 @@ class ThreadDB(Base):
     doctor_name = Column(String, index=True)
     user_id = Column(String, index=True)
     content = Column(Text)
-    messages = Column(JSON)  # To store messages as JSON
+    messages = Column(JSON)  # Legacy message list; messages now live in MessageDB (see migrate_json_messages)
     uploaded_files = Column(JSON)  # To store file paths as JSON
+    search_index = Column(JSON)  # BM25 index over the thread's chunks (see retrieval.py)
+    file_digests = Column(JSON)  # Content hashes of the files already in the index
+    summary = Column(Text)  # Rolling summary of the conversation (see context.py)
+
+# One row per chat message. Turns are appended with the next seq of their thread, so adding
+# a message never rewrites the conversation; (thread_id, seq) serves ordered, paged reads.
+class MessageDB(Base):
+    __tablename__ = "messages"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    thread_id = Column(PG_UUID(as_uuid=True), ForeignKey("threads.id"), nullable=False)
+    seq = Column(Integer, nullable=False)
+    user_id = Column(String)
+    content = Column(Text)
+
+    __table_args__ = (Index("ix_messages_thread_id_seq", "thread_id", "seq", unique=True),)
 
 # Create the database tables
 Base.metadata.create_all(bind=engine)
+
+# Add columns introduced after a table was first created; create_all() only creates missing tables
+def add_missing_columns():
+    existing = {column["name"] for column in inspect(engine).get_columns(ThreadDB.__tablename__)}
+    with engine.begin() as connection:
+        for column in ThreadDB.__table__.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f"ALTER TABLE {ThreadDB.__tablename__} ADD COLUMN {column.name} {column_type}"))
+
+add_missing_columns()
+
+
+# Locks the thread's row until the transaction ends, so concurrent appends to one thread
+# take their seqs one after the other. SQLite has no row locks (SQLAlchemy leaves out the
+# FOR UPDATE); there writers are already serialized by sqlite_write_lock.
+def lock_thread_query(thread_id):
+    return select(ThreadDB.id).where(ThreadDB.id == thread_id).with_for_update()
+
+def last_seq_query(thread_id):
+    return select(func.max(MessageDB.seq)).where(MessageDB.thread_id == thread_id)
+
+def message_rows(thread_id, last_seq, messages):
+    next_seq = 0 if last_seq is None else last_seq + 1
+    return [MessageDB(thread_id=thread_id, seq=next_seq + offset, user_id=message["user_id"], content=message["content"])
+            for offset, message in enumerate(messages)]
+
+def messages_query(thread_id, after=None, limit=None):
+    query = select(MessageDB).where(MessageDB.thread_id == thread_id)
+    if after is not None:
+        query = query.where(MessageDB.seq > after)
+    query = query.order_by(MessageDB.seq)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+# Insert messages (dicts with user_id and content) at the end of a thread; the caller commits.
+# The next seq comes from the (thread_id, seq) index, so the cost doesn't grow with the thread.
+def append_messages(db, thread_id, messages):
+    db.execute(lock_thread_query(thread_id))
+    rows = message_rows(thread_id, db.scalar(last_seq_query(thread_id)), messages)
+    db.add_all(rows)
+    return rows
+
+# Up to limit messages of a thread with seq greater than after, oldest first
+def read_messages(db, thread_id, after=None, limit=None):
+    return db.scalars(messages_query(thread_id, after, limit)).all()
+
+# Async versions of the two above for AsyncSessionLocal sessions
+async def aappend_messages(db, thread_id, messages):
+    await db.execute(lock_thread_query(thread_id))
+    rows = message_rows(thread_id, await db.scalar(last_seq_query(thread_id)), messages)
+    db.add_all(rows)
+    return rows
+
+async def aread_messages(db, thread_id, after=None, limit=None):
+    return (await db.scalars(messages_query(thread_id, after, limit))).all()
+
+# Move messages still stored in the legacy JSON column into the messages table, one thread
+# per transaction; the column is cleared afterwards so a thread is only migrated once
+def migrate_json_messages():
+    with SessionLocal() as db:
+        thread_ids = [thread_id for (thread_id,) in db.query(ThreadDB.id).filter(ThreadDB.messages.isnot(None))]
+        for thread_id in thread_ids:
+            thread = db.get(ThreadDB, thread_id)
+            append_messages(db, thread_id, thread.messages or [])
+            thread.messages = null()  # SQL NULL; plain None would be stored as JSON null
+            db.commit()
+
+migrate_json_messages()
@@ -0,0 +1,294 @@
+# extraction.py
+
+import asyncio
+import collections
+import hashlib
+import io
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+import PyPDF2
+
+try:
+    import pdf2image
+    import pytesseract
+except ImportError:  # OCR of scanned pages is off without them
+    pdf2image = pytesseract = None
+
+import cache
+import telemetry
+
+# Worker processes for PDF and Excel parsing; 0 parses inline on the calling thread
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Seconds one file may take to extract before the request gives up on it
+EXTRACTION_TIMEOUT = float(os.getenv("EXTRACTION_TIMEOUT", "120"))
+
+# PDFs with more pages than this are split into ranges of this many pages, parsed in parallel
+EXTRACTION_PAGES_PER_TASK = int(os.getenv("EXTRACTION_PAGES_PER_TASK", "16"))
+
+# Page ranges of a PDF being read page by page that are parsed ahead of the reader; when
+# the reader falls behind (its chunks wait for the model), no more pages are parsed
+EXTRACTION_PREFETCH = int(os.getenv("EXTRACTION_PREFETCH", str(max(1, EXTRACTION_WORKERS))))
+
+# Pages whose text layer has fewer non-blank characters than this are taken for scans
+# and OCR'd; 0 turns OCR off
+OCR_MIN_CHARS = int(os.getenv("OCR_MIN_CHARS", "20"))
+
+# Resolution scanned pages are rendered at for OCR, and the Tesseract language(s)
+OCR_DPI = int(os.getenv("OCR_DPI", "300"))
+OCR_LANGUAGE = os.getenv("OCR_LANGUAGE", "eng")
+
+OCR_ENABLED = OCR_MIN_CHARS > 0 and pytesseract is not None
+
+# Part of the extractor versions the apps key cached text by: text extracted with OCR
+# differs from text extracted without it, or at another resolution
+OCR_VERSION = f"ocr-{OCR_DPI}-{OCR_LANGUAGE}" if OCR_ENABLED else "ocr-off"
+
+_pool = None
+
+
+# Workers are spawned rather than forked so they don't inherit the event loop and the
+# HTTP client threads of the server process
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
+
+
+# The functions below run in the worker processes, so they only take and return picklable values.
+# source is the file's bytes or, better, the path of the saved upload: workers then read
+# only the pages they parse instead of receiving a copy of the whole file.
+
+def _open(source):
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+
+def count_pdf_pages(source):
+    return len(PyPDF2.PdfReader(_open(source)).pages)
+
+
+def read_pdf_page_texts(source, start=0, stop=None):
+    pages = PyPDF2.PdfReader(_open(source)).pages
+    stop = len(pages) if stop is None else min(stop, len(pages))
+    return [pages[number].extract_text() or "" for number in range(start, stop)]
+
+
+def read_pdf_pages(source, start=0, stop=None):
+    return "".join(read_pdf_page_texts(source, start, stop))
+
+
+# Hash of one page's content (its text, fonts and images), the same wherever the page
+# appears: the page written out as a PDF of its own
+def _page_digest(page):
+    writer = PyPDF2.PdfWriter()
+    writer.add_page(page)
+    data = io.BytesIO()
+    writer.write(data)
+    return hashlib.sha256(data.getvalue()).hexdigest()
+
+
+# Pages start to stop as (text, digest): digest is None for pages with a text layer,
+# and the page's content hash for pages that need OCR
+def read_pdf_page_layers(source, start=0, stop=None):
+    pages = PyPDF2.PdfReader(_open(source)).pages
+    stop = len(pages) if stop is None else min(stop, len(pages))
+    layers = []
+    for number in range(start, stop):
+        text = pages[number].extract_text() or ""
+        scanned = OCR_ENABLED and len("".join(text.split())) < OCR_MIN_CHARS
+        layers.append((text, _page_digest(pages[number]) if scanned else None))
+    return layers
+
+
+# Render page number of a PDF at dpi and read its text with Tesseract
+def ocr_pdf_page(source, number, dpi=None):
+    options = {"dpi": dpi or OCR_DPI, "first_page": number + 1, "last_page": number + 1}
+    if isinstance(source, bytes):
+        images = pdf2image.convert_from_bytes(source, **options)
+    else:
+        images = pdf2image.convert_from_path(source, **options)
+    return "".join(pytesseract.image_to_string(image, lang=OCR_LANGUAGE) for image in images)
+
+
+def ocr_key(digest):
+    return f"{digest}:page:{OCR_VERSION}"
+
+
+# Text of the pages start to stop with scanned pages OCR'd one after the other, for
+# callers already in a worker process (batch.py); OCR'd text is cached like aocr_pages does
+def read_pdf_text(source, start=0, stop=None):
+    texts = []
+    for number, (text, digest) in enumerate(read_pdf_page_layers(source, start, stop), start):
+        if digest is not None:
+            ocr_text = cache.extraction_cache.get(ocr_key(digest))
+            if ocr_text is None:
+                try:
+                    ocr_text = ocr_pdf_page(source, number)
+                except Exception as e:
+                    print(f"Error reading page {number + 1} of the PDF file with OCR: {e}")
+                    ocr_text = ""
+                if ocr_text:
+                    cache.extraction_cache.set(ocr_key(digest), ocr_text)
+            text = ocr_text or text
+        texts.append(text)
+    return "".join(texts)
+
+
+def read_excel(source):
+    return pd.read_excel(_open(source)).to_string(index=False)
+
+
+# Workers resolve relative paths against their own working directory, so pass absolute ones
+def _resolve(source):
+    return os.path.abspath(source) if isinstance(source, str) else source
+
+
+async def _run(function, *args):
+    if EXTRACTION_WORKERS <= 0:
+        return function(*args)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_pool(), function, *args)
+    except BrokenProcessPool:
+        shutdown_pool()  # A worker died (e.g. out of memory); start a fresh pool next time
+        raise
+
+
+# Replace the text of the scanned pages among layers (from read_pdf_page_layers for the
+# pages from start) with their OCR'd text: from the cache, by page content, or OCR'd in
+# the worker pool, all pages in parallel. A page OCR fails on keeps its text layer.
+async def aocr_pages(source, start, layers):
+    async def page_text(number, text, digest):
+        if digest is None:
+            return text
+        key = ocr_key(digest)
+        ocr_text = await cache.extraction_cache.aget(key)
+        if ocr_text is None:
+            with telemetry.span("extraction.ocr", page=number) as attributes:
+                try:
+                    ocr_text = await _run(ocr_pdf_page, source, number, OCR_DPI)
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    print(f"Error reading page {number + 1} of the PDF file with OCR: {e}")
+                    return text
+                attributes["chars"] = len(ocr_text)
+            if ocr_text:
+                await cache.extraction_cache.aset(key, ocr_text)
+        return ocr_text or text
+
+    return await asyncio.gather(*(page_text(number, text, digest) for number, (text, digest) in enumerate(layers, start)))
+
+
+# Texts of pages start to stop of a PDF, scanned pages OCR'd
+async def _read_pages(source, start, stop):
+    return await aocr_pages(source, start, await _run(read_pdf_page_layers, source, start, stop))
+
+
+# Pages start to stop of a PDF, timed as one "extraction.pages" span
+async def _extract_pages(source, start, stop):
+    with telemetry.span("extraction.pages", start=start, stop=stop) as attributes:
+        text = "".join(await _read_pages(source, start, stop))
+        attributes["chars"] = len(text)
+    return text
+
+
+# Page ranges of a PDF are extracted in parallel and joined back in page order
+async def _extract_pdf(source, attributes):
+    page_count = attributes["pages"] = await _run(count_pdf_pages, source)
+    if page_count <= EXTRACTION_PAGES_PER_TASK:
+        return await _extract_pages(source, 0, page_count)
+
+    ranges = range(0, page_count, EXTRACTION_PAGES_PER_TASK)
+    parts = await asyncio.gather(*(_extract_pages(source, start, min(start + EXTRACTION_PAGES_PER_TASK, page_count)) for start in ranges))
+    return "".join(parts)
+
+
+# Page ranges for reading a PDF page by page: 1 page, then 2, 4, ... up to
+# EXTRACTION_PAGES_PER_TASK, so the first page is out quickly and later ranges still
+# amortize the cost of opening the file in a worker
+def _page_ranges(page_count):
+    start, size = 0, 1
+    while start < page_count:
+        stop = min(start + size, page_count)
+        yield start, stop
+        start, size = stop, min(size * 2, max(1, EXTRACTION_PAGES_PER_TASK))
+
+
+def _file_attributes(source, kind):
+    if isinstance(source, bytes):
+        return {"kind": kind, "bytes": len(source)}
+    return {"kind": kind, "file": os.path.basename(source) if isinstance(source, str) else None}
+
+
+# Extract a PDF off the event loop. Unreadable files give "" like the old inline
+# extractors; a file that takes longer than EXTRACTION_TIMEOUT raises TimeoutError
+# (the worker finishes the abandoned pages in the background).
+async def aextract_pdf(source):
+    try:
+        with telemetry.span("extraction.file", **_file_attributes(source, "pdf")) as attributes:
+            return await asyncio.wait_for(_extract_pdf(_resolve(source), attributes), EXTRACTION_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise
+    except Exception as e:
+        print(f"Error reading the PDF file: {e}")
+        return ""
+
+
+# The text of a PDF page by page, as the pages are parsed, for pipelines that start on
+# the first pages while the rest are still being read. Up to EXTRACTION_PREFETCH page
+# ranges are parsed ahead, in parallel, and the pages come out in order. An unreadable
+# file ends early like aextract_pdf gives ""; a file whose pages take longer than
+# EXTRACTION_TIMEOUT in all to come raises TimeoutError (time the reader spends on the
+# pages it got doesn't count).
+async def aiter_pdf_pages(source):
+    source = _resolve(source)
+    loop = asyncio.get_running_loop()
+    remaining = EXTRACTION_TIMEOUT
+    pending = collections.deque()
+    with telemetry.span("extraction.file", **_file_attributes(source, "pdf")) as attributes:
+        try:
+            started = loop.time()
+            page_count = attributes["pages"] = await asyncio.wait_for(_run(count_pdf_pages, source), remaining)
+            remaining -= loop.time() - started
+            ranges = _page_ranges(page_count)
+            while True:
+                for start, stop in itertools.islice(ranges, max(1, EXTRACTION_PREFETCH) - len(pending)):
+                    pending.append(asyncio.ensure_future(_read_pages(source, start, stop)))
+                if not pending:
+                    return
+                started = loop.time()
+                pages = await asyncio.wait_for(pending.popleft(), max(0, remaining))
+                remaining -= loop.time() - started
+                for page in pages:
+                    yield page
+        except asyncio.TimeoutError:
+            raise
+        except Exception as e:
+            print(f"Error reading the PDF file: {e}")
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+async def aextract_excel(source):
+    try:
+        with telemetry.span("extraction.file", **_file_attributes(source, "excel")):
+            return await asyncio.wait_for(_run(read_excel, _resolve(source)), EXTRACTION_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise
+    except Exception as e:
+        print(f"Error reading the Excel file: {e}")
+        return ""
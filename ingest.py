@@ -0,0 +1,58 @@
+# ingest.py
+
+import asyncio
+import hashlib
+import os
+import uuid
+
+import telemetry
+
+# Size of the blocks an upload is copied to disk in; bounds the memory one upload needs
+UPLOAD_BLOCK_SIZE = int(os.getenv("UPLOAD_BLOCK_SIZE", str(1024 * 1024)))
+
+
+# Copy the upload to path block by block, hashing each block on the way. The copy is
+# written to a file of its own next to the target and renamed into place, so readers never
+# see half a file and concurrent uploads with the same name don't write over each other.
+def _copy_and_hash(source, path):
+    digest = hashlib.sha256()
+    size = 0
+    partial = f"{path}.{uuid.uuid4().hex}.part"
+    source.seek(0)
+    try:
+        with open(partial, "wb") as target:
+            while True:
+                block = source.read(UPLOAD_BLOCK_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+                target.write(block)
+                size += len(block)
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return digest.hexdigest(), size
+
+
+# Save an UploadFile into directory in a single pass and return (path, sha256 hex digest, size).
+# Runs in a worker thread since the multipart spool and the target are blocking files.
+async def save_upload(file, directory):
+    path = os.path.join(directory, file.filename)
+    with telemetry.span("upload.write", file=file.filename) as attributes:
+        digest, size = await asyncio.to_thread(_copy_and_hash, file.file, path)
+        attributes["bytes"] = size
+    return path, digest, size
+
+
+# Save an UploadFile under its content hash instead of its name, so a later upload with the
+# same name can't replace it before it is processed. Returns (path, digest, size).
+async def save_upload_by_digest(file, directory):
+    staging = os.path.join(directory, f"{uuid.uuid4().hex}.upload")
+    with telemetry.span("upload.write", file=file.filename) as attributes:
+        digest, size = await asyncio.to_thread(_copy_and_hash, file.file, staging)
+        attributes["bytes"] = size
+    path = os.path.join(directory, digest + os.path.splitext(file.filename)[1].lower())
+    os.replace(staging, path)
+    return path, digest, size
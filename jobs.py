@@ -0,0 +1,205 @@
+# jobs.py
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import scheduler
+import telemetry
+
+# SQLite file holding the job queue; queued and interrupted jobs are picked up again after a restart
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "./jobs.db")
+
+# Directory the uploads of background jobs are saved to, named by content hash
+JOB_UPLOAD_DIR = os.getenv("JOB_UPLOAD_DIR", "uploaded_files/jobs")
+
+# Jobs one server process works on at the same time
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+# Attempts before a job that keeps raising is marked failed
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# Seconds between checks of the queue by idle workers and of a job by its event subscribers
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+
+
+# Durable job queue in a SQLite table. A job runs one of the apps' event pipelines (async
+# generators of (event, data) pairs, see streaming.py) registered under its kind: progress
+# and chunk events update the job's progress, "done" stores the result, "error" fails it.
+# Jobs submitted with a key are idempotent: submitting the same key again returns the
+# existing job unless it failed. Jobs left running by a stopped process are queued again
+# on start, so one process should serve each jobs database.
+class JobQueue:
+    def __init__(self, path=None, workers=None):
+        self.path = path or JOBS_DB_PATH
+        self.workers = JOB_WORKERS if workers is None else workers
+        self._handlers = {}
+        self._tasks = []
+        self._wakeup = None  # Created on start, in the server's event loop
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs "
+            "(id TEXT PRIMARY KEY, key TEXT UNIQUE, kind TEXT NOT NULL, params TEXT NOT NULL, status TEXT NOT NULL, "
+            "progress TEXT, result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status_created_at ON jobs (status, created_at)")
+        self._connection.commit()
+
+    # handler(params) returns the event pipeline that does the job's work
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            row = self._connection.execute(sql, parameters).fetchone()
+            self._connection.commit()
+        return row
+
+    def _update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        self._execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    @staticmethod
+    def _to_dict(row):
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],  # queued, running, done or failed
+            "progress": json.loads(row["progress"]) if row["progress"] else None,
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def get(self, job_id):
+        row = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return None if row is None else self._to_dict(row)
+
+    # Returns the job and whether this call queued it
+    def submit(self, kind, params, key=None):
+        now = time.time()
+        with self._lock:
+            row = None
+            if key is not None:
+                row = self._connection.execute("SELECT * FROM jobs WHERE key = ?", (key,)).fetchone()
+            if row is not None and row["status"] != "failed":
+                return self._to_dict(row), False
+
+            if row is not None:
+                job_id = row["id"]  # Failed jobs are retried from scratch
+                self._connection.execute(
+                    "UPDATE jobs SET params = ?, status = 'queued', progress = NULL, error = NULL, attempts = 0, "
+                    "updated_at = ? WHERE id = ?", (json.dumps(params), now, job_id))
+            else:
+                job_id = str(uuid.uuid4())
+                self._connection.execute(
+                    "INSERT INTO jobs (id, key, kind, params, status, created_at, updated_at) VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                    (job_id, key, kind, json.dumps(params), now, now))
+            self._connection.commit()
+
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return self.get(job_id), True
+
+    # Mark the oldest queued job running and return it, or None when the queue is empty
+    def _claim(self):
+        return self._execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? "
+            "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1) "
+            "RETURNING id, kind, params, attempts", (time.time(),))
+
+    async def _run(self, job):
+        handler = self._handlers.get(job["kind"])
+        if handler is None:
+            self._update(job["id"], status="failed", error=f"No handler for jobs of kind {job['kind']}")
+            return
+
+        progress = {}
+        try:
+            async for event, data in handler(json.loads(job["params"])):
+                if event == "done":
+                    self._update(job["id"], status="done", result=json.dumps(data))
+                    return
+                if event == "error":
+                    self._update(job["id"], status="failed", error=data["error"])
+                    return
+                # Tokens and other fine-grained events are only of use to live streams
+                if event == "progress":
+                    progress = dict(data, answered=progress.get("answered", 0))
+                elif event == "chunk":
+                    progress["answered"] = progress.get("answered", 0) + 1
+                else:
+                    continue
+                self._update(job["id"], progress=json.dumps(progress))
+            self._update(job["id"], status="failed", error="The job ended without a result.")
+        except asyncio.CancelledError:
+            self._update(job["id"], status="queued")  # Stopped with the server; resumed on the next start
+            raise
+        except Exception as e:
+            print(f"Error running job {job['id']} (attempt {job['attempts']}): {e}")
+            status = "queued" if job["attempts"] < JOB_MAX_ATTEMPTS else "failed"
+            self._update(job["id"], status=status, error=str(e))
+
+    async def _work(self):
+        while True:
+            self._wakeup.clear()
+            job = self._claim()
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+                except TimeoutError:
+                    pass
+                continue
+            # The job's spans are traced under its id, like a request's under the request id, and
+            # its model calls wait behind those of requests for the rate limits
+            with telemetry.trace(job["id"], job=job["kind"], attempt=job["attempts"]), scheduler.lane("bulk"):
+                await self._run(job)
+
+    # Start the workers; call from the server's startup so they run in its event loop
+    def start(self):
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")  # Interrupted by a restart
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # Event stream of a job for subscribers: a "status" event whenever its status or
+    # progress changes, then "done" with the result or "error"
+    async def events(self, job_id):
+        last = None
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                yield "error", {"error": "Job not found", "status_code": 404}
+                return
+            if job["status"] == "done":
+                yield "done", job["result"]
+                return
+            if job["status"] == "failed":
+                yield "error", {"error": job["error"], "status_code": 500}
+                return
+
+            state = {"status": job["status"], "progress": job["progress"], "attempts": job["attempts"]}
+            if state != last:
+                yield "status", state
+                last = state
+            await asyncio.sleep(JOB_POLL_INTERVAL)
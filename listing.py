@@ -0,0 +1,81 @@
+# listing.py
+
+import base64
+import gzip
+import os
+import uuid
+
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+import telemetry
+
+# Threads per page of a listing unless the request asks for another value, and the cap
+LIST_DEFAULT_LIMIT = int(os.getenv("LIST_DEFAULT_LIMIT", "100"))
+LIST_MAX_LIMIT = int(os.getenv("LIST_MAX_LIMIT", "1000"))
+
+# Large fields a listing leaves out unless they are asked for with ?fields=
+HEAVY_FIELDS = ("content", "messages")
+
+# Bodies smaller than this are not worth compressing
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1024"))
+
+
+# Fields to return: the comma-separated ?fields= list, or every model field except the heavy ones
+def parse_fields(fields, model):
+    allowed = list(model.model_fields)
+    if not fields:
+        return [field for field in allowed if field not in HEAVY_FIELDS]
+
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}. Choose from: {', '.join(allowed)}")
+    if "id" not in requested:
+        requested.insert(0, "id")  # Clients need the id to page and to fetch the rest
+    return requested
+
+
+def parse_limit(limit):
+    return min(limit or LIST_DEFAULT_LIMIT, LIST_MAX_LIMIT)
+
+
+def project(thread, fields):
+    return {field: thread.get(field) for field in fields}
+
+
+# Cursors are opaque to clients: the (user_id, thread_id) of the last thread on the page,
+# and its position in the listing when the store has one (see ThreadStore.page)
+def encode_cursor(user_id, thread_id, position=None):
+    fields = [user_id, str(thread_id)] + ([position] if position is not None else [])
+    return base64.urlsafe_b64encode(orjson.dumps(fields)).decode("ascii")
+
+
+# Returns (user_id, thread_id, position), position None when the cursor has none
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        user_id, thread_id, *position = orjson.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if len(position) > 1 or not all(isinstance(value, int) for value in position):
+            raise ValueError(position)
+        return user_id, uuid.UUID(thread_id), position[0] if position else None
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# JSON response serialized with orjson and gzip-compressed when the client accepts it.
+# The cursor of the next page, if any, goes in the X-Next-Cursor header so the body
+# keeps the shape clients already parse.
+def json_response(request, data, next_cursor=None):
+    with telemetry.span("response.serialize") as attributes:
+        body = orjson.dumps(data)
+        headers = {"Vary": "Accept-Encoding"}
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        if len(body) >= GZIP_MIN_BYTES and "gzip" in request.headers.get("accept-encoding", ""):
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+        attributes["bytes"] = len(body)
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,324 @@
+# llm.py
+
+import asyncio
+import contextlib
+import contextvars
+import email.utils
+import itertools
+import json
+import os
+import time
+
+import httpx
+
+import scheduler
+import telemetry
+
+# Upper bound on chunk calls that are in flight at the same time for one request
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+# Size of the shared keep-alive connection pool to the chat completions endpoint
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "16"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+
+# Chat completions endpoint used by the OpenAI based apps (main.py, thread.py, coronary.py)
+OPENAI_CHAT_URL = os.getenv("OPENAI_CHAT_URL", "https://api.openai.com/v1/chat/completions")
+
+# Statuses a call is tried again after: rate limited, or the service briefly unavailable
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+_sync_client = None
+_async_client = None
+_async_client_loop = None
+
+# Counters of the chat model calls made in the current context, innermost last (see count_calls)
+_call_count = contextvars.ContextVar("llm_call_count", default=())
+
+
+def _limits():
+    return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE)
+
+
+# Shared blocking client, reused so every chunk call does not open a new connection
+def get_sync_client():
+    global _sync_client
+    if _sync_client is None or _sync_client.is_closed:
+        _sync_client = httpx.Client(limits=_limits(), timeout=LLM_TIMEOUT)
+    return _sync_client
+
+
+# Shared async client; an AsyncClient is bound to the loop it was first used on,
+# so a new one is created if we are called from a different event loop
+def get_async_client():
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client.is_closed or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(limits=_limits(), timeout=LLM_TIMEOUT)
+        _async_client_loop = loop
+    return _async_client
+
+
+async def aclose_clients():
+    global _sync_client, _async_client, _async_client_loop
+    if _async_client is not None and _async_client_loop is asyncio.get_running_loop():
+        await _async_client.aclose()
+    if _sync_client is not None:
+        _sync_client.close()
+    _sync_client = None
+    _async_client = None
+    _async_client_loop = None
+
+
+# A chat model call failed for good: still failing after LLM_MAX_RETRIES retries, or
+# rejected with a status not worth retrying. status_code is the one to answer with.
+class LLMError(Exception):
+    def __init__(self, message, status_code=503):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def openai_headers(api_key):
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key or ''}".strip(),
+    }
+
+
+def azure_headers(api_key):
+    return {
+        "Content-Type": "application/json",
+        "api-key": api_key or "",
+    }
+
+
+# Tokens of the prompt, about four characters each, for endpoints that report no usage
+def _estimate_prompt_tokens(payload):
+    return sum(len(message.get("content") or "") for message in payload.get("messages", [])) // 4
+
+
+# Record the call's token counts on its span and in llm_tokens_total, from the response's
+# usage when the endpoint reports it
+def _count_tokens(attributes, payload, characters, usage=None):
+    usage = usage or {}
+    attributes["tokens_in"] = usage.get("prompt_tokens") or _estimate_prompt_tokens(payload)
+    attributes["tokens_out"] = usage.get("completion_tokens") or characters // 4
+    attributes["tokens_estimated"] = not usage
+    telemetry.count_tokens(attributes["tokens_in"], attributes["tokens_out"])
+
+
+def _message_content(response, payload, attributes):
+    attributes["status"] = response.status_code
+    response.raise_for_status()  # Raise an error for bad responses
+    body = response.json()
+    content = body['choices'][0]['message']['content']
+    _count_tokens(attributes, payload, len(content), body.get("usage"))
+    return content
+
+
+# Count the chat model calls made in the block, including by the tasks it starts; yields a
+# one-item list holding the count. A retried call counts once. Blocks nest: a call counts
+# for the block it is made in and for every block around it.
+@contextlib.contextmanager
+def count_calls():
+    counter = [0]
+    token = _call_count.set(_call_count.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _call_count.reset(token)
+
+
+def _counted():
+    for counter in _call_count.get():
+        counter[0] += 1
+
+
+# Tokens taken from the tokens per minute limit when a call is admitted: the prompt, plus
+# the completion when the payload caps it. Settled against the real count afterwards.
+def _admission_tokens(payload):
+    return _estimate_prompt_tokens(payload) + (payload.get("max_tokens") or 0)
+
+
+# Seconds the service asked us to wait, from Azure's retry-after-ms or the standard
+# Retry-After (seconds or a date); None when it sent neither
+def retry_after(response):
+    value = response.headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+# Seconds to sleep before retrying a failed attempt (from 0), or LLMError when the call
+# should not be retried. A 429 holds back every call rather than only this one, so the
+# retry just waits its turn in the scheduler again.
+def _retry_delay(attempt, error, attributes):
+    status = None
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        reason = str(status)
+        if status not in RETRY_STATUSES:
+            telemetry.LLM_FAILURES.inc(reason)
+            raise LLMError(f"The language model rejected the request ({status}): {error.response.text[:200]}", status_code=502) from error
+    else:
+        reason = type(error).__name__
+    if attempt >= scheduler.LLM_MAX_RETRIES:
+        telemetry.LLM_FAILURES.inc(reason)
+        raise LLMError(f"The language model is unavailable, try again later ({attempt + 1} attempts, last: {reason})") from error
+
+    telemetry.LLM_RETRIES.inc(reason)
+    attributes["retries"] = attempt + 1
+    delay = scheduler.backoff_delay(attempt, retry_after(error.response) if status else None)
+    print(f"Chat model call failed ({reason}), retrying in {delay:.1f}s")
+    if status == 429:
+        scheduler.llm_scheduler.pause(delay)
+        return 0
+    return delay
+
+
+# Blocking chat completion over the shared connection pool, admitted by the scheduler
+# and retried on 429, 5xx and connection errors
+def post_chat_completion(url, headers, payload):
+    tokens = _admission_tokens(payload)
+    with telemetry.span("llm.call", model=payload.get("model"), stream=False, lane=scheduler.current_lane()) as attributes:
+        _counted()
+        for attempt in itertools.count():
+            queued = scheduler.llm_scheduler.acquire_sync(tokens)
+            attributes["queued_ms"] = attributes.get("queued_ms", 0) + round(queued * 1000, 3)
+            try:
+                response = get_sync_client().post(url, json=payload, headers=headers)
+                content = _message_content(response, payload, attributes)
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                time.sleep(_retry_delay(attempt, e, attributes))
+                continue
+            scheduler.llm_scheduler.settle(tokens, attributes["tokens_in"] + attributes["tokens_out"])
+            return content
+
+
+# Non-blocking chat completion over the shared connection pool, admitted by the scheduler
+# and retried on 429, 5xx and connection errors
+async def apost_chat_completion(url, headers, payload):
+    tokens = _admission_tokens(payload)
+    with telemetry.span("llm.call", model=payload.get("model"), stream=False, lane=scheduler.current_lane()) as attributes:
+        _counted()
+        for attempt in itertools.count():
+            queued = await scheduler.llm_scheduler.acquire(tokens)
+            attributes["queued_ms"] = attributes.get("queued_ms", 0) + round(queued * 1000, 3)
+            try:
+                response = await get_async_client().post(url, json=payload, headers=headers)
+                content = _message_content(response, payload, attributes)
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                await asyncio.sleep(_retry_delay(attempt, e, attributes))
+                continue
+            scheduler.llm_scheduler.settle(tokens, attributes["tokens_in"] + attributes["tokens_out"])
+            return content
+
+
+# Run worker(item) for every item with at most max_concurrency calls in flight.
+# Results come back in the same order as the items, whatever order they finish in.
+# With keep_errors, a call that fails with LLMError gives the error as its result
+# instead of failing them all.
+async def gather_in_order(items, worker, max_concurrency=None, keep_errors=False):
+    semaphore = asyncio.Semaphore(max_concurrency or LLM_MAX_CONCURRENCY)
+
+    async def run(item):
+        async with semaphore:
+            return await _call(worker, item, keep_errors)
+
+    return await asyncio.gather(*(run(item) for item in items))
+
+
+# Run worker(item) for every item like gather_in_order, but yield (position, result)
+# as each call finishes so callers can report partial answers straight away
+async def iter_as_completed(items, worker, max_concurrency=None, keep_errors=False):
+    semaphore = asyncio.Semaphore(max_concurrency or LLM_MAX_CONCURRENCY)
+
+    async def run(position, item):
+        async with semaphore:
+            return position, await _call(worker, item, keep_errors)
+
+    tasks = [asyncio.ensure_future(run(position, item)) for position, item in enumerate(items)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # The client went away or the caller stopped early; don't leave calls running
+        for task in tasks:
+            task.cancel()
+
+
+async def _call(worker, item, keep_errors):
+    try:
+        return await worker(item)
+    except LLMError as e:
+        if not keep_errors:
+            raise
+        return e
+
+
+# The results of gather_in_order(..., keep_errors=True) without the failed calls, so one
+# chunk the model couldn't answer doesn't sink the whole answer. Raises the error when
+# every call failed.
+def successful(results):
+    answers = [result for result in results if not isinstance(result, LLMError)]
+    if len(answers) < len(results):
+        if not answers:
+            raise next(result for result in results if isinstance(result, LLMError))
+        print(f"Left out {len(results) - len(answers)} of {len(results)} chunk answers the model could not give")
+    return answers
+
+
+# Streaming chat completion over the shared connection pool. Yields the content
+# deltas of the server-sent events as they arrive, until the [DONE] event. Admitted and
+# retried like apost_chat_completion, but only until the first delta: a stream that
+# breaks after that raises LLMError, since its start has already been passed on.
+async def astream_chat_completion(url, headers, payload):
+    payload = dict(payload, stream=True)
+    tokens = _admission_tokens(payload)
+    with telemetry.span("llm.call", model=payload.get("model"), stream=True, lane=scheduler.current_lane()) as attributes:
+        received = 0
+        _counted()
+        for attempt in itertools.count():
+            queued = await scheduler.llm_scheduler.acquire(tokens)
+            attributes["queued_ms"] = attributes.get("queued_ms", 0) + round(queued * 1000, 3)
+            started = time.perf_counter()
+            try:
+                async with get_async_client().stream("POST", url, json=payload, headers=headers) as response:
+                    attributes["status"] = response.status_code
+                    if response.status_code >= 400:
+                        await response.aread()  # So the error can report the body
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            break
+                        choices = json.loads(data).get("choices") or [{}]
+                        content = (choices[0].get("delta") or {}).get("content")
+                        if content:
+                            if not received:
+                                attributes["first_token_ms"] = round((time.perf_counter() - started) * 1000, 3)
+                            received += len(content)
+                            yield content
+            except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                if received:
+                    telemetry.LLM_FAILURES.inc(type(e).__name__)
+                    raise LLMError(f"The language model stream broke off: {e}") from e
+                await asyncio.sleep(_retry_delay(attempt, e, attributes))
+                continue
+            break
+        _count_tokens(attributes, payload, received)
+        scheduler.llm_scheduler.settle(tokens, attributes["tokens_in"] + attributes["tokens_out"])
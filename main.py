@@ -1,12 +1,29 @@
 import PyPDF2
 import openai
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Request
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Dict, List
+from typing import Dict, List, Optional
 import pandas as pd
+import asyncio
 import csv
+import json
+import os
+import cache
+import chunking
+import coalesce
+import cpt
+import extraction
+import ingest
+import jobs
+import listing
+import llm
+import scheduler
+import streaming
+import synthesis
+import telemetry
+from thread_store import ThreadStore
 from uuid import UUID, uuid4
 
 app = FastAPI()
@@ -20,6 +37,38 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request ids, timed spans of each stage and a Prometheus /metrics endpoint
+telemetry.instrument(app, "main")
+
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await llm.aclose_clients()
+
+
+@app.on_event("shutdown")
+def close_extraction_pool():
+    extraction.shutdown_pool()
+
+
+# Long analyses submitted with background=true run here, off the request (see jobs.py)
+job_queue = jobs.JobQueue()
+os.makedirs(jobs.JOB_UPLOAD_DIR, exist_ok=True)
+
+# Directory to save uploaded files
+UPLOAD_DIR = "uploaded_files"
+os.makedirs(UPLOAD_DIR, exist_ok=True)  # Create the directory if it doesn't exist
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    job_queue.start()
+
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    await job_queue.stop()
+
 
 # Set your OpenAI API key
 openai.api_key = ""  # Replace with your actual OpenAI API key
@@ -27,16 +76,10 @@ openai.api_key = ""  # Replace with your actual OpenAI API key
 # Data structure to hold threads
 threads: List["Thread"] = []
 
-# Function to extract text from a PDF file
-def extract_text_from_pdf(file):
-    pdf_text = ""
-    try:
-        pdf_reader = PyPDF2.PdfReader(file)
-        for page in pdf_reader.pages:
-            pdf_text += page.extract_text() or ""
-    except Exception as e:
-        print(f"Error reading the PDF file: {e}")
-    return pdf_text
+# Function to extract text from a PDF file, parsed in the extraction process pool
+# (large PDFs are split into page ranges that are parsed in parallel)
+async def extract_text_from_pdf(file):
+    return await extraction.aextract_pdf(file.read())
 
 # Function to extract text from a TXT file
 def extract_text_from_txt(file):
@@ -59,51 +102,94 @@ def extract_text_from_csv(file):
         print(f"Error reading the CSV file: {e}")
     return csv_text
 
-# Function to extract text from an Excel file
-def extract_text_from_excel(file):
-    try:
-        excel_data = pd.read_excel(file)
-        return excel_data.to_string(index=False)
-    except Exception as e:
-        print(f"Error reading the Excel file: {e}")
-        return ""
-
-# Function to split text into smaller chunks to fit token limits
-def split_text_into_chunks(text, chunk_size=1500):
-    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
-
-# Function to query OpenAI API with a single prompt
-def query_pdf_content(chunk_text, query):
-    try:
-        print(openai.api_key,"keeeeeey")
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",  # Ensure the correct model is used
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"Analyze the following document: {chunk_text}. Based on this text, answer the question: {query}."
-                }
-            ]
-        )
-        return response['choices'][0]['message']['content']
-    except Exception as e:
-        print(f"Error querying OpenAI API: {e}")
-        return f"Error querying OpenAI API: {e}"
-
-# Function to query OpenAI API with each chunk and get a combined response
-def query_pdf_content_in_chunks(combined_text, query):
-    chunks = split_text_into_chunks(combined_text)
-    responses = []
-
-    for chunk in chunks:
-        response = query_pdf_content(chunk, query)
-        responses.append(response)
-
-    # Combine responses for final output
-    combined_response = "\n".join(responses)
-
-    # Final query to OpenAI API to summarize combined responses
-    final_response = query_pdf_content(combined_response, """generate a final report.if asked to generate a coronere report , generate it in a detailed coronere  format with proper explanation 
+# Function to extract text from an Excel file, parsed in the extraction process pool
+async def extract_text_from_excel(file):
+    return await extraction.aextract_excel(file.read())
+
+SUPPORTED_EXTENSIONS = (".pdf", ".txt", ".csv", ".xls", ".xlsx")
+
+# Function to extract text from a PDF, TXT, CSV or Excel file based on its name
+async def extract_text_by_type(filename, file):
+    filename = filename.lower()
+    if filename.endswith(".pdf"):
+        return await extract_text_from_pdf(file)
+    if filename.endswith(".txt"):
+        return extract_text_from_txt(file)
+    if filename.endswith(".csv"):
+        return extract_text_from_csv(file)
+    if filename.endswith((".xls", ".xlsx")):
+        return await extract_text_from_excel(file)
+    raise ValueError(f"Unsupported file type: {filename}")
+
+# CPT codes found in one file's extracted text, with character offsets into that text.
+# Scanned in a worker thread so long documents don't hold up the event loop.
+async def match_cpt_codes(filename, text):
+    matches = await asyncio.to_thread(cpt.get_matcher().match, text)
+    return {"file": filename, "matches": matches}
+
+# Function to split text into sentence-aware chunks that fit the model's token budget
+def split_text_into_chunks(text, max_tokens=None):
+    with telemetry.span("chunking", chars=len(text)) as attributes:
+        chunks = list(chunking.iter_chunks(text, max_tokens=max_tokens, model="gpt-3.5-turbo"))
+        attributes["chunks"] = len(chunks)
+    return chunks
+
+def build_chunk_request(chunk_text, query):
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": [
+            {
+                "role": "user",
+                "content": f"Analyze the following document: {chunk_text}. Based on this text, answer the question: {query}."
+            }
+        ]
+    }
+
+# Bump when the chunk prompt changes so answers to the old prompt are not served from the cache
+PROMPT_VERSION = "1"
+
+# Function to query OpenAI API with a single chunk, over the shared keep-alive pool in llm.py.
+# Answers are cached by chunk, query, model and prompt version; use_cache=False skips
+# the lookup (the fresh answer still replaces the cached one).
+async def aquery_pdf_content(chunk_text, query, use_cache=True):
+    key = cache.response_key(chunk_text, query, "gpt-3.5-turbo", PROMPT_VERSION)
+    if use_cache:
+        cached_answer = await cache.response_cache.aget(key)
+        if cached_answer is not None:
+            return cached_answer
+
+    data = build_chunk_request(chunk_text, query)
+    async def call():
+        answer = await llm.apost_chat_completion(llm.OPENAI_CHAT_URL, llm.openai_headers(openai.api_key), data)
+        await cache.response_cache.aset(key, answer)
+        return answer
+
+    # The same prompt already in flight for another request is waited for, not sent again
+    return await coalesce.llm_calls.run(key, call)
+
+# Streaming version of aquery_pdf_content: yields the answer piece by piece as the model
+# produces it. A cached answer is yielded whole; the streamed answer is cached once complete.
+async def astream_pdf_content(chunk_text, query, use_cache=True):
+    key = cache.response_key(chunk_text, query, "gpt-3.5-turbo", PROMPT_VERSION)
+    if use_cache:
+        cached_answer = await cache.response_cache.aget(key)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+
+    data = build_chunk_request(chunk_text, query)
+    answer = ""
+    async for token in llm.astream_chat_completion(llm.OPENAI_CHAT_URL, llm.openai_headers(openai.api_key), data):
+        answer += token
+        yield token
+
+    await cache.response_cache.aset(key, answer)
+
+# Instructions for merging a batch of chunk answers when they are too many for one final call
+MERGE_QUERY = "combine these partial findings into one consolidated set of findings. Keep every fact, date, name, finding, medication and dosage, and drop only repetition"
+
+# Instructions for the final synthesis over the combined chunk answers
+FINAL_REPORT_QUERY = """generate a final report.if asked to generate a coronere report , generate it in a detailed coronere  format with proper explanation 
                                        General principles
 The report should be a detailed factual account, based on the
 medical records and your knowledge of the deceased.
@@ -193,12 +279,68 @@ deceased by their full name and professional status. Describe your
 understanding of what they did and the conclusions they reached
 based on your own knowledge or the clinical notes. You should not,
 however, comment on the adequacy or otherwise of their
-performance.""")
-    
-    return final_response
+performance."""
+
+# Extraction stage of the report pipeline: a "progress" event as each upload starts, then
+# its text as "text" events, page by page for PDFs as the pages are parsed. uploads is a
+# list of (filename, path) of the saved files. With cpt_matches, the CPT codes found in
+# each file's text are appended to it.
+async def iter_upload_text(uploads, cpt_matches=None):
+    for position, (filename, path) in enumerate(uploads):
+        yield "progress", {"stage": "extracting", "file": filename, "index": position, "files": len(uploads)}
+        text = ""
+        try:
+            if filename.lower().endswith(".pdf"):
+                async for page in extraction.aiter_pdf_pages(path):
+                    text += page
+                    yield "text", page
+            else:
+                with open(path, "rb") as file:
+                    text = await extract_text_by_type(filename, file)
+                yield "text", text
+        except TimeoutError:
+            yield "error", {"error": f"Timed out extracting text from the file: {filename}", "status_code": 504}
+            return
+        yield "text", "\n"
+        if cpt_matches is not None:
+            cpt_matches.append(await match_cpt_codes(filename, text))
+
+# Report pipeline as an event stream: extraction progress, each chunk
+# answer as it completes, then the tokens of the final report as the model produces them.
+# Chunks are queried as soon as the pages they come from are extracted, while the rest of
+# the uploads are still being read. uploads is a list of (filename, path), see
+# iter_upload_text. With cpt_codes, the CPT codes found in each file's text are added to
+# the "done" payload.
+async def stream_query_pdf_content_in_chunks(uploads, query, use_cache=True, cpt_codes=False):
+    scheduler.set_lane("bulk")  # Reports wait behind interactive chat turns for the rate limits
+    cpt_matches = [] if cpt_codes else None
+    responses = []
+    pieces = iter_upload_text(uploads, cpt_matches)
+    chunker = chunking.Chunker(model="gpt-3.5-turbo")
+    async for event in streaming.stream_pipelined_chunk_answers(pieces, chunker, lambda chunk: aquery_pdf_content(chunk, query, use_cache), responses):
+        yield event
+        if event[0] == "error":
+            return
 
+    yield "progress", {"stage": "reducing", "answers": len(responses)}
+    responses, levels = await synthesis.reduce_until_fits(responses, lambda text: aquery_pdf_content(text, MERGE_QUERY, use_cache), model="gpt-3.5-turbo")
+    for level in levels:
+        yield "progress", dict(level, stage="reduced")
 
-user_threads: Dict[str, List[Dict]] = {}
+    yield "progress", {"stage": "synthesizing"}
+    final_response = ""
+    async for token in astream_pdf_content("\n".join(responses), FINAL_REPORT_QUERY, use_cache):
+        final_response += token
+        yield "token", {"content": token}
+
+    result = {"query": query, "answer": final_response}
+    if cpt_codes:
+        result["cpt_codes"] = cpt_matches
+    yield "done", result
+
+
+# Threads indexed by user and thread id (see thread_store.py)
+thread_store = ThreadStore()
 
 class Thread(BaseModel):
     id: UUID  # UUID will be provided in the request
@@ -208,59 +350,63 @@ class Thread(BaseModel):
 
 @app.post("/threads/", response_model=Thread)
 async def create_thread(thread: Thread):
-    # Ensure the user has a list for their threads
-    if thread.user_id not in user_threads:
-        user_threads[thread.user_id] = []
-
-    # Check for duplicate thread IDs for the same user
-    if any(existing_thread['id'] == thread.id for existing_thread in user_threads[thread.user_id]):
+    # Duplicate thread IDs for the same user are rejected by the store
+    if not thread_store.create(thread.user_id, thread.dict()):
         raise HTTPException(status_code=400, detail="Thread with this ID already exists for this user.")
-
-    # Append the new thread to the user's thread list
-    user_threads[thread.user_id].append(thread.dict())
     return thread
 
-@app.get("/threads/", response_model=Dict[str, List[Thread]])
-def read_threads():
-    # Convert the stored threads to the response model
-    return {user_id: [Thread(**thread) for thread in threads] for user_id, threads in user_threads.items()}
+# Paged by ?limit= and the X-Next-Cursor header (pass it back as ?cursor=); content and
+# messages are left out unless asked for with ?fields=
+@app.get("/threads/")
+def read_threads(request: Request, cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1), fields: Optional[str] = None):
+    fields = listing.parse_fields(fields, Thread)
+    page, after = thread_store.page(listing.parse_limit(limit), after=listing.decode_cursor(cursor))
+
+    threads_by_user = {}
+    for thread in page:
+        threads_by_user.setdefault(thread['user_id'], []).append(listing.project(thread, fields))
+    next_cursor = listing.encode_cursor(*after) if after else None
+    return listing.json_response(request, threads_by_user, next_cursor)
+
+@app.get("/threads/{user_id}")
+def read_user_threads(user_id: str, request: Request, cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1), fields: Optional[str] = None):
+    if not thread_store.has_user(user_id):
+        raise HTTPException(status_code=404, detail="User threads not found")
 
-@app.get("/threads/{user_id}", response_model=List[Thread])
-def read_user_threads(user_id: str):
-    if user_id in user_threads:
-        return [Thread(**thread) for thread in user_threads[user_id]]
-    raise HTTPException(status_code=404, detail="User threads not found")
+    fields = listing.parse_fields(fields, Thread)
+    page, after = thread_store.page(listing.parse_limit(limit), after=listing.decode_cursor(cursor), user_id=user_id)
+    next_cursor = listing.encode_cursor(*after) if after else None
+    return listing.json_response(request, [listing.project(thread, fields) for thread in page], next_cursor)
 
 @app.get("/threads/{user_id}/{thread_id}", response_model=Thread)
 def read_thread(user_id: str, thread_id: UUID):
-    if user_id not in user_threads:
+    if not thread_store.has_user(user_id):
         raise HTTPException(status_code=404, detail="User threads not found")
-        
-    for thread in user_threads[user_id]:
-        if thread['id'] == thread_id:
-            return Thread(**thread)
+
+    thread = thread_store.get(user_id, thread_id)
+    if thread is not None:
+        return thread
     raise HTTPException(status_code=404, detail="Thread not found")
 
 @app.put("/threads/{user_id}/{thread_id}", response_model=Thread)
 def update_thread(user_id: str, thread_id: UUID, updated_thread: Thread):
-    if user_id not in user_threads:
+    if not thread_store.has_user(user_id):
         raise HTTPException(status_code=404, detail="User threads not found")
 
-    for index, thread in enumerate(user_threads[user_id]):
-        if thread['id'] == thread_id:
-            user_threads[user_id][index] = updated_thread.dict()
-            user_threads[user_id][index]['id'] = thread_id  # Ensure ID remains the same
-            return updated_thread
+    thread = updated_thread.dict()
+    thread['id'] = thread_id  # Ensure ID remains the same
+    if thread_store.replace(user_id, thread_id, thread):
+        return updated_thread
     raise HTTPException(status_code=404, detail="Thread not found")
 
 @app.delete("/threads/{user_id}/{thread_id}", response_model=Thread)
 def delete_thread(user_id: str, thread_id: UUID):
-    if user_id not in user_threads:
+    if not thread_store.has_user(user_id):
         raise HTTPException(status_code=404, detail="User threads not found")
 
-    for index, thread in enumerate(user_threads[user_id]):
-        if thread['id'] == thread_id:
-            return Thread(**user_threads[user_id].pop(index))
+    thread = thread_store.delete(user_id, thread_id)
+    if thread is not None:
+        return thread
     raise HTTPException(status_code=404, detail="Thread not found")
 
 # Endpoint to upload files and ask a question
@@ -268,42 +414,76 @@ def delete_thread(user_id: str, thread_id: UUID):
 async def upload_and_query(
     files: List[UploadFile] = File(...), 
     query: str = Form(...),
-    user_id: str = Form(...)
+    user_id: str = Form(...),
+    no_cache: bool = Form(False),  # Skip cached answers for this request
+    stream: bool = Form(False),  # Answer as a text/event-stream instead of one JSON body
+    background: bool = Form(False),  # Queue the analysis and return a job id right away
+    cpt_codes: bool = Form(False)  # Add the CPT codes found in each file to the answer
 ):
-    combined_text = ""
-
     for file in files:
-        filename = file.filename.lower()
-
-        # Handle PDF files
-        if filename.endswith(".pdf"):
-            pdf_text = extract_text_from_pdf(file.file)
-            combined_text += pdf_text + "\n"
-
-        # Handle TXT files
-        elif filename.endswith(".txt"):
-            txt_text = extract_text_from_txt(file.file)
-            combined_text += txt_text + "\n"
-
-        # Handle CSV files
-        elif filename.endswith(".csv"):
-            csv_text = extract_text_from_csv(file.file)
-            combined_text += csv_text + "\n"
-
-        # Handle Excel files
-        elif filename.endswith(".xls") or filename.endswith(".xlsx"):
-            excel_text = extract_text_from_excel(file.file)
-            combined_text += excel_text + "\n"
-
-        else:
+        if not file.filename.lower().endswith(SUPPORTED_EXTENSIONS):
             return JSONResponse(content={"error": f"Unsupported file type: {file.filename}"}, status_code=400)
 
-    if not combined_text:
-        return JSONResponse(content={"error": "None of the provided files contain extractable text."}, status_code=400)
+    if background:
+        return await submit_report_job(files, query, user_id, use_cache=not no_cache, cpt_codes=cpt_codes)
 
-    answer = query_pdf_content_in_chunks(combined_text, query)
-    
-    return {"query": query, "answer": answer}
+    # Uploads are closed once the handler returns, so save them before streaming. Each is
+    # copied to disk block by block under its content hash, hashed on the way.
+    uploads, digests = [], []
+    for file in files:
+        path, digest, _ = await ingest.save_upload_by_digest(file, UPLOAD_DIR)
+        uploads.append((file.filename, path))
+        digests.append(digest)
+
+    # Requests for the same files and question while one is being answered share its analysis
+    key = coalesce.analysis_key(digests, query, "gpt-3.5-turbo", cpt_codes, not no_cache)
+    events = coalesce.analyses.join(key, lambda: stream_query_pdf_content_in_chunks(uploads, query, use_cache=not no_cache, cpt_codes=cpt_codes))
+
+    # Stream progress, chunk answers and report tokens as server-sent events
+    if stream:
+        return streaming.sse_response(events)
+    return await streaming.final_json(events)
+
+# Save the uploads and queue the analysis. The same files (by content) and query return the
+# job already submitted for them; no_cache=true always queues a new one.
+async def submit_report_job(files, query, user_id, use_cache=True, cpt_codes=False):
+    uploads = []
+    for file in files:
+        path, digest, _ = await ingest.save_upload_by_digest(file, jobs.JOB_UPLOAD_DIR)
+        uploads.append((file.filename, path, digest))
+
+    key = None
+    if use_cache:
+        key = cache.content_hash(json.dumps(["report", [digest for _, _, digest in uploads], cache.normalize_query(query), cpt_codes]))
+    params = {"uploads": [(filename, path) for filename, path, _ in uploads], "query": query, "user_id": user_id, "use_cache": use_cache,
+              "cpt_codes": cpt_codes}
+    job, created = job_queue.submit("report", params, key)
+    return JSONResponse(content={"job_id": job["id"], "status": job["status"], "created": created}, status_code=202)
+
+def run_report_job(params):
+    return stream_query_pdf_content_in_chunks(params["uploads"], params["query"], params["use_cache"], params.get("cpt_codes", False))
+
+job_queue.register("report", run_report_job)
+
+# Endpoint to find CPT codes in a piece of text, e.g. an answer, without calling the LLM
+@app.post("/cpt/match")
+async def match_cpt(text: str = Form(...)):
+    return (await match_cpt_codes(None, text))["matches"]
+
+# Endpoint to poll a background job: its status, progress, and result once done
+@app.get("/jobs/{job_id}")
+def read_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+# Endpoint to subscribe to a background job as server-sent events until it finishes
+@app.get("/jobs/{job_id}/events")
+def read_job_events(job_id: str):
+    if job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return streaming.sse_response(job_queue.events(job_id))
 
 if __name__ == "__main__":
     import uvicorn
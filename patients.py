@@ -0,0 +1,200 @@
+# patients.py
+
+import csv
+import os
+import threading
+import time
+
+import numpy as np
+
+# Semicolon-delimited transcripts with transcription, created_at, patient_model_id and patient_id columns
+PATIENT_DATA_PATH = os.getenv("PATIENT_DATA_PATH", "patient_personal_details(1).csv")
+
+# Seconds between checks of the file for changes; a changed file is reloaded in the background
+PATIENT_DATA_CHECK_INTERVAL = float(os.getenv("PATIENT_DATA_CHECK_INTERVAL", "5"))
+
+# Rows returned by lookups and range queries unless the caller asks for another number
+PATIENT_DEFAULT_LIMIT = int(os.getenv("PATIENT_DEFAULT_LIMIT", "50"))
+
+
+# "YYYY-MM-DD" or "YYYY-MM-DD HH:MM[:SS]" to seconds since the epoch. A bare date as the
+# end of a range covers that whole day.
+def parse_time(value, end=False):
+    if value is None:
+        return None
+    seconds = int(np.datetime64(value.strip().replace(" ", "T"), "s").astype(np.int64))
+    if end and len(value.strip()) == 10:
+        seconds += 24 * 3600 - 1
+    return seconds
+
+
+def format_time(seconds):
+    return str(np.datetime64(int(seconds), "s")).replace("T", " ")
+
+
+# Dictionary-encode a string column: (int32 codes, distinct values in first-seen order)
+def _encode(values):
+    categories = {}
+    codes = np.fromiter((categories.setdefault(value, len(categories)) for value in values), dtype=np.int32, count=len(values))
+    return codes, list(categories)
+
+
+# Columnar, read-only snapshot of the transcripts, sorted by created_at. Timestamps are
+# an int64 array searched with binary search, the two id columns are dictionary-encoded,
+# and each patient maps to the positions of their rows, so lookups, time ranges and
+# top-N queries touch only the rows they return.
+class PatientTable:
+    def __init__(self, transcriptions, created_at, patient_model_ids, patient_ids):
+        order = np.argsort(np.asarray(created_at, dtype=np.int64), kind="stable")
+        self.created_at = np.asarray(created_at, dtype=np.int64)[order]
+        self.transcriptions = [transcriptions[position] for position in order]
+        self.model_codes, self.model_ids = _encode([patient_model_ids[position] for position in order])
+        self.patient_codes, self.patient_ids = _encode([patient_ids[position] for position in order])
+
+        # Rows of each patient, oldest first
+        by_code = np.argsort(self.patient_codes, kind="stable")
+        bounds = np.searchsorted(self.patient_codes[by_code], np.arange(len(self.patient_ids) + 1))
+        self.rows_by_patient = {patient_id: by_code[bounds[code]:bounds[code + 1]]
+                                for code, patient_id in enumerate(self.patient_ids)}
+
+        # Patients by number of transcripts, then by most recent transcript
+        self.patient_ranking = sorted(
+            self.rows_by_patient.items(),
+            key=lambda item: (len(item[1]), self.created_at[item[1][-1]]),
+            reverse=True,
+        )
+
+    def __len__(self):
+        return len(self.transcriptions)
+
+    def record(self, position, include_text=True):
+        record = {
+            "patient_id": self.patient_ids[self.patient_codes[position]],
+            "patient_model_id": self.model_ids[self.model_codes[position]],
+            "created_at": format_time(self.created_at[position]),
+        }
+        if include_text:
+            record["transcription"] = self.transcriptions[position]
+        return record
+
+    def _records(self, positions, limit, latest_first, include_text):
+        positions = positions[::-1] if latest_first else positions
+        return [self.record(position, include_text) for position in positions[:limit or PATIENT_DEFAULT_LIMIT]]
+
+    # Positions between start and end (seconds, inclusive) within positions sorted by time
+    def _between(self, positions, start, end):
+        times = self.created_at[positions]
+        low = 0 if start is None else np.searchsorted(times, start, side="left")
+        high = len(positions) if end is None else np.searchsorted(times, end, side="right")
+        return positions[low:high]
+
+    # A patient's transcripts, optionally within [start, end]
+    def by_patient(self, patient_id, start=None, end=None, limit=None, latest_first=True, include_text=True):
+        positions = self.rows_by_patient.get(patient_id)
+        if positions is None:
+            return []
+        return self._records(self._between(positions, start, end), limit, latest_first, include_text)
+
+    # Every patient's transcripts within [start, end]
+    def in_range(self, start=None, end=None, limit=None, latest_first=True, include_text=True):
+        low = 0 if start is None else np.searchsorted(self.created_at, start, side="left")
+        high = len(self) if end is None else np.searchsorted(self.created_at, end, side="right")
+        return self._records(np.arange(low, high), limit, latest_first, include_text)
+
+    # Number of transcripts, and of distinct patients they belong to, within [start, end];
+    # with a patient id, of that patient's transcripts only
+    def count(self, patient_id=None, start=None, end=None):
+        if patient_id is not None:
+            positions = self.rows_by_patient.get(patient_id)
+            transcripts = 0 if positions is None else len(self._between(positions, start, end))
+            return {"transcripts": transcripts, "patients": int(transcripts > 0)}
+        low = 0 if start is None else np.searchsorted(self.created_at, start, side="left")
+        high = len(self) if end is None else np.searchsorted(self.created_at, end, side="right")
+        return {"transcripts": int(high - low), "patients": len(np.unique(self.patient_codes[low:high]))}
+
+    # The n patients with the most transcripts
+    def top_patients(self, n=10):
+        return [{"patient_id": patient_id, "transcripts": len(positions), "last_seen": format_time(self.created_at[positions[-1]])}
+                for patient_id, positions in self.patient_ranking[:n]]
+
+    # The n most recent transcripts
+    def latest(self, n=10, include_text=True):
+        return self._records(np.arange(len(self)), n, True, include_text)
+
+
+def load_table(path):
+    transcriptions, created_at, patient_model_ids, patient_ids = [], [], [], []
+    # The export is UTF-8 with the odd byte in another encoding; those are replaced, not fatal
+    with open(path, encoding="utf-8", errors="replace", newline="") as file:
+        for line, row in enumerate(csv.DictReader(file, delimiter=";"), start=2):
+            try:
+                created_at.append(parse_time(row["created_at"]))
+            except (TypeError, ValueError) as e:
+                print(f"Skipping row {line} of {path} with an unreadable created_at: {e}")
+                continue
+            transcriptions.append(row["transcription"] or "")
+            patient_model_ids.append(row["patient_model_id"] or "")
+            patient_ids.append(row["patient_id"] or "")
+    return PatientTable(transcriptions, created_at, patient_model_ids, patient_ids)
+
+
+# Holds the current PatientTable of a file and swaps in a new one when the file changes.
+# Queries keep using the previous table while a reload runs in a background thread.
+class PatientEngine:
+    def __init__(self, path=None):
+        self.path = path or PATIENT_DATA_PATH
+        self._table = None
+        self._stamp = None
+        self._checked_at = 0.0
+        self._reloading = False
+        self._lock = threading.Lock()
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    # Load the file if it changed since the last load (or always, with force).
+    # Returns whether a new table was loaded.
+    def reload(self, force=False):
+        with self._lock:
+            stamp = self._file_stamp()
+            if not force and self._table is not None and stamp == self._stamp:
+                return False
+            try:
+                table = load_table(self.path)
+            except Exception as e:
+                print(f"Error loading the patient data from {self.path}: {e}")
+                if self._table is None:
+                    self._table = PatientTable([], [], [], [])
+                return False
+            self._table, self._stamp = table, stamp
+            print(f"Loaded {len(table)} transcripts of {len(table.patient_ids)} patients from {self.path}")
+            return True
+
+    def _reload_in_background(self):
+        try:
+            self.reload()
+        finally:
+            self._reloading = False
+
+    # Start a background reload when the file changed; checked at most every
+    # PATIENT_DATA_CHECK_INTERVAL seconds so queries only pay for it once in a while
+    def maybe_reload(self):
+        now = time.monotonic()
+        if self._reloading or now - self._checked_at < PATIENT_DATA_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        if self._file_stamp() != self._stamp:
+            self._reloading = True
+            threading.Thread(target=self._reload_in_background, daemon=True).start()
+
+    @property
+    def table(self):
+        if self._table is None:
+            self.reload()
+        else:
+            self.maybe_reload()
+        return self._table
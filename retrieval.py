@@ -0,0 +1,107 @@
+# retrieval.py
+
+import heapq
+import math
+import os
+import re
+from collections import Counter
+
+# Number of chunks sent to the model per query unless the request asks for another value
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "8"))
+
+# Words and numbers, keeping decimals together so lab values like "0.08" stay one term
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+# In-process BM25 inverted index over the chunks of one upload or thread
+class BM25Index:
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.chunks = []
+        self.lengths = []
+        self.postings = {}  # term -> {chunk position: term frequency}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.chunks)
+
+    # Add chunks to the index; existing chunks are left untouched
+    def add(self, chunks):
+        for chunk in chunks:
+            position = len(self.chunks)
+            terms = Counter(tokenize(chunk))
+            self.chunks.append(chunk)
+            self.lengths.append(sum(terms.values()))
+            self.total_length += self.lengths[-1]
+            for term, frequency in terms.items():
+                self.postings.setdefault(term, {})[position] = frequency
+        return self
+
+    # Score every chunk that shares a term with the query, highest first
+    def search(self, query, top_k=None):
+        if not self.chunks:
+            return []
+
+        n_chunks = len(self.chunks)
+        average_length = (self.total_length / n_chunks) or 1.0
+        scores = {}
+
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_chunks - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, frequency in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[position] / average_length)
+                scores[position] = scores.get(position, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        top_k = top_k or RETRIEVAL_TOP_K
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    # Top-k chunks for the query, returned in document order so the answers read naturally.
+    # With recent_from, chunks at that position and after (the files just added) get up to
+    # half of the slots ahead of older ones, and the rest go to the best matches of all.
+    # Falls back to the leading chunks when nothing in the query matches the index.
+    def top_chunks(self, query, top_k=None, recent_from=None):
+        top_k = top_k or RETRIEVAL_TOP_K
+        if recent_from is None or recent_from >= len(self.chunks):
+            positions = sorted(position for position, _ in self.search(query, top_k))
+        else:
+            ranked = [position for position, _ in self.search(query, len(self.chunks))]
+            recent = [position for position in ranked if position >= recent_from][:(top_k + 1) // 2]
+            chosen = set(recent)
+            rest = [position for position in ranked if position not in chosen][:top_k - len(recent)]
+            positions = sorted(recent + rest)
+        if not positions:
+            positions = range(min(top_k, len(self.chunks)))
+        return [self.chunks[position] for position in positions]
+
+    # JSON-serializable form, stored in ThreadDB.search_index
+    def to_dict(self):
+        return {
+            "k1": self.k1,
+            "b": self.b,
+            "chunks": self.chunks,
+            "lengths": self.lengths,
+            "postings": {term: {str(position): frequency for position, frequency in postings.items()}
+                         for term, postings in self.postings.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls(k1=data.get("k1", 1.5), b=data.get("b", 0.75))
+        index.chunks = list(data["chunks"])
+        index.lengths = list(data["lengths"])
+        index.total_length = sum(index.lengths)
+        index.postings = {term: {int(position): frequency for position, frequency in postings.items()}
+                          for term, postings in data["postings"].items()}
+        return index
+
+
+def build_index(chunks):
+    return BM25Index().add(chunks)
@@ -0,0 +1,304 @@
+# router.py
+
+import math
+import os
+import re
+import time
+from collections import Counter
+
+import patients
+
+# Posterior the classifier needs before a weak rule match (a bare "top 5", a date, an id
+# without the word "patient", "how many records") is trusted; below it the question goes to the documents
+ROUTER_MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.6"))
+
+# Rows listed for "top" and "latest" questions that don't say how many
+ROUTER_DEFAULT_N = int(os.getenv("ROUTER_DEFAULT_N", "10"))
+
+# Question families: answered from the patient transcripts, from the CPT code list,
+# or from the uploaded documents by the model
+FAMILIES = ("patients", "cpt", "documents")
+
+# Route name -> family
+ROUTES = {
+    "patient_transcripts": "patients",
+    "patient_count": "patients",
+    "top_patients": "patients",
+    "transcripts_in_range": "patients",
+    "cpt_code": "cpt",
+    "cpt_search": "cpt",
+    "documents": "documents",
+}
+
+TIME_PATTERN = re.compile(r"\b\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2})?)?\b")
+CPT_CODE_PATTERN = re.compile(r"\b(?:cpt|code)\b\D{0,20}?\b(\d{4}[0-9FTU])\b", re.IGNORECASE)
+BARE_CODE_PATTERN = re.compile(r"\b(\d{4}[0-9FTU])\b")
+CPT_SEARCH_PATTERN = re.compile(r"\b(?:cpt|billing|procedure)\s+codes?\s+(?:for|of)\s+(.+)", re.IGNORECASE)
+CODE_SEARCH_PATTERN = re.compile(r"\bcodes?\s+(?:for|of)\s+(.+)", re.IGNORECASE)
+PATIENT_ID_PATTERN = re.compile(r"\bpatient\s*(?:id|number|no\.?|#)\s*[:#=]?\s*([A-Za-z0-9][\w\-]*)", re.IGNORECASE)
+ID_TOKEN_PATTERN = re.compile(r"[A-Za-z0-9][\w\-]*")
+COUNT_PATTERN = re.compile(r"\b(?:how\s+many|number\s+of|count(?:\s+of)?|total)\b", re.IGNORECASE)
+COUNT_OF_PATTERN = re.compile(r"\b(?:how\s+many|number\s+of|count(?:\s+of)?|total)\s+(?:\w+\s+)?"
+                              r"(patients|transcripts?|transcriptions?|visits?|consultations?|records?)\b", re.IGNORECASE)
+TOP_PATIENTS_PATTERN = re.compile(r"\btop\s*(\d+)?\s+(?:\w+\s+){0,2}?patients?\b"
+                                  r"|\bpatients?\s+with\s+(?:the\s+)?most\s+(?:transcripts|transcriptions|visits|consultations)\b",
+                                  re.IGNORECASE)
+TOP_PATTERN = re.compile(r"\btop\s*(\d+)?\b", re.IGNORECASE)
+LATEST_PATTERN = re.compile(r"\b(?:latest|most\s+recent|newest|last)\s*(\d+)?\s+(?:transcripts?|transcriptions?|visits?|consultations?)\b",
+                            re.IGNORECASE)
+# Words that point at the uploaded documents rather than the patient data
+DOCUMENT_PATTERN = re.compile(r"\b(?:reports?|documents?|notes|history|uploaded|uploads?|files?|pdfs?|attached|charts?)\b", re.IGNORECASE)
+TRANSCRIPT_PATTERN = re.compile(r"\b(?:transcripts?|transcriptions?|visits?|consultations?|recorded)\b", re.IGNORECASE)
+
+# Words for the classifier: numbers and ids all become "#", so "patient id 212" and
+# "patient id GP-0121" look alike
+FEATURE_PATTERN = re.compile(r"[a-z0-9][a-z0-9\-_]*")
+
+# Labelled questions the classifier is fitted on when the module loads. The evaluation
+# set in benchmarks/router_eval.jsonl is kept apart from these.
+TRAINING = [
+    ("show the transcripts of patient id GP-0121", "patients"),
+    ("transcripts for patient RJ0015", "patients"),
+    ("what did patient AP001 talk about in their visits", "patients"),
+    ("list all consultations of patient id 212", "patients"),
+    ("get patient id AK-72974 transcripts between 2024-09-20 and 2024-09-25", "patients"),
+    ("how many transcripts does patient G0012 have", "patients"),
+    ("how many patients were seen last week", "patients"),
+    ("number of consultations recorded on 2024-09-26", "patients"),
+    ("top 5 patients", "patients"),
+    ("top patients by number of transcripts", "patients"),
+    ("which patients have the most visits", "patients"),
+    ("show the latest transcripts", "patients"),
+    ("transcripts recorded between 2024-09-20 and 2024-09-22", "patients"),
+    ("list the visits on 2024-09-27", "patients"),
+    ("who are the top 3 patients this month", "patients"),
+    ("patient PSY-092 records", "patients"),
+    ("total visits of patient JM00124", "patients"),
+    ("most recent consultations", "patients"),
+    ("what is cpt code 24500", "cpt"),
+    ("cpt 0003T", "cpt"),
+    ("what procedure is code 24587", "cpt"),
+    ("cpt code for treatment of humerus fracture", "cpt"),
+    ("which cpt codes apply to an upper gi endoscopy", "cpt"),
+    ("billing code for cervicography", "cpt"),
+    ("describe procedure code 24515", "cpt"),
+    ("look up the cpt code of a knee arthroscopy", "cpt"),
+    ("what does 0042T stand for", "cpt"),
+    ("what is 99213", "cpt"),
+    ("explain 24587", "cpt"),
+    ("procedure codes for the revision of the humerus", "cpt"),
+    ("what is the cause of death in the autopsy report", "documents"),
+    ("summarize the toxicology findings", "documents"),
+    ("what does the mri show", "documents"),
+    ("list the medications and dosages in the history", "documents"),
+    ("was the patient on any blood thinners", "documents"),
+    ("what are the top findings of the report", "documents"),
+    ("should the patient stop the medication", "documents"),
+    ("what was the blood alcohol level", "documents"),
+    ("describe the coronary arteries", "documents"),
+    ("were there any fractures in the imaging", "documents"),
+    ("give me a summary of the patient's history", "documents"),
+    ("what is the diagnosis and the treatment plan", "documents"),
+    ("how many lesions were found in the liver", "documents"),
+    ("what did the doctor recommend at the last follow up", "documents"),
+    ("explain the lab results", "documents"),
+    ("what is the patient's age and weight", "documents"),
+    ("is there evidence of stenosis in the top of the artery", "documents"),
+    ("when was the report signed", "documents"),
+]
+
+
+def features(text):
+    return ["#" if any(character.isdigit() for character in token) else token
+            for token in FEATURE_PATTERN.findall(text.lower())]
+
+
+# Multinomial naive Bayes over the words of a question, with add-one smoothing.
+# Fitting and predicting are dictionary lookups, a few microseconds per question.
+class QuestionClassifier:
+    def __init__(self, examples):
+        counts = {family: Counter() for family in FAMILIES}
+        documents = Counter()
+        for text, family in examples:
+            counts[family].update(features(text))
+            documents[family] += 1
+        vocabulary = set().union(*counts.values())
+
+        self.priors = {family: math.log(documents[family] / len(examples)) for family in FAMILIES}
+        self.weights = {}  # word -> {family: log probability}
+        for family in FAMILIES:
+            total = sum(counts[family].values()) + len(vocabulary)
+            for word in vocabulary:
+                self.weights.setdefault(word, {})[family] = math.log((counts[family][word] + 1) / total)
+
+    # (most likely family, its posterior probability)
+    def predict(self, text):
+        scores = dict(self.priors)
+        for word in features(text):
+            weights = self.weights.get(word)
+            if weights is None:
+                continue  # Unseen by every family, so it favours none
+            for family in FAMILIES:
+                scores[family] += weights[family]
+        best = max(scores, key=scores.get)
+        total = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1 / total
+
+
+classifier = QuestionClassifier(TRAINING)
+
+
+# (start, end) strings of the dates in the question: one date is that whole day, two a range
+def _time_range(query):
+    times = TIME_PATTERN.findall(query)
+    try:
+        for value in times:
+            patients.parse_time(value)
+    except ValueError:
+        return None, None  # Not a real date, so not a time range
+    if not times:
+        return None, None
+    return times[0], times[-1]
+
+
+def _dated(params, query):
+    start, end = _time_range(query)
+    return dict(params, start=start, end=end)
+
+
+# The rules, tried in order. Each returns (route, params) or None; a strong rule's match
+# is routed as is, a weak one only when the classifier agrees on the family.
+
+def _cpt_code(query, patient_ids):
+    match = CPT_CODE_PATTERN.search(query)
+    return match and ("cpt_code", {"code": match.group(1).upper()})
+
+
+def _cpt_search(query, patient_ids):
+    match = CPT_SEARCH_PATTERN.search(query)
+    return match and ("cpt_search", {"text": match.group(1).strip(" ?.!")})
+
+
+# The word after "patient id" is only taken for an id when it's a known one or looks like
+# one (letters and digits), so "the patient id on the report" isn't read as patient "on"
+# and "patient number 3" is only a patient when there is one with that id
+def _patient_id(query, patient_ids):
+    match = PATIENT_ID_PATTERN.search(query)
+    candidate = match and match.group(1)
+    if not candidate or not (candidate in patient_ids or (any(c.isdigit() for c in candidate) and not candidate.isdigit())):
+        return None
+    route = "patient_count" if COUNT_PATTERN.search(query) else "patient_transcripts"
+    return route, _dated({"patient_id": match.group(1)}, query)
+
+
+# Counts of patients or transcripts are strong; "how many records" could as well be about
+# the documents ("records mention cocaine"), so it's a weak match unless an id came with it
+def _count(query, patient_ids, records=False):
+    match = COUNT_OF_PATTERN.search(query)
+    if not match or match.group(1).lower().startswith("record") != records:
+        return None
+    of = "patients" if match.group(1).lower() == "patients" else "transcripts"
+    return "patient_count", _dated({"patient_id": None, "of": of}, query)
+
+
+def _top_patients(query, patient_ids):
+    match = TOP_PATIENTS_PATTERN.search(query)
+    return match and ("top_patients", {"n": int(match.group(1) or ROUTER_DEFAULT_N)})
+
+
+def _dated_transcripts(query, patient_ids):
+    if not TRANSCRIPT_PATTERN.search(query):
+        return None
+    latest = LATEST_PATTERN.search(query)
+    if latest:
+        return "transcripts_in_range", {"start": None, "end": None, "limit": int(latest.group(1) or ROUTER_DEFAULT_N)}
+    start, end = _time_range(query)
+    return start and ("transcripts_in_range", {"start": start, "end": end, "limit": None})
+
+
+# An id from the patient data written without "patient id" before it. Ids with letters
+# are taken as they are; an all-digit id ("212") could be any number, so it's a weak match.
+def _known_patient(query, patient_ids, numeric=False):
+    for match in ID_TOKEN_PATTERN.finditer(query):
+        if match.group() in patient_ids and match.group().isdigit() == numeric:
+            route = "patient_count" if COUNT_PATTERN.search(query) else "patient_transcripts"
+            return route, _dated({"patient_id": match.group()}, query)
+    return None
+
+
+def _known_number(query, patient_ids):
+    return _known_patient(query, patient_ids, numeric=True)
+
+
+def _count_records(query, patient_ids):
+    return _count(query, patient_ids, records=True)
+
+
+def _top(query, patient_ids):
+    match = TOP_PATTERN.search(query)
+    return match and ("top_patients", {"n": int(match.group(1) or ROUTER_DEFAULT_N)})
+
+
+def _bare_code(query, patient_ids):
+    match = BARE_CODE_PATTERN.search(query)
+    return match and ("cpt_code", {"code": match.group(1).upper()})
+
+
+def _code_search(query, patient_ids):
+    match = CODE_SEARCH_PATTERN.search(query)
+    return match and ("cpt_search", {"text": match.group(1).strip(" ?.!")})
+
+
+def _dates(query, patient_ids):
+    start, end = _time_range(query)
+    return start and ("transcripts_in_range", {"start": start, "end": end, "limit": None})
+
+
+# (rule, strong)
+RULES = [
+    (_cpt_code, True),
+    (_cpt_search, True),
+    (_patient_id, True),
+    (_known_patient, True),
+    (_count, True),
+    (_top_patients, True),
+    (_dated_transcripts, True),
+    (_known_number, False),
+    (_count_records, False),
+    (_top, False),
+    (_bare_code, False),
+    (_code_search, False),
+    (_dates, False),
+]
+
+
+# Decide how to answer a question: a dict with the route name (see ROUTES), its params,
+# the rule that chose it ("classifier" when the classifier vetoed every weak match,
+# "mentions_documents" for a question about a report or file, None when nothing matched),
+# the classifier's family and confidence, and the time taken.
+# patient_ids is a container of the known patient ids, e.g. PatientTable.rows_by_patient.
+# With documents=True (files were uploaded with the question) the documents come first:
+# strong rules only count when the classifier agrees, and weak ones are not tried.
+def route(query, patient_ids=(), documents=False):
+    started = time.perf_counter()
+    family, confidence = classifier.predict(query)
+    decision = {"name": "documents", "params": {}, "rule": None}
+
+    if DOCUMENT_PATTERN.search(query):
+        rules = []
+        decision["rule"] = "mentions_documents"
+    else:
+        rules = [(rule, strong and not documents) for rule, strong in RULES if strong or not documents]
+    for rule, strong in rules:
+        matched = rule(query, patient_ids)
+        if not matched:
+            continue
+        name, params = matched
+        if strong or (ROUTES[name] == family and confidence >= ROUTER_MIN_CONFIDENCE):
+            decision = {"name": name, "params": params, "rule": rule.__name__.lstrip("_")}
+            break
+        decision["rule"] = "classifier"
+
+    decision.update(family=family, confidence=round(confidence, 3),
+                    elapsed_ms=round((time.perf_counter() - started) * 1000, 3))
+    return decision
@@ -0,0 +1,236 @@
+# scheduler.py
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+import telemetry
+
+# Requests and tokens per minute the deployment allows (its quota, or a little under it
+# when other clients share the deployment); 0 leaves that limit off
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "0"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+
+# Seconds over which the limits are enforced: at most that share of a minute's quota is
+# sent in any such window. Azure OpenAI checks its quotas over short windows rather than
+# whole minutes, so a minute's worth of requests sent at once is throttled.
+LLM_RATE_WINDOW = float(os.getenv("LLM_RATE_WINDOW", "10"))
+
+# Times a call rejected with 429 or a 5xx, or that could not reach the service, is tried again
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+
+# Backoff before a retry (seconds): random up to LLM_BACKOFF_BASE doubled on every retry,
+# capped at LLM_BACKOFF_MAX. A Retry-After from the service is used as it is instead.
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "60"))
+
+# Priority lanes, highest first: a waiting call of a lane goes before every call of the
+# lanes after it, and calls of the same lane go in the order they arrived
+LANES = ("interactive", "standard", "bulk")
+
+# Lane of the calls made by the current request or job
+_lane = contextvars.ContextVar("lane", default="standard")
+
+
+def current_lane():
+    return _lane.get()
+
+
+# Put the rest of the current task's calls in lane; for pipelines (async generators),
+# which can't reset a context variable around their yields
+def set_lane(lane):
+    if lane not in LANES:
+        raise ValueError(f"Unknown lane {lane!r}, expected one of {LANES}")
+    _lane.set(lane)
+
+
+@contextlib.contextmanager
+def lane(name):
+    if name not in LANES:
+        raise ValueError(f"Unknown lane {name!r}, expected one of {LANES}")
+    token = _lane.set(name)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+# Refills at per_minute / 60 a second up to window seconds' worth. The level may go below
+# zero when a call turns out to have used more than was taken for it; later calls wait
+# that off.
+class TokenBucket:
+    def __init__(self, per_minute, window=None):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * (window or LLM_RATE_WINDOW))
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until amount can be taken. More than the capacity waits for a full bucket,
+    # so a prompt over the quota is still sent, alone, rather than never.
+    def wait_time(self, amount, now):
+        self._refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+
+    # Leave the bucket empty at the end of a pause of seconds, so calls resume at the
+    # steady rate afterwards rather than in a burst that is throttled again
+    def drain(self, seconds, now):
+        self._refill(now)
+        self.level = min(self.level, -self.rate * seconds)
+
+
+# Seconds to wait before retry number attempt (from 0), from the service's Retry-After
+# when it sent one
+def backoff_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        return min(retry_after, LLM_BACKOFF_MAX)
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+# Admits chat model calls within the requests and tokens per minute limits. Calls wait in
+# one queue ordered by lane, then arrival; only the first one looks at the buckets, so a
+# large prompt at the front is not starved by small ones behind it, and a waiting
+# interactive call is next whatever bulk work is queued. A 429 holds back every call
+# until its Retry-After has passed. Usable from the event loop and from threads.
+class Scheduler:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, window=None):
+        requests_per_minute = LLM_REQUESTS_PER_MINUTE if requests_per_minute is None else requests_per_minute
+        tokens_per_minute = LLM_TOKENS_PER_MINUTE if tokens_per_minute is None else tokens_per_minute
+        self.requests = TokenBucket(requests_per_minute, window) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute, window) if tokens_per_minute > 0 else None
+        self.paused_until = 0.0
+        self._queue = []  # heap of [lane rank, arrival, tokens, lane, wake()]
+        self._arrivals = itertools.count()
+        self._lock = threading.Lock()
+
+    def depth(self):
+        with self._lock:
+            return len(self._queue)
+
+    # Seconds the first call must still wait; called with the lock held
+    def _delay(self, tokens, now):
+        delay = self.paused_until - now
+        if self.requests is not None:
+            delay = max(delay, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.wait_time(tokens, now))
+        return delay
+
+    def _enqueue(self, tokens, lane, wake):
+        if lane not in LANES:
+            raise ValueError(f"Unknown lane {lane!r}, expected one of {LANES}")
+        entry = [LANES.index(lane), next(self._arrivals), tokens, lane, wake]
+        with self._lock:
+            heapq.heappush(self._queue, entry)
+        telemetry.LLM_QUEUE_DEPTH.inc(lane)
+        return entry
+
+    # Admit entry if it is first and the limits allow it (returns 0), or return the seconds
+    # until it could be (None: not first, wait to be woken). Called with the lock held.
+    def _try_admit(self, entry):
+        if self._queue[0] is not entry:
+            return None
+        now = time.monotonic()
+        delay = self._delay(entry[2], now)
+        if delay > 0:
+            return delay
+        heapq.heappop(self._queue)
+        if self.requests is not None:
+            self.requests.take(1, now)
+        if self.tokens is not None:
+            self.tokens.take(entry[2], now)
+        if self._queue:
+            self._queue[0][4]()  # The next call is first now
+        return 0
+
+    # A waiting call gave up (its request was cancelled)
+    def _leave(self, entry):
+        with self._lock:
+            if entry in self._queue:
+                first = self._queue[0] is entry
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                if first and self._queue:
+                    self._queue[0][4]()
+
+    def _admitted(self, entry, started):
+        telemetry.LLM_QUEUE_DEPTH.dec(entry[3])
+        waited = time.monotonic() - started
+        telemetry.LLM_QUEUE_SECONDS.observe(waited, entry[3])
+        return waited
+
+    # Wait until a call with a prompt of about tokens tokens may be sent. Returns the
+    # seconds waited.
+    async def acquire(self, tokens, lane=None):
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        started = time.monotonic()
+        entry = self._enqueue(tokens, lane or current_lane(), lambda: loop.call_soon_threadsafe(woken.set))
+        try:
+            while True:
+                with self._lock:
+                    woken.clear()
+                    delay = self._try_admit(entry)
+                if delay == 0:
+                    return self._admitted(entry, started)
+                try:
+                    await asyncio.wait_for(woken.wait(), delay)
+                except TimeoutError:
+                    pass
+        except BaseException:
+            self._leave(entry)
+            telemetry.LLM_QUEUE_DEPTH.dec(entry[3])
+            raise
+
+    # Blocking acquire for calls made from threads
+    def acquire_sync(self, tokens, lane=None):
+        woken = threading.Event()
+        started = time.monotonic()
+        entry = self._enqueue(tokens, lane or current_lane(), woken.set)
+        try:
+            while True:
+                with self._lock:
+                    woken.clear()
+                    delay = self._try_admit(entry)
+                if delay == 0:
+                    return self._admitted(entry, started)
+                woken.wait(delay)
+        except BaseException:
+            self._leave(entry)
+            telemetry.LLM_QUEUE_DEPTH.dec(entry[3])
+            raise
+
+    # Charge the difference between the tokens a call really used and the estimate
+    # taken for it when it was admitted
+    def settle(self, estimated, used):
+        if self.tokens is not None and used != estimated:
+            with self._lock:
+                self.tokens.take(used - estimated, time.monotonic())
+
+    # The service said to slow down: hold back every call for seconds
+    def pause(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            paused_until = max(self.paused_until, now + seconds)
+            if self.requests is not None:
+                self.requests.drain(paused_until - now, now)
+            telemetry.LLM_THROTTLED_SECONDS.inc(amount=round(paused_until - max(self.paused_until, now), 3))
+            self.paused_until = paused_until
+            if self._queue:
+                self._queue[0][4]()
+
+
+llm_scheduler = Scheduler()
@@ -0,0 +1,177 @@
+# streaming.py
+
+import asyncio
+import json
+import os
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+
+import llm
+
+# Chunks of a pipelined report waiting for a model call; when that many wait, the chunker,
+# and through it the extraction of further pages, waits too
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+
+NO_TEXT_ERROR = "None of the provided files contain extractable text."
+
+# Headers that stop proxies (nginx in particular) from buffering the event stream
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+# One server-sent event; data is sent as JSON so answers with newlines survive intact
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Pipelines are async generators of (event, data) pairs. The same pipeline backs the
+# streamed response and the plain JSON one, which only keeps the "done" payload.
+# A model call that failed for good ends the stream with an "error" event.
+def sse_response(events):
+    async def body():
+        try:
+            async for event, data in events:
+                yield sse_event(event, data)
+        except llm.LLMError as e:
+            yield sse_event("error", {"error": str(e), "status_code": e.status_code})
+
+    return StreamingResponse(body(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+async def final_result(events):
+    try:
+        async for event, data in events:
+            if event == "error":
+                raise HTTPException(status_code=data.get("status_code", 400), detail=data["error"])
+            if event == "done":
+                return data
+    except llm.LLMError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    raise HTTPException(status_code=500, detail="The answer stream ended without a result.")
+
+
+# final_result for the endpoints that answer errors as {"error": ...} rather than {"detail": ...}
+async def final_json(events):
+    try:
+        async for event, data in events:
+            if event == "error":
+                return JSONResponse(content={"error": data["error"]}, status_code=data.get("status_code", 400))
+            if event == "done":
+                return data
+    except llm.LLMError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=e.status_code)
+    finally:
+        await events.aclose()
+    return JSONResponse(content={"error": "The answer stream ended without a result."}, status_code=500)
+
+
+# Query every chunk concurrently and emit a "chunk" event per answer as it completes.
+# The answers are also written into answers (in chunk order) for the caller to combine.
+# A chunk the model couldn't answer gets a "chunk" event with the error instead and is
+# left out; when no chunk could be answered the error is raised.
+async def stream_chunk_answers(chunks, worker, answers):
+    answers[:] = [""] * len(chunks)
+    yield "progress", {"stage": "querying", "chunks": len(chunks)}
+    failed = {}
+    async for position, answer in llm.iter_as_completed(chunks, worker, keep_errors=True):
+        if isinstance(answer, llm.LLMError):
+            failed[position] = answer
+            yield "chunk", {"index": position, "error": str(answer)}
+            continue
+        answers[position] = answer
+        yield "chunk", {"index": position, "answer": answer}
+    if failed:
+        if len(failed) == len(chunks):
+            raise next(iter(failed.values()))
+        answers[:] = [answer for position, answer in enumerate(answers) if position not in failed]
+
+
+# stream_chunk_answers for uploads that are still being extracted. pieces is the
+# extraction stage, an async generator of (event, data): "text" events carry the text in
+# document order and are fed to chunker (a chunking.Chunker), any other event is passed
+# on. Each chunk is sent to the model as soon as it is complete, so the first calls
+# overlap the extraction of the later pages and files. The stages are joined by bounded
+# queues: PIPELINE_QUEUE_SIZE chunks wait for the LLM_MAX_CONCURRENCY calls, and while
+# they are full the extraction stage is not read from. An "error" event from it ends the
+# stream, as does text with no chunk in it (with the NO_TEXT_ERROR "error" event).
+async def stream_pipelined_chunk_answers(pieces, chunker, worker, answers):
+    chunks = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+    results = asyncio.Queue()  # (kind, value) from the stages, read here in arrival order
+
+    async def chunk_stage():
+        try:
+            position = 0
+            async for event, data in pieces:
+                if event != "text":
+                    results.put_nowait(("event", (event, data)))
+                    if event == "error":
+                        return
+                    continue
+                for chunk in chunker.feed(data):
+                    await chunks.put((position, chunk))
+                    position += 1
+            for chunk in chunker.finish():
+                await chunks.put((position, chunk))
+                position += 1
+            results.put_nowait(("chunked", position))
+            await chunks.put(None)
+        except Exception as e:
+            results.put_nowait(("raise", e))
+        finally:
+            await pieces.aclose()  # Stops the parsing of pages read ahead
+
+    async def query_stage():
+        try:
+            while (item := await chunks.get()) is not None:
+                position, chunk = item
+                try:
+                    results.put_nowait(("answer", (position, await worker(chunk))))
+                except llm.LLMError as e:
+                    results.put_nowait(("answer", (position, e)))
+            chunks.put_nowait(None)  # For the other callers
+        except Exception as e:
+            results.put_nowait(("raise", e))
+        finally:
+            results.put_nowait(("exit", None))
+
+    callers = max(1, llm.LLM_MAX_CONCURRENCY)
+    tasks = [asyncio.ensure_future(chunk_stage())] + [asyncio.ensure_future(query_stage()) for _ in range(callers)]
+    answered = {}
+    failed = {}
+    chunk_count = None
+    try:
+        while callers:
+            kind, value = await results.get()
+            if kind == "exit":
+                callers -= 1
+            elif kind == "raise":
+                raise value
+            elif kind == "event":
+                yield value
+                if value[0] == "error":
+                    return
+            elif kind == "chunked":
+                chunk_count = value
+                yield "progress", {"stage": "chunked", "chunks": chunk_count}
+                if not chunk_count:
+                    yield "error", {"error": NO_TEXT_ERROR}
+                    return
+            else:
+                position, answer = value
+                if isinstance(answer, llm.LLMError):
+                    failed[position] = answer
+                    yield "chunk", {"index": position, "error": str(answer)}
+                else:
+                    answered[position] = answer
+                    yield "chunk", {"index": position, "answer": answer}
+    finally:
+        # The client went away, or extraction failed; don't leave calls or parsing running
+        for task in tasks:
+            task.cancel()
+
+    if failed and not answered:
+        raise next(iter(failed.values()))
+    answers[:] = [answered[position] for position in sorted(answered)]
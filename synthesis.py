@@ -0,0 +1,64 @@
+# synthesis.py
+
+import os
+import time
+
+import chunking
+import llm
+
+# Token budget of one reduce call's input, and how many answers one call may merge
+SYNTHESIS_MAX_TOKENS = int(os.getenv("SYNTHESIS_MAX_TOKENS", "8000"))
+SYNTHESIS_FAN_IN = int(os.getenv("SYNTHESIS_FAN_IN", "8"))
+
+# Levels of merging before the final call is made with whatever is left
+SYNTHESIS_MAX_DEPTH = int(os.getenv("SYNTHESIS_MAX_DEPTH", "4"))
+
+
+# Group consecutive texts into batches of at most fan_in texts and max_tokens tokens.
+# A text that is over budget on its own gets a batch to itself.
+def pack_batches(texts, max_tokens, fan_in, counter):
+    batches = []
+    current = []
+    current_tokens = 0
+    for text in texts:
+        tokens = counter(text)
+        if current and (len(current) >= fan_in or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+# Tree reduce: merge the answers a level at a time, every batch of a level in parallel,
+# until they fit in one final call. merge(text) is the app's query function bound to the
+# merge instructions. A batch whose merge call fails is passed on as its answers joined,
+# so one failed call doesn't sink the whole answer. Returns the remaining answers and the
+# timing of each level.
+async def reduce_until_fits(texts, merge, model=chunking.DEFAULT_MODEL, max_tokens=None, fan_in=None, max_depth=None):
+    max_tokens = max_tokens or SYNTHESIS_MAX_TOKENS
+    fan_in = max(2, fan_in or SYNTHESIS_FAN_IN)
+    max_depth = SYNTHESIS_MAX_DEPTH if max_depth is None else max_depth
+    counter = chunking.get_token_counter(model)
+
+    levels = []
+    while len(levels) < max_depth:
+        batches = pack_batches(texts, max_tokens, fan_in, counter)
+        if len(batches) <= 1:
+            break
+
+        start = time.perf_counter()
+        joined = ["\n".join(batch) for batch in batches]
+        merged = await llm.gather_in_order(joined, merge, keep_errors=True)
+        failed = sum(isinstance(text, llm.LLMError) for text in merged)
+        texts = [text if isinstance(result, llm.LLMError) else result for text, result in zip(joined, merged)]
+        levels.append({"level": len(levels) + 1, "inputs": sum(map(len, batches)), "calls": len(batches),
+                       "failed": failed, "seconds": round(time.perf_counter() - start, 3)})
+        print(f"Synthesis level {levels[-1]['level']}: {levels[-1]['inputs']} answers merged in "
+              f"{levels[-1]['calls']} calls ({failed} failed, kept unmerged), {levels[-1]['seconds']}s")
+        if failed == len(batches):
+            break  # Nothing was merged; another level would only repeat the same calls
+
+    return texts, levels
@@ -0,0 +1,253 @@
+# telemetry.py
+
+import bisect
+import contextlib
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+# Share of requests whose spans are printed as one JSON line when they finish; metrics
+# are recorded for every request either way
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+
+# Spans kept per request; later ones still count in the metrics but are left out of the trace
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "500"))
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Callers may pass their own request id in this header; it is echoed in the response
+REQUEST_ID_HEADER = "x-request-id"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}  # label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, tuple(labels), tuple(buckets)
+        self.values = {}  # label values -> [count per bucket (the last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][position] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(label_values, list(counts), total) for label_values, (counts, total) in self.values.items()]
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _labels(self.labels + ("le",), label_values + (str(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}  # label values -> current value
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+REQUESTS = Counter("http_requests_total", "HTTP requests by app, method, route and status.", ["app", "method", "route", "status"])
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time from request to the last byte of the response.",
+                            ["app", "method", "route"])
+STAGE_SECONDS = Histogram("stage_duration_seconds", "Time spent in each stage of request handling.", ["stage"])
+STAGE_ERRORS = Counter("stage_errors_total", "Stages that raised.", ["stage"])
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens sent to and received from the chat models.", ["direction"])
+LLM_QUEUE_DEPTH = Gauge("llm_queue_depth", "Chat model calls waiting for the rate limits, by priority lane.", ["lane"])
+LLM_QUEUE_SECONDS = Histogram("llm_queue_seconds", "Time chat model calls waited for the rate limits.", ["lane"])
+LLM_RETRIES = Counter("llm_retries_total", "Chat model calls retried, by what went wrong.", ["reason"])
+LLM_THROTTLED_SECONDS = Counter("llm_throttled_seconds_total", "Seconds every call was held back after the service said to slow down.")
+LLM_FAILURES = Counter("llm_failures_total", "Chat model calls given up on, by what went wrong.", ["reason"])
+COALESCED = Counter("coalesced_total", "Callers that joined an identical computation already in flight.", ["kind"])
+LLM_CALLS_SAVED = Counter("llm_calls_saved_total", "Chat model calls not made because an identical computation was in flight.", ["kind"])
+METRICS = [REQUESTS, REQUEST_SECONDS, STAGE_SECONDS, STAGE_ERRORS, LLM_TOKENS,
+           LLM_QUEUE_DEPTH, LLM_QUEUE_SECONDS, LLM_RETRIES, LLM_THROTTLED_SECONDS, LLM_FAILURES,
+           COALESCED, LLM_CALLS_SAVED]
+
+
+# The trace of the current request or job: {"request_id", "started", "spans"}, or None
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def current_request_id():
+    trace = _trace.get()
+    return trace["request_id"] if trace else None
+
+
+# Time a stage of the current request. Yields a dict of attributes the caller can add
+# to (sizes, token counts); the stage's duration goes to stage_duration_seconds, and the
+# span to the request's trace. Works the same in sync code, async code and worker threads.
+@contextlib.contextmanager
+def span(name, **attributes):
+    started = time.perf_counter()
+    try:
+        yield attributes
+    except GeneratorExit:
+        attributes["closed"] = True  # A streaming caller stopped reading early
+        raise
+    except BaseException as e:
+        STAGE_ERRORS.inc(name)
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_SECONDS.observe(duration, name)
+        trace = _trace.get()
+        if trace is not None and len(trace["spans"]) < TRACE_MAX_SPANS:
+            trace["spans"].append({"name": name, "start_ms": round((started - trace["started"]) * 1000, 3),
+                                   "duration_ms": round(duration * 1000, 3), **attributes})
+
+
+def count_tokens(tokens_in, tokens_out):
+    LLM_TOKENS.inc("in", amount=tokens_in)
+    LLM_TOKENS.inc("out", amount=tokens_out)
+
+
+# Collect the spans of a unit of work done outside a request (e.g. a background job)
+# under request_id, and print them when it ends
+@contextlib.contextmanager
+def trace(request_id, **attributes):
+    state = {"request_id": request_id, "started": time.perf_counter(), "spans": []}
+    token = _trace.set(state)
+    try:
+        yield state
+    finally:
+        _trace.reset(token)
+        _emit(state, attributes)
+
+
+def _emit(state, attributes):
+    if random.random() >= TRACE_SAMPLE_RATE:
+        return
+    record = {"request_id": state["request_id"], **attributes,
+              "duration_ms": round((time.perf_counter() - state["started"]) * 1000, 3),
+              "spans": sorted(state["spans"], key=lambda span: span["start_ms"])}
+    print(json.dumps(record, default=str))
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ASGI middleware giving every HTTP request an id (the caller's X-Request-ID or a new
+# one, echoed in the response), a trace its spans are collected in, and request count
+# and latency metrics labelled by the route template rather than the raw path. Latency
+# runs to the last byte of the body, so streamed answers are timed in full.
+class TelemetryMiddleware:
+    def __init__(self, app, service):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == REQUEST_ID_HEADER.encode():
+                request_id = value.decode("latin-1")[:128]
+        state = {"request_id": request_id or uuid.uuid4().hex, "started": time.perf_counter(), "spans": []}
+        token = _trace.set(state)
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(REQUEST_ID_HEADER.encode(), state["request_id"].encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _trace.reset(token)
+            route = scope.get("route")
+            route = getattr(route, "path", "unmatched")
+            duration = time.perf_counter() - state["started"]
+            REQUESTS.inc(self.service, scope["method"], route, status)
+            REQUEST_SECONDS.observe(duration, self.service, scope["method"], route)
+            if route != "/metrics":
+                _emit(state, {"app": self.service, "method": scope["method"], "route": route, "status": status})
+
+
+# Add the middleware and a Prometheus /metrics endpoint to an app, and render its JSON
+# responses inside a "response.serialize" span. Call before the app's routes are declared,
+# since routes take the app's default response class when they are added. FastAPI is
+# imported here rather than at the top so the extraction workers, which import this
+# module for their spans, don't pay for it.
+def instrument(app, service):
+    from fastapi.responses import JSONResponse, Response
+
+    class TracedJSONResponse(JSONResponse):
+        def render(self, content):
+            with span("response.serialize") as attributes:
+                body = super().render(content)
+                attributes["bytes"] = len(body)
+            return body
+
+    app.router.default_response_class = TracedJSONResponse
+    app.add_middleware(TelemetryMiddleware, service=service)
+
+    @app.get("/metrics", include_in_schema=False)
+    def read_metrics():
+        return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
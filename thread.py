@@ -1,13 +1,26 @@
 import os
 import PyPDF2
 import openai
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Request
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Dict, List
+from typing import Dict, List, Optional
 import pandas as pd
 import csv
+import cache
+import chunking
+import coalesce
+import context
+import extraction
+import ingest
+import listing
+import llm
+import retrieval
+import scheduler
+import streaming
+import telemetry
+from thread_store import ThreadStore
 from uuid import UUID, uuid4
 
 app = FastAPI()
@@ -21,11 +34,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request ids, timed spans of each stage and a Prometheus /metrics endpoint
+telemetry.instrument(app, "thread")
+
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await llm.aclose_clients()
+
+
+@app.on_event("shutdown")
+def close_extraction_pool():
+    extraction.shutdown_pool()
+
 # Set your OpenAI API key
 openai.api_key = ""  # Replace with your actual OpenAI API key
 
 # Data structure to hold user threads
-user_threads: Dict[str, List[Dict]] = {}
+thread_store = ThreadStore()
 
 # Define a directory to save uploaded files
 UPLOAD_DIR = "uploaded_files"
@@ -43,171 +69,232 @@ class Thread(BaseModel):
     messages: List[Message] = []  # Add messages to the thread
     uploaded_files: List[str] = []  # Track uploaded file paths
 
-# Utility function to extract text from PDF, TXT, CSV, and Excel
-def extract_text(file: UploadFile):
-    file_type = file.filename.lower()
+# Bump when extraction output changes so text cached by older extractors is not reused
+EXTRACTOR_VERSION = f"2-pypdf2-{PyPDF2.__version__}-pandas-{pd.__version__}-{extraction.OCR_VERSION}"
+
+# Utility function to extract text from a saved upload (PDF, TXT, CSV, and Excel).
+# Results are cached by the hash taken while the upload was saved, so re-uploads skip extraction.
+async def extract_text(filename, path, digest):
+    file_type = filename.lower()
 
     try:
+        key = cache.extraction_key(digest, os.path.splitext(file_type)[1], EXTRACTOR_VERSION)
+        cached_text = await cache.extraction_cache.aget(key)
+        if cached_text is not None:
+            return cached_text
+
         if file_type.endswith(".pdf"):
-            return extract_text_from_pdf(file.file)
+            text = await extract_text_from_pdf(path)
         elif file_type.endswith(".txt"):
-            return extract_text_from_txt(file.file)
+            text = extract_text_from_txt(path)
         elif file_type.endswith(".csv"):
-            return extract_text_from_csv(file.file)
+            text = extract_text_from_csv(path)
         elif file_type.endswith((".xls", ".xlsx")):
-            return extract_text_from_excel(file.file)
+            text = await extract_text_from_excel(path)
         else:
-            raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.filename}")
+            raise HTTPException(status_code=400, detail=f"Unsupported file type: {filename}")
+
+        # Extractors return "" on failure; don't pin a failed extraction in the cache
+        if text:
+            await cache.extraction_cache.aset(key, text)
+        return text
+    except HTTPException:
+        raise
+    except TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Timed out extracting text from the file: {filename}")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing the file: {file.filename}. Details: {e}")
+        raise HTTPException(status_code=500, detail=f"Error processing the file: {filename}. Details: {e}")
 
-def extract_text_from_pdf(file):
-    pdf_text = ""
-    try:
-        pdf_reader = PyPDF2.PdfReader(file)
-        for page in pdf_reader.pages:
-            pdf_text += page.extract_text() or ""
-    except Exception as e:
-        print(f"Error reading the PDF file: {e}")
-    return pdf_text
+# Function to extract text from a PDF file, parsed in the extraction process pool
+# (large PDFs are split into page ranges that are parsed in parallel)
+async def extract_text_from_pdf(path):
+    return await extraction.aextract_pdf(path)
 
-def extract_text_from_txt(file):
+def extract_text_from_txt(path):
     try:
-        return file.read().decode("utf-8")
+        with open(path, encoding="utf-8") as file:
+            return file.read()
     except Exception as e:
         print(f"Error reading the TXT file: {e}")
         return ""
 
-def extract_text_from_csv(file):
-    csv_text = ""
+def extract_text_from_csv(path):
+    rows = []
     try:
-        content = file.read().decode("utf-8").splitlines()
-        reader = csv.reader(content)
-        for row in reader:
-            csv_text += " ".join(row) + "\n"
+        with open(path, encoding="utf-8", newline="") as file:
+            for row in csv.reader(file):
+                rows.append(" ".join(row) + "\n")
     except Exception as e:
         print(f"Error reading the CSV file: {e}")
-    return csv_text
-
-def extract_text_from_excel(file):
-    try:
-        excel_data = pd.read_excel(file)
-        return excel_data.to_string(index=False)
-    except Exception as e:
-        print(f"Error reading the Excel file: {e}")
-        return ""
-
-# Function to split text into chunks to handle token limits
-def split_text_into_chunks(text, chunk_size=1500):
-    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
-
-# Function to query OpenAI API with a single chunk
-def query_pdf_content(chunk_text, query):
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"Analyze the following document: {chunk_text}. Based on this text, answer the question: {query}."
-                }
-            ]
-        )
-        return response['choices'][0]['message']['content']
-    except Exception as e:
-        print(f"Error querying OpenAI API: {e}")
-        return f"Error querying OpenAI API: {e}"
-
-# Function to query OpenAI API with multiple chunks and get a combined response
-def query_pdf_content_in_chunks(combined_text, query):
-    chunks = split_text_into_chunks(combined_text)
-    responses = []
-
-    for chunk in chunks:
-        response = query_pdf_content(chunk, query)
-        responses.append(response)
+    return "".join(rows)
+
+# Function to extract text from an Excel file, parsed in the extraction process pool
+async def extract_text_from_excel(path):
+    return await extraction.aextract_excel(path)
+
+# Function to split text into sentence-aware chunks that fit the model's token budget
+def split_text_into_chunks(text, max_tokens=None):
+    with telemetry.span("chunking", chars=len(text)) as attributes:
+        chunks = list(chunking.iter_chunks(text, max_tokens=max_tokens, model="gpt-4o-mini"))
+        attributes["chunks"] = len(chunks)
+    return chunks
+
+# Bump when the chunk prompt changes so answers to the old prompt are not served from the cache
+PROMPT_VERSION = "1"
+
+# Function to query OpenAI API with a single chunk, over the shared keep-alive pool in llm.py.
+# Answers are cached by chunk, query, model and prompt version; use_cache=False skips
+# the lookup (the fresh answer still replaces the cached one).
+async def aquery_pdf_content(chunk_text, query, use_cache=True):
+    key = cache.response_key(chunk_text, query, "gpt-4o-mini", PROMPT_VERSION)
+    if use_cache:
+        cached_answer = await cache.response_cache.aget(key)
+        if cached_answer is not None:
+            return cached_answer
+
+    data = {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {
+                "role": "user",
+                "content": f"Analyze the following document: {chunk_text}. Based on this text, answer the question: {query}."
+            }
+        ]
+    }
+    async def call():
+        answer = await llm.apost_chat_completion(llm.OPENAI_CHAT_URL, llm.openai_headers(openai.api_key), data)
+        await cache.response_cache.aset(key, answer)
+        return answer
+
+    # The same prompt already in flight for another request is waited for, not sent again
+    return await coalesce.llm_calls.run(key, call)
+
+# One uncached prompt to the model, used to compress conversation summaries; raises on failure
+async def acomplete(prompt):
+    data = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": prompt}]}
+    return await llm.apost_chat_completion(llm.OPENAI_CHAT_URL, llm.openai_headers(openai.api_key), data)
+
+# Function to query OpenAI API with a list of chunks and get a combined response
+async def query_chunks(chunks, query, use_cache=True):
+    # Chunks are queried concurrently (bounded by LLM_MAX_CONCURRENCY), answers keep chunk order;
+    # chunks the model couldn't answer are left out
+    responses = await llm.gather_in_order(chunks, lambda chunk: aquery_pdf_content(chunk, query, use_cache), keep_errors=True)
+    responses = llm.successful(responses)
 
     return "\n".join(responses)
 
+# Function to query OpenAI API with every chunk of the text
+async def query_pdf_content_in_chunks(combined_text, query, use_cache=True):
+    return await query_chunks(split_text_into_chunks(combined_text), query, use_cache)
+
 # API to create a new thread
 @app.post("/threads/", response_model=Thread)
 async def create_thread(thread: Thread):
-    if thread.user_id not in user_threads:
-        user_threads[thread.user_id] = []
-
-    if any(existing_thread['id'] == thread.id for existing_thread in user_threads[thread.user_id]):
+    # Duplicate thread IDs for the same user are rejected by the store
+    if not thread_store.create(thread.user_id, thread.dict()):
         raise HTTPException(status_code=400, detail="Thread with this ID already exists for this user.")
-
-    user_threads[thread.user_id].append(thread.dict())
     return thread
 
 # API to read all threads
-@app.get("/threads/", response_model=Dict[str, List[Thread]])
-def read_threads():
-    return {user_id: [Thread(**thread) for thread in threads] for user_id, threads in user_threads.items()}
+# Paged by ?limit= and the X-Next-Cursor header (pass it back as ?cursor=); content and
+# messages are left out unless asked for with ?fields=
+@app.get("/threads/")
+def read_threads(request: Request, cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1), fields: Optional[str] = None):
+    fields = listing.parse_fields(fields, Thread)
+    page, after = thread_store.page(listing.parse_limit(limit), after=listing.decode_cursor(cursor))
+
+    threads_by_user = {}
+    for thread in page:
+        threads_by_user.setdefault(thread['user_id'], []).append(listing.project(thread, fields))
+    next_cursor = listing.encode_cursor(*after) if after else None
+    return listing.json_response(request, threads_by_user, next_cursor)
 
 # API to read threads by user ID
-@app.get("/threads/{user_id}", response_model=List[Thread])
-def read_user_threads(user_id: str):
-    if user_id in user_threads:
-        return [Thread(**thread) for thread in user_threads[user_id]]
-    raise HTTPException(status_code=404, detail="User threads not found")
+@app.get("/threads/{user_id}")
+def read_user_threads(user_id: str, request: Request, cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1), fields: Optional[str] = None):
+    if not thread_store.has_user(user_id):
+        raise HTTPException(status_code=404, detail="User threads not found")
+
+    fields = listing.parse_fields(fields, Thread)
+    page, after = thread_store.page(listing.parse_limit(limit), after=listing.decode_cursor(cursor), user_id=user_id)
+    next_cursor = listing.encode_cursor(*after) if after else None
+    return listing.json_response(request, [listing.project(thread, fields) for thread in page], next_cursor)
 
 # API to read a specific thread
 @app.get("/threads/{user_id}/{thread_id}", response_model=Thread)
 def read_thread(user_id: str, thread_id: UUID):
-    if user_id not in user_threads:
+    if not thread_store.has_user(user_id):
         raise HTTPException(status_code=404, detail="User threads not found")
 
-    for thread in user_threads[user_id]:
-        if thread['id'] == thread_id:
-            return Thread(**thread)
+    thread = thread_store.get(user_id, thread_id)
+    if thread is not None:
+        return thread
     raise HTTPException(status_code=404, detail="Thread not found")
 
 # API to update a thread
 @app.put("/threads/{user_id}/{thread_id}", response_model=Thread)
 def update_thread(user_id: str, thread_id: UUID, updated_thread: Thread):
-    if user_id not in user_threads:
+    if not thread_store.has_user(user_id):
         raise HTTPException(status_code=404, detail="User threads not found")
 
-    for index, thread in enumerate(user_threads[user_id]):
-        if thread['id'] == thread_id:
-            user_threads[user_id][index] = updated_thread.dict()
-            return updated_thread
+    thread = updated_thread.dict()
+    if thread_store.replace(user_id, thread_id, thread):
+        return updated_thread
     raise HTTPException(status_code=404, detail="Thread not found")
 
 # API to delete a thread
 @app.delete("/threads/{user_id}/{thread_id}", response_model=Thread)
 def delete_thread(user_id: str, thread_id: UUID):
-    if user_id not in user_threads:
+    if not thread_store.has_user(user_id):
         raise HTTPException(status_code=404, detail="User threads not found")
 
-    for index, thread in enumerate(user_threads[user_id]):
-        if thread['id'] == thread_id:
-            return Thread(**user_threads[user_id].pop(index))
+    thread = thread_store.delete(user_id, thread_id)
+    if thread is not None:
+        return thread
     raise HTTPException(status_code=404, detail="Thread not found")
 
+# API to inspect cache hit/miss counters
+@app.get("/cache/stats")
+def read_cache_stats():
+    return cache.stats()
+
 # API to upload files and ask a query
 @app.post("/upload_and_query/")
 async def upload_and_query(
     files: List[UploadFile] = File(...), 
     query: str = Form(...),
-    user_id: str = Form(...)
+    user_id: str = Form(...),
+    top_k: Optional[int] = Form(None),
+    no_cache: bool = Form(False),  # Skip cached answers for this request
+    stream: bool = Form(False)  # Answer as a text/event-stream instead of one JSON body
 ):
-    combined_text = ""
+    uploads = []
     uploaded_file_names = [] 
 
     for file in files:
-        # Save the file to the specified directory
-        file_location = os.path.join(UPLOAD_DIR, file.filename)
-        with open(file_location, "wb") as f:
-            f.write(await file.read())  # Save the file content
+        # Stream the file to the specified directory, saved under its content hash so another
+        # upload with the same name can't replace it before its text is extracted
+        file_location, digest, _ = await ingest.save_upload_by_digest(file, UPLOAD_DIR)
 
         uploaded_file_names.append(file_location)  # Store the saved file path
+        uploads.append((file.filename, file_location, digest))
+
+    events = stream_upload_and_query(uploads, uploaded_file_names, query, user_id, top_k, not no_cache)
+    if stream:
+        return streaming.sse_response(events)
+    return await streaming.final_result(events)
 
-        # Extract text from the uploaded file
-        extracted_text = extract_text(file)
-        combined_text += extracted_text + "\n"
+# Event stream behind upload_and_query: extraction progress, each chunk answer as it
+# completes, then a "done" event with the combined answer
+async def stream_upload_and_query(uploads, uploaded_file_names, query, user_id, top_k, use_cache):
+    combined_text = ""
+    for position, (filename, file_location, digest) in enumerate(uploads):
+        yield "progress", {"stage": "extracting", "file": filename, "index": position, "files": len(uploads)}
+        try:
+            combined_text += await extract_text(filename, file_location, digest) + "\n"
+        except HTTPException as e:
+            yield "error", {"error": e.detail, "status_code": e.status_code}
+            return
 
     # Create a new thread with uploaded files
     thread_id = uuid4()  # Generate a new UUID for the thread
@@ -216,10 +303,25 @@ async def upload_and_query(
     # Create the thread
     await create_thread(new_thread)
 
-    # Query the content
-    answer = query_pdf_content_in_chunks(combined_text, query)
-    
-    return {"query": query, "answer": answer}
+    # Index the chunks once and keep the index with the thread for follow-up questions,
+    # along with the hashes of the files it covers
+    thread = thread_store.get(user_id, thread_id)
+    index = retrieval.build_index(split_text_into_chunks(combined_text))
+    thread['search_index'] = index
+    thread['file_digests'] = [digest for _, _, digest in uploads]
+
+    # Query only the chunks that are most relevant to the question
+    answers = []
+    async for event in streaming.stream_chunk_answers(index.top_chunks(query, top_k), lambda chunk: aquery_pdf_content(chunk, query, use_cache), answers):
+        yield event
+    answer = "\n".join(answers)
+
+    # Start the rolling summary that follow-up questions carry, after the answer is sent
+    async def save_summary(summary):
+        thread['summary'] = summary
+    context.update_summary_later(thread_id, "", query, answer, acomplete, save_summary, model="gpt-4o-mini")
+
+    yield "done", {"query": query, "answer": answer}
 
 # API to upload files and continue chat on an existing thread
 @app.post("/upload_and_continue_chat/")
@@ -227,32 +329,78 @@ async def upload_and_continue_chat(
     thread_id: UUID = Form(...),
     files: List[UploadFile] = File(...),
     query: str = Form(...),
-    user_id: str = Form(...)
+    user_id: str = Form(...),
+    top_k: Optional[int] = Form(None),
+    no_cache: bool = Form(False),  # Skip cached answers for this request
+    stream: bool = Form(False)  # Answer as a text/event-stream instead of one JSON body
 ):
-    combined_text = ""
+    # Fetch the thread
+    if not thread_store.has_user(user_id):
+        raise HTTPException(status_code=404, detail="User threads not found.")
+    thread = thread_store.get(user_id, thread_id)
+    if thread is None:
+        raise HTTPException(status_code=404, detail="Thread not found.")
 
-    # Extract text from the uploaded files
+    # Save the uploaded files and extract text only from files the thread hasn't seen;
+    # the text of the others is already in its index
+    combined_text = ""
+    new_files = []
+    seen_digests = set(thread.get('file_digests', []))
     for file in files:
-        combined_text += extract_text(file) + "\n"
-
-    if not combined_text:
+        file_location, digest, _ = await ingest.save_upload_by_digest(file, UPLOAD_DIR)
+        if digest in seen_digests:
+            continue
+        seen_digests.add(digest)
+        text = await extract_text(file.filename, file_location, digest) + "\n"
+        new_files.append((file_location, digest, text))
+        combined_text += text
+
+    if new_files and not combined_text:
         return JSONResponse(content={"error": "None of the provided files contain extractable text."}, status_code=400)
 
-    # Fetch the thread and append the new message
-    if user_id in user_threads:
-        for thread in user_threads[user_id]:
-            if thread['id'] == thread_id:
-                thread['messages'].append({"user_id": user_id, "content": query})
-                break
-        else:
-            raise HTTPException(status_code=404, detail="Thread not found.")
-    else:
-        raise HTTPException(status_code=404, detail="User threads not found.")
-
-    # Query the content
-    answer = query_pdf_content_in_chunks(combined_text, query)
-
-    # Append assistant's response
+    # The thread as it is now: another turn or an update may have changed it while the files
+    # were extracted. Nothing below awaits until the files are added, so no turn comes between.
+    thread = thread_store.get(user_id, thread_id)
+    if thread is None:
+        raise HTTPException(status_code=404, detail="Thread not found.")
+    known_digests = set(thread.get('file_digests', []))
+    new_files = [new_file for new_file in new_files if new_file[1] not in known_digests]
+    combined_text = "".join(text for _, _, text in new_files)
+
+    # Reuse the thread's index and only index the newly uploaded files
+    index = thread.get('search_index') or retrieval.build_index(split_text_into_chunks(thread['content']))
+    recent_from = len(index)
+    index.add(split_text_into_chunks(combined_text))
+    thread['search_index'] = index
+    thread['content'] += combined_text
+    thread['uploaded_files'] = thread['uploaded_files'] + [file_location for file_location, _, _ in new_files]
+    thread['file_digests'] = thread.get('file_digests', []) + [digest for _, digest, _ in new_files]
+    thread['messages'].append({"user_id": user_id, "content": query})
+
+    events = stream_continue_chat(thread, index, recent_from, query, top_k, not no_cache)
+    if stream:
+        return streaming.sse_response(events)
+    return await streaming.final_result(events)
+
+# Event stream behind upload_and_continue_chat: each chunk answer as it completes, then
+# a "done" event; the combined answer is appended to the thread as the assistant's reply.
+# Chunks are picked from the earlier documents and the new ones (from recent_from on) and
+# asked the question; their answers are put in the context of the conversation so far.
+async def stream_continue_chat(thread, index, recent_from, query, top_k, use_cache):
+    scheduler.set_lane("interactive")  # Follow-up questions go ahead of bulk work for the rate limits
+    await context.wait_for_summary(thread['id'])  # The previous turn's, if still being written
+    summary = thread.get('summary', "")
+
+    # Query only the chunks that are most relevant to the question
+    answers = []
+    async for event in streaming.stream_chunk_answers(index.top_chunks(query, top_k, recent_from), lambda chunk: aquery_pdf_content(chunk, query, use_cache), answers):
+        yield event
+    answer = await context.answer_in_context(query, summary, answers, acomplete)
+
+    # Append assistant's response and fold the turn into the summary after the answer is sent
     thread['messages'].append({"user_id": "assistant", "content": answer})
+    async def save_summary(summary):
+        thread['summary'] = summary
+    context.update_summary_later(thread['id'], summary, query, answer, acomplete, save_summary, model="gpt-4o-mini")
     
-    return {"query": query, "answer": answer}
+    yield "done", {"query": query, "answer": answer}
@@ -0,0 +1,120 @@
+# thread_store.py
+
+import bisect
+import itertools
+import threading
+
+
+# In-memory thread repository shared by the apps. Threads are plain dicts with at least
+# "id" and "user_id", indexed by (user_id, thread_id) and by thread_id alone so lookups,
+# updates and deletes don't scan a user's threads. Per-user dicts keep creation order.
+# Handlers run both on the event loop and in the threadpool, so changes take a lock.
+# Thread ids are UUIDs; if two users ever share one, get_by_id returns the latest.
+# For paging, every thread gets a creation number, and users and each user's threads are
+# kept in lists in creation order, so a page resumes at its cursor with a binary search
+# instead of walking the threads before it. The cursor carries the creation number, so it
+# still resumes in the right place when its thread was deleted in the meantime.
+# Deleted threads leave a None in their user's list until it is more than half None.
+class ThreadStore:
+    def __init__(self):
+        self._by_user = {}  # user_id -> {thread_id: thread}
+        self._by_id = {}  # thread_id -> thread
+        self._users = []  # user ids in order of their first thread
+        self._user_positions = {}  # user_id -> index in _users
+        self._order = {}  # user_id -> [thread_id or None, ...] in creation order
+        self._numbers = {}  # user_id -> [creation number, ...] matching _order[user_id]
+        self._number_of = {}  # user_id -> {thread_id: creation number}
+        self._next_number = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def has_user(self, user_id):
+        return user_id in self._by_user
+
+    # Returns False when the user already has a thread with this id
+    def create(self, user_id, thread):
+        with self._lock:
+            threads = self._by_user.setdefault(user_id, {})
+            if thread["id"] in threads:
+                return False
+            if user_id not in self._user_positions:
+                self._user_positions[user_id] = len(self._users)
+                self._users.append(user_id)
+            number = next(self._next_number)
+            self._order.setdefault(user_id, []).append(thread["id"])
+            self._numbers.setdefault(user_id, []).append(number)
+            self._number_of.setdefault(user_id, {})[thread["id"]] = number
+            threads[thread["id"]] = thread
+            self._by_id[thread["id"]] = thread
+            return True
+
+    def get(self, user_id, thread_id):
+        return self._by_user.get(user_id, {}).get(thread_id)
+
+    def get_by_id(self, thread_id):
+        return self._by_id.get(thread_id)
+
+    # Returns False when the thread does not exist
+    def replace(self, user_id, thread_id, thread):
+        with self._lock:
+            threads = self._by_user.get(user_id)
+            if threads is None or thread_id not in threads:
+                return False
+            threads[thread_id] = thread
+            self._by_id[thread_id] = thread
+            return True
+
+    # Returns the removed thread, or None when it does not exist
+    def delete(self, user_id, thread_id):
+        with self._lock:
+            threads = self._by_user.get(user_id, {})
+            thread = threads.pop(thread_id, None)
+            if thread is None:
+                return None
+            if self._by_id.get(thread_id) is thread:
+                del self._by_id[thread_id]
+            order, numbers, number_of = self._order[user_id], self._numbers[user_id], self._number_of[user_id]
+            order[bisect.bisect_left(numbers, number_of.pop(thread_id))] = None
+            if len(order) > 2 * len(threads):
+                order[:] = list(threads)
+                numbers[:] = [number_of[thread_id] for thread_id in order]
+            return thread
+
+    def list_user(self, user_id):
+        with self._lock:
+            return list(self._by_user.get(user_id, {}).values())
+
+    # {user_id: [thread, ...]} snapshot of every thread
+    def by_user(self):
+        with self._lock:
+            return {user_id: list(threads.values()) for user_id, threads in self._by_user.items()}
+
+    # Up to limit threads in creation order (grouped by user), starting after the cursor
+    # after=(user_id, thread_id, number); only user_id's threads when it is given. number is
+    # the cursor thread's creation number, used when that thread has been deleted.
+    # Returns the page and the cursor of the next page, None when no threads follow it.
+    def page(self, limit, after=None, user_id=None):
+        with self._lock:
+            user_ids = [user_id] if user_id is not None else self._users
+            first_user, start = 0, 0
+            if after is not None:
+                after_user, after_thread, number = after
+                number = self._number_of.get(after_user, {}).get(after_thread, number)
+                if (user_id is not None and after_user != user_id) or number is None or after_user not in self._user_positions:
+                    return [], None  # The cursor belongs to someone else or to no thread of this store
+                first_user = 0 if user_id is not None else self._user_positions[after_user]
+                start = bisect.bisect_right(self._numbers[after_user], number)
+
+            def threads():
+                for index in range(first_user, len(user_ids)):
+                    current_user = user_ids[index]
+                    order, numbers = self._order.get(current_user, []), self._numbers.get(current_user, [])
+                    for position in range(start if index == first_user else 0, len(order)):
+                        if order[position] is not None:
+                            yield current_user, order[position], numbers[position]
+
+            entries = list(itertools.islice(threads(), limit + 1))
+            page = [self._by_user[current_user][thread_id] for current_user, thread_id, _ in entries[:limit]]
+        return page, entries[limit - 1] if len(entries) > limit else None